@@ -0,0 +1,140 @@
+import av
+import os
+import sys
+import argparse
+import numpy as np
+from data.split_utils import is_blank_frame, is_blank_frame_reference, is_blank_video_frame, is_color_frame, is_color_frame_reference, BLANK_BLACK_COLOR, BLANK_GREEN_COLOR, BLANK_BLUE_COLOR, BLANK_FRAME_THRESHOLD
+from utils.logger import setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+BASE_COLORS = {
+    "black": BLANK_BLACK_COLOR,
+    "green": BLANK_GREEN_COLOR,
+    "blue": BLANK_BLUE_COLOR,
+    "dark_grey": (30, 30, 30),
+    "grey": (128, 128, 128),
+    "white": (255, 255, 255),
+}
+
+# Standard deviation of the Gaussian noise, in pixel values. Between 1.0 and 1.3, the fraction of matching pixels crosses the 95% threshold.
+NOISE_SIGMAS = (0.0, 0.5, 1.0, 1.3, 1.6, 2.0, 2.2, 2.5, 3.0)
+
+# Fraction of the frame covered by content
+OVERLAY_FRACTIONS = (0.0, 0.03, 0.1, 0.5)
+
+# The detectors only look at every 16th pixel. Frames whose fraction of matching pixels is this close to the threshold can go either way and are reported as borderline instead of as disagreements.
+# At 1280x720, the standard error of the sampled fraction is about 0.001.
+BORDERLINE_MARGIN = 0.005
+
+
+def reference_frames(width: int, height: int, seed: int = 0):
+    """
+    Frames to compare the blank detectors on: noisy solid colours with and without content overlays, gradients and content.
+    :return: iterator over (name, uint8 rgb image of shape [height, width, 3])
+    """
+    rng = np.random.default_rng(seed)
+    content = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+
+    for color_name, color in BASE_COLORS.items():
+        for sigma in NOISE_SIGMAS:
+            noise = np.round(rng.normal(0, sigma, size=(height, width, 3))) if sigma > 0 else np.zeros((height, width, 3))
+            solid = np.clip(np.array(color, dtype=np.float64) + noise, 0, 255).astype(np.uint8)
+
+            for fraction in OVERLAY_FRACTIONS:
+                img = solid.copy()
+                if fraction > 0:
+                    # Rectangle with the frame's aspect ratio in the center
+                    overlay_height = int(round(height * np.sqrt(fraction)))
+                    overlay_width = int(round(width * np.sqrt(fraction)))
+                    y = (height - overlay_height) // 2
+                    x = (width - overlay_width) // 2
+                    img[y:y + overlay_height, x:x + overlay_width] = content[y:y + overlay_height, x:x + overlay_width]
+                yield f"{color_name}_sigma{sigma}_overlay{fraction}", img
+
+    _, xx = np.mgrid[0:height, 0:width]
+    yield "horizontal_gradient", np.repeat((xx * 255 // (width - 1)).astype(np.uint8)[..., None], 3, axis=2)
+    yield "shallow_gradient", np.repeat((xx * 8 // width).astype(np.uint8)[..., None], 3, axis=2)
+    yield "content", content
+
+
+def matching_fraction(img: np.ndarray, color=None) -> float:
+    """
+    Fraction of pixels within the tolerance of the given colour, or of the median colour, computed like in `is_blank_frame_reference`
+    """
+    reference_color = np.median(img, axis=(0, 1)) if color is None else np.array(color)
+    return float(np.mean(np.all(np.abs(img.astype(np.int32) - reference_color) <= 2, axis=2)))
+
+
+def _compare(mismatches: list[str], borderline: list[str], description: str, actual: bool, expected: bool, fraction_fn) -> None:
+    if actual == expected:
+        return
+    fraction = fraction_fn()
+    if abs(fraction - BLANK_FRAME_THRESHOLD) < BORDERLINE_MARGIN:
+        borderline.append(f"{description}: expected {expected}, fraction {fraction:.4f}")
+    else:
+        mismatches.append(f"{description}: expected {expected}, fraction {fraction:.4f}")
+
+
+def check_image_detectors(frames) -> tuple[list[str], list[str]]:
+    """
+    Compare `is_blank_frame` and `is_color_frame` with their full-resolution reference implementations.
+    :param frames: iterator over (name, rgb image), see `reference_frames`
+    :return: tuple (disagreements, borderline disagreements)
+    """
+    mismatches = []
+    borderline = []
+    num_frames = 0
+    for name, img in frames:
+        num_frames += 1
+        _compare(mismatches, borderline, f"is_blank_frame({name})", is_blank_frame(img), is_blank_frame_reference(img), lambda: matching_fraction(img))
+
+        for color_name, color in (("black", BLANK_BLACK_COLOR), ("green", BLANK_GREEN_COLOR), ("blue", BLANK_BLUE_COLOR)):
+            _compare(mismatches, borderline, f"is_color_frame({name}, {color_name})", is_color_frame(img, color), is_color_frame_reference(img, color), lambda: matching_fraction(img, color))
+
+    log.info(f"Compared the image detectors on {num_frames} frames.")
+    return mismatches, borderline
+
+
+def check_video_frame_detector(frames, pix_fmt: str = "yuv420p") -> tuple[list[str], list[str]]:
+    """
+    Compare `is_blank_video_frame` on decoded-like frames with the reference implementation on the same frame converted to rgb24.
+    :param frames: iterator over (name, rgb image), see `reference_frames`
+    :param pix_fmt: pixel format of the frames, as produced by the decoder
+    :return: tuple (disagreements, borderline disagreements)
+    """
+    mismatches = []
+    borderline = []
+    num_frames = 0
+    for name, img in frames:
+        num_frames += 1
+        frame = av.VideoFrame.from_ndarray(img, format="rgb24").reformat(format=pix_fmt)
+        rgb = frame.to_ndarray(format="rgb24")
+        _compare(mismatches, borderline, f"is_blank_video_frame({name}, {pix_fmt})", is_blank_video_frame(frame), is_blank_frame_reference(rgb), lambda: matching_fraction(rgb))
+
+    log.info(f"Compared the {pix_fmt} frame detector on {num_frames} frames.")
+    return mismatches, borderline
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that the fast blank and colour frame detectors agree with the full-resolution reference implementations")
+    parser.add_argument("--width", type=int, help="Frame width", default=1280)
+    parser.add_argument("--height", type=int, help="Frame height", default=720)
+    parser.add_argument("--seed", type=int, help="Seed of the noise and the content", default=0)
+    args = vars(parser.parse_args())
+
+    mismatches = []
+    borderline = []
+    for check in (check_image_detectors, check_video_frame_detector):
+        check_mismatches, check_borderline = check(reference_frames(args["width"], args["height"], seed=args["seed"]))
+        mismatches += check_mismatches
+        borderline += check_borderline
+
+    for description in borderline:
+        log.info(f"Borderline: {description}")
+    for description in mismatches:
+        log.error(description)
+    log.info(f"{len(mismatches)} disagreements, {len(borderline)} within {BORDERLINE_MARGIN} of the threshold.")
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,230 @@
+import av
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+from datetime import datetime, timezone
+from benchmarks.synthetic_recordings import synthesize_recording, write_fragments, DEFAULT_WIDTH, DEFAULT_HEIGHT, DEFAULT_NUM_CLIPS, DEFAULT_CLIP_FRAMES, DEFAULT_FRAMES_PER_FRAGMENT, DEFAULT_GOP_SIZE
+from data.frame_classifier import FrameClassifier, DEFAULT_WINDOW_SIZE
+from data.clip_manifest import probe_clip
+from data.separators import LABEL_SEPARATOR, label_frame
+from data.split_utils import is_blank_frame, luma_view, try_read_qr_code, open_output_writer, prepare_output_frame
+from data.split_recordings_into_clips import split_fragments, split_fragments_by_boundaries
+from data.split_recordings_into_clips_parallel import split_fragments_parallel
+from data.split_pipeline import split_fragments_pipelined
+from utils.logger import setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+# Number of decoded frames kept in memory for the per-frame benchmarks
+NUM_SAMPLE_FRAMES = 120
+
+
+def _best_time(fn, repeats: int) -> float:
+    """
+    :return: shortest wall time of `repeats` calls, in seconds
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+
+def _result(num_frames: int, seconds: float, **extra) -> dict:
+    return {"frames": num_frames, "seconds": seconds, "fps": num_frames / seconds if seconds > 0 else None, **extra}
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _decode_sample(fragments_filepaths: list[str]) -> tuple[list[av.VideoFrame], list[av.VideoFrame]]:
+    """
+    :return: tuple (up to NUM_SAMPLE_FRAMES decoded frames, all separator frames among them)
+    """
+    frames = []
+    for fragment_filepath in fragments_filepaths:
+        with av.open(fragment_filepath) as container:
+            for frame in container.decode(video=0):
+                frames.append(frame)
+                if len(frames) >= NUM_SAMPLE_FRAMES:
+                    break
+        if len(frames) >= NUM_SAMPLE_FRAMES:
+            break
+
+    separator_frames = [frame for frame in frames if label_frame(frame)[0] == LABEL_SEPARATOR]
+    return frames, separator_frames
+
+
+def benchmark_frame_functions(fragments_filepaths: list[str], output_dir: str, repeats: int) -> dict:
+    """
+    Time the per-frame building blocks of the splitters on decoded frames.
+    """
+    frames, separator_frames = _decode_sample(fragments_filepaths)
+    luma_planes = [luma_view(frame) for frame in frames]
+    rgb_images = [frame.to_ndarray(format="rgb24") for frame in frames]
+    results = {}
+
+    def decode() -> int:
+        num_decoded = 0
+        for fragment_filepath in fragments_filepaths:
+            with av.open(fragment_filepath) as container:
+                for _ in container.decode(video=0):
+                    num_decoded += 1
+        return num_decoded
+
+    results["decode"] = _result(decode(), _best_time(decode, repeats))
+
+    results["is_blank_frame_luma"] = _result(len(frames), _best_time(lambda: [is_blank_frame(plane) for plane in luma_planes], repeats))
+    results["is_blank_frame_rgb"] = _result(len(frames), _best_time(lambda: [is_blank_frame(img) for img in rgb_images], repeats))
+
+    # QR decoding is the most expensive analysis step. Content frames are the common case, separator frames the successful case.
+    results["try_read_qr_code_content"] = _result(len(frames), _best_time(lambda: [try_read_qr_code(plane) for plane in luma_planes], repeats))
+    if separator_frames:
+        separator_planes = [luma_view(frame) for frame in separator_frames]
+        results["try_read_qr_code_separator"] = _result(len(separator_planes), _best_time(lambda: [try_read_qr_code(plane) for plane in separator_planes], repeats))
+
+    # Labelling per frame compared with the windowed classifier, which only decodes QR codes when the scene changes
+    results["label_frame"] = _result(len(frames), _best_time(lambda: [label_frame(frame) for frame in frames], repeats))
+
+    def classify():
+        classifier = FrameClassifier()
+        for window_start in range(0, len(frames), DEFAULT_WINDOW_SIZE):
+            classifier.label(frames[window_start:window_start + DEFAULT_WINDOW_SIZE])
+
+    results["frame_classifier"] = _result(len(frames), _best_time(classify, repeats))
+
+    def encode():
+        with av.open(fragments_filepaths[0]) as container:
+            template_stream = container.streams.video[0]
+            output_container, output_stream = open_output_writer(os.path.join(output_dir, "encode_benchmark.mp4"), template_stream)
+            # Same timestamps as in the splitters: input time base, relative to the first frame
+            for frame in frames:
+                for packet in output_stream.encode(prepare_output_frame(frame, frame.pts - frames[0].pts)):
+                    packet.time_base = template_stream.time_base
+                    output_container.mux(packet)
+            for packet in output_stream.encode():
+                packet.time_base = template_stream.time_base
+                output_container.mux(packet)
+            output_container.close()
+
+    results["encode"] = _result(len(frames), _best_time(encode, repeats))
+    return results
+
+
+def check_clips(clips_df, clips_dir: str, expected_clips: list[dict]) -> list[str]:
+    """
+    Compare the clips written by a splitter with the clips of the synthetic recording.
+    :param clips_df: data frame returned by the splitter, with item_id, modifiers and filename
+    :param clips_dir: directory with the clips
+    :param expected_clips: see `benchmarks.synthetic_recordings.synthesize_recording`
+    :return: one message per difference. Empty if the clips are correct.
+    """
+    written = [(row["item_id"], row["modifiers"], probe_clip(os.path.join(clips_dir, row["filename"]))["num_frames"]) for _, row in clips_df.iterrows()]
+    expected = [(clip["item_id"], clip["modifiers"], clip["num_frames"]) for clip in expected_clips]
+
+    errors = [f"expected clip {clip}, got {found}" for clip, found in zip(expected, written) if clip != found]
+    if len(written) != len(expected):
+        errors.append(f"expected {len(expected)} clips, got {len(written)}")
+    return errors
+
+
+def benchmark_splitters(fragments_filepaths: list[str], num_frames: int, expected_clips: list[dict], output_dir: str, repeats: int, num_workers: int) -> dict:
+    """
+    Time the splitters end to end. Every run starts with an empty output directory and without cached indices.
+    """
+    splitters = {
+        "split_fragments": lambda clips_dir: split_fragments(fragments_filepaths, clips_dir),
+        "split_fragments_classified": lambda clips_dir: split_fragments(fragments_filepaths, clips_dir, classify_window=DEFAULT_WINDOW_SIZE),
+        "split_fragments_by_boundaries_stride": lambda clips_dir: split_fragments_by_boundaries(fragments_filepaths, clips_dir, search_mode="stride"),
+        "split_fragments_by_boundaries_smart": lambda clips_dir: split_fragments_by_boundaries(fragments_filepaths, clips_dir, search_mode="stride", extraction_mode="smart"),
+        "split_fragments_parallel": lambda clips_dir: split_fragments_parallel(fragments_filepaths, clips_dir, num_workers=num_workers),
+        "split_fragments_pipelined": lambda clips_dir: split_fragments_pipelined(fragments_filepaths, clips_dir),
+    }
+
+    results = {}
+    for name, splitter in splitters.items():
+        clips_dir = os.path.join(output_dir, name)
+        clips_dfs = []
+
+        def run():
+            shutil.rmtree(clips_dir, ignore_errors=True)
+            os.makedirs(clips_dir)
+            clips_dfs.append(splitter(clips_dir))
+
+        seconds = _best_time(run, repeats)
+        # Item ids, modifiers and frame counts of the clips, checked after the timed runs
+        clip_errors = check_clips(clips_dfs[-1], clips_dir, expected_clips)
+        for error in clip_errors:
+            log.error(f"{name}: {error}")
+
+        results[name] = _result(num_frames, seconds, clips=len(clips_dfs[-1]), clips_ok=len(clip_errors) == 0, clip_errors=clip_errors)
+        log.info(f"{name}: {results[name]['fps']:.1f} fps")
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the splitters on a synthetic recording")
+    parser.add_argument("--output_json", type=str, help="Where to write the results", default="bench_results.json")
+    parser.add_argument("--work_dir", type=str, help="Directory for the synthetic recording and the clips. By default, a temporary directory is used.", default=None)
+    parser.add_argument("--width", type=int, help="Frame width", default=DEFAULT_WIDTH)
+    parser.add_argument("--height", type=int, help="Frame height", default=DEFAULT_HEIGHT)
+    parser.add_argument("--num_clips", type=int, help="Number of clips", default=DEFAULT_NUM_CLIPS)
+    parser.add_argument("--clip_frames", type=int, help="Number of content frames per clip", default=DEFAULT_CLIP_FRAMES)
+    parser.add_argument("--frames_per_fragment", type=int, help="Number of frames per fragment", default=DEFAULT_FRAMES_PER_FRAGMENT)
+    parser.add_argument("--gop_size", type=int, help="Keyframe interval", default=DEFAULT_GOP_SIZE)
+    parser.add_argument("--repeats", type=int, help="Number of runs per benchmark. The fastest run is reported.", default=3)
+    parser.add_argument("--num_workers", type=int, help="Number of processes for the parallel splitter", default=os.cpu_count())
+    parser.add_argument("--skip_splitters", action="store_true", help="Only run the per-frame benchmarks")
+    args = vars(parser.parse_args())
+
+    config = {k: v for k, v in args.items() if k not in ("output_json", "work_dir")}
+    work_dir = args["work_dir"] or tempfile.mkdtemp(prefix="split_benchmark_")
+
+    try:
+        frames, num_frames, expected_clips = synthesize_recording(num_clips=args["num_clips"], clip_frames=args["clip_frames"], width=args["width"], height=args["height"])
+        fragments_filepaths = write_fragments(frames, os.path.join(work_dir, "recording"), frames_per_fragment=args["frames_per_fragment"], gop_size=args["gop_size"])
+        log.info(f"Generated {num_frames} frames in {len(fragments_filepaths)} fragments.")
+
+        output_dir = os.path.join(work_dir, "output")
+        os.makedirs(output_dir, exist_ok=True)
+
+        results = benchmark_frame_functions(fragments_filepaths, output_dir, repeats=args["repeats"])
+        if not args["skip_splitters"]:
+            results.update(benchmark_splitters(fragments_filepaths, num_frames, expected_clips, output_dir, repeats=args["repeats"], num_workers=args["num_workers"]))
+
+    finally:
+        if args["work_dir"] is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "git_commit": _git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "av": av.__version__,
+        "numpy": np.__version__,
+        "config": config,
+        "results": results,
+    }
+    with open(args["output_json"], "w") as f:
+        json.dump(report, f, indent=2)
+
+    for name, result in results.items():
+        log.info(f"{name:40s} {result['fps']:10.1f} fps")
+    log.info(f"Stored results to \"{args['output_json']}\"")
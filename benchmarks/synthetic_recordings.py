@@ -0,0 +1,180 @@
+import av
+import os
+import argparse
+import numpy as np
+import qrcode
+from data.split_utils import BLANK_GREEN_COLOR, BLANK_BLUE_COLOR, BLANK_BLACK_COLOR
+from utils.logger import setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+DEFAULT_WIDTH = 1280
+DEFAULT_HEIGHT = 720
+DEFAULT_FPS = 30
+
+# Layout of one clip in the recording: separator, a few blank frames, content, and a coloured blank screen between some clips
+DEFAULT_NUM_CLIPS = 6
+DEFAULT_SEPARATOR_FRAMES = 12
+DEFAULT_BLANK_FRAMES = 3
+DEFAULT_CLIP_FRAMES = 90
+DEFAULT_COLOR_FRAMES = 4
+
+DEFAULT_FRAMES_PER_FRAGMENT = 150
+DEFAULT_GOP_SIZE = 30
+
+MODIFIERS = ("raw", "facefusion-identity-swap-v1")
+
+
+def solid_frame(color: tuple[int, int, int], width: int, height: int) -> np.ndarray:
+    return np.full((height, width, 3), color, dtype=np.uint8)
+
+
+def qr_frame(metadata: dict, width: int, height: int) -> np.ndarray:
+    """
+    Render a separator frame: the metadata dict as a QR code, centered on a white background.
+    :param metadata: dict with item_id and modifiers
+    :return: RGB image
+    """
+    qr = qrcode.QRCode(border=4)
+    qr.add_data(str(metadata))
+    qr.make(fit=True)
+
+    # Draw the module matrix directly, so that no imaging library is needed. The code fills the frame height like on the real separator screens,
+    # otherwise the white background would make it a blank frame.
+    modules = np.array(qr.get_matrix(), dtype=bool)
+    scale = max(1, min(width, height) // len(modules))
+    code = np.kron(np.where(modules, 0, 255).astype(np.uint8), np.ones((scale, scale), dtype=np.uint8))
+
+    img = solid_frame((255, 255, 255), width, height)
+    y = (height - code.shape[0]) // 2
+    x = (width - code.shape[1]) // 2
+    img[y:y + code.shape[0], x:x + code.shape[1]] = code[..., None]
+    return img
+
+
+def content_frame(frame_idx: int, width: int, height: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Render a content frame: moving gradients with some noise, so that the encoder has realistic work to do.
+    """
+    yy, xx = np.mgrid[0:height, 0:width]
+    img = np.stack([(xx + 3 * frame_idx) % 256, (yy + 2 * frame_idx) % 256, ((xx + yy) // 2 + frame_idx) % 256], axis=-1).astype(np.uint8)
+    noise = rng.integers(0, 8, size=img.shape, dtype=np.uint8)
+    return img + noise
+
+
+def synthesize_recording(
+    num_clips: int = DEFAULT_NUM_CLIPS,
+    separator_frames: int = DEFAULT_SEPARATOR_FRAMES,
+    blank_frames: int = DEFAULT_BLANK_FRAMES,
+    clip_frames: int = DEFAULT_CLIP_FRAMES,
+    color_frames: int = DEFAULT_COLOR_FRAMES,
+    width: int = DEFAULT_WIDTH,
+    height: int = DEFAULT_HEIGHT,
+    seed: int = 0,
+):
+    """
+    Generate the frames of a recording with the same structure as a real session.
+    :return: tuple (iterator over RGB frames, number of frames, list of expected clips as dicts with item_id, modifiers and num_frames)
+    """
+    clips = [
+        {"item_id": f"{i:05d}--synthetic", "modifiers": MODIFIERS[i % len(MODIFIERS)], "num_frames": clip_frames}
+        for i in range(num_clips)
+    ]
+    num_frames = blank_frames + num_clips * (separator_frames + blank_frames + clip_frames) + (num_clips // 2) * color_frames + blank_frames
+
+    def frames():
+        rng = np.random.default_rng(seed)
+        black = solid_frame(BLANK_BLACK_COLOR, width, height)
+
+        yield from [black] * blank_frames
+        for i, clip in enumerate(clips):
+            separator = qr_frame({"item_id": clip["item_id"], "modifiers": clip["modifiers"]}, width, height)
+            yield from [separator] * separator_frames
+            yield from [black] * blank_frames
+            for frame_idx in range(clip_frames):
+                yield content_frame(i * clip_frames + frame_idx, width, height, rng)
+
+            # Green and blue screens appear between some clips
+            if i % 2 == 1:
+                yield from [solid_frame(BLANK_GREEN_COLOR if i % 4 == 1 else BLANK_BLUE_COLOR, width, height)] * color_frames
+        yield from [black] * blank_frames
+
+    return frames(), num_frames, clips
+
+
+def write_fragments(
+    frames,
+    output_dir: str,
+    frames_per_fragment: int = DEFAULT_FRAMES_PER_FRAGMENT,
+    gop_size: int = DEFAULT_GOP_SIZE,
+    fps: int = DEFAULT_FPS,
+) -> list[str]:
+    """
+    Encode frames into .mkv fragments, like the recorder does.
+    :param frames: iterator over RGB frames
+    :param output_dir: where to write the fragments
+    :param frames_per_fragment: number of frames per fragment
+    :param gop_size: keyframe interval
+    :param fps: frame rate
+    :return: fragment paths in recording order
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    fragments_filepaths = []
+    container = None
+    stream = None
+
+    for frame_idx, img in enumerate(frames):
+        if frame_idx % frames_per_fragment == 0:
+            if container is not None:
+                for packet in stream.encode():
+                    container.mux(packet)
+                container.close()
+
+            fragment_filepath = os.path.join(output_dir, f"fragment_{len(fragments_filepaths):05d}.mkv")
+            fragments_filepaths.append(fragment_filepath)
+            container = av.open(fragment_filepath, mode="w")
+            stream = container.add_stream("libx264", rate=fps)
+            stream.width = img.shape[1]
+            stream.height = img.shape[0]
+            stream.pix_fmt = "yuv420p"
+            stream.options = {"g": str(gop_size), "bf": "0", "crf": "18", "preset": "ultrafast"}
+
+        frame = av.VideoFrame.from_ndarray(img, format="rgb24")
+        frame.pts = frame_idx
+        for packet in stream.encode(frame):
+            container.mux(packet)
+
+    if container is not None:
+        for packet in stream.encode():
+            container.mux(packet)
+        container.close()
+
+    return fragments_filepaths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic recording with QR separators")
+    parser.add_argument("--output_dir", type=str, help="Directory where to write the fragments", required=True)
+    parser.add_argument("--width", type=int, help="Frame width", default=DEFAULT_WIDTH)
+    parser.add_argument("--height", type=int, help="Frame height", default=DEFAULT_HEIGHT)
+    parser.add_argument("--num_clips", type=int, help="Number of clips", default=DEFAULT_NUM_CLIPS)
+    parser.add_argument("--clip_frames", type=int, help="Number of content frames per clip", default=DEFAULT_CLIP_FRAMES)
+    parser.add_argument("--separator_frames", type=int, help="Number of QR frames per separator", default=DEFAULT_SEPARATOR_FRAMES)
+    parser.add_argument("--frames_per_fragment", type=int, help="Number of frames per fragment", default=DEFAULT_FRAMES_PER_FRAGMENT)
+    parser.add_argument("--gop_size", type=int, help="Keyframe interval", default=DEFAULT_GOP_SIZE)
+    parser.add_argument("--seed", type=int, help="Random seed for the content noise", default=0)
+    args = vars(parser.parse_args())
+
+    frames, num_frames, clips = synthesize_recording(
+        num_clips=args["num_clips"],
+        separator_frames=args["separator_frames"],
+        clip_frames=args["clip_frames"],
+        width=args["width"],
+        height=args["height"],
+        seed=args["seed"],
+    )
+    fragments_filepaths = write_fragments(frames, args["output_dir"], frames_per_fragment=args["frames_per_fragment"], gop_size=args["gop_size"])
+    log.info(f"Wrote {num_frames} frames in {len(fragments_filepaths)} fragments to \"{args['output_dir']}\"")
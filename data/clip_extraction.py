@@ -0,0 +1,397 @@
+import av
+import os
+from collections.abc import Iterator
+from data.clip_manifest import commit_clip, discard_clip, temporary_filepath
+from data.split_utils import encode_and_mux, is_blank_video_frame, open_output_writer, prepare_output_frame
+from utils.instrumentation import get_instrumentation
+from utils.logger import setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+# reencode: decode and re-encode every frame losslessly, see `open_output_writer`
+# smart: copy the compressed packets of all GOPs inside the clip and only re-encode the partial GOPs at the clip boundaries
+EXTRACTION_MODES = ("reencode", "smart")
+
+# Encoder settings for the partial GOPs at the clip boundaries in smart mode. Lossless x264 needs a 4:4:4 profile, which
+# cannot be spliced with the copied GOPs, so these few frames are encoded with a low CRF instead.
+SMART_CUT_ENCODER_OPTIONS = {
+    "crf": "10",
+    "preset": "medium",
+    "refs": "1",
+    "bf": "0",
+}
+
+# Map from the decoder's profile names to libx264 profiles
+X264_PROFILES = {
+    "Constrained Baseline": "baseline",
+    "Baseline": "baseline",
+    "Main": "main",
+    "High": "high",
+}
+
+
+def clip_filename(item_id: str, modifiers: str) -> str:
+    return f"{item_id}_{modifiers}.mp4"
+
+
+def iter_clip_frames(fragments_filepaths: list[str], clip: dict) -> Iterator[tuple[av.video.stream.VideoStream, av.VideoFrame]]:
+    """
+    Decode the frames of a clip, including blank frames.
+    :param fragments_filepaths: fragments of the recording, in order
+    :param clip: clip boundaries, see `data.separators.find_clips`
+    :return: iterator over (input stream, decoded frame)
+    """
+    for fragment_idx in range(clip["start_fragment_idx"], clip["end_fragment_idx"] + 1):
+        is_first_fragment = fragment_idx == clip["start_fragment_idx"]
+        is_last_fragment = fragment_idx == clip["end_fragment_idx"]
+
+        with av.open(fragments_filepaths[fragment_idx]) as input_container:
+            input_stream = input_container.streams.video[0]
+
+            if is_first_fragment:
+                # Skip the part of the fragment before the clip
+                input_container.seek(clip["after_pts"], stream=input_stream, backward=True, any_frame=False)
+
+            for input_frame in get_instrumentation().timed_iter("decode", input_container.decode(input_stream)):
+                if is_first_fragment and input_frame.pts <= clip["after_pts"]:
+                    continue
+                if is_last_fragment and clip["before_pts"] is not None and input_frame.pts >= clip["before_pts"]:
+                    break
+
+                yield input_stream, input_frame
+
+
+def extract_clip(fragments_filepaths: list[str], clip: dict, output_filepath: str) -> int:
+    """
+    Re-encode the non-blank frames of a clip into a new video file.
+    :param fragments_filepaths: fragments of the recording, in order
+    :param clip: clip boundaries, see `data.separators.find_clips`
+    :param output_filepath: where to write the clip
+    :return: number of frames written. If the clip has no non-blank frames, no file is written.
+    """
+    instrumentation = get_instrumentation()
+    output_container = None
+    output_stream = None
+    time_base = None
+    start_pts = None
+    num_frames = 0
+
+    try:
+        for input_stream, input_frame in iter_clip_frames(fragments_filepaths, clip):
+            # Skip over black frames
+            with instrumentation.time("blank_test"):
+                is_blank = is_blank_video_frame(input_frame)
+            if is_blank:
+                instrumentation.count("frames_blank")
+                continue
+
+            # First frame of the clip
+            if output_container is None:
+                output_container, output_stream = open_output_writer(output_filepath, input_stream)
+                time_base = input_stream.time_base
+                start_pts = input_frame.pts
+
+            # Calculate new PTS relative to the first frame of the clip and pass the decoded frame on to the encoder
+            output_frame = prepare_output_frame(input_frame, input_frame.pts - start_pts)
+            encode_and_mux(output_container, output_stream, output_frame, time_base)
+
+            num_frames += 1
+
+        if output_container is not None:
+            # Flush encoder
+            encode_and_mux(output_container, output_stream, None, time_base)
+
+    finally:
+        if output_container is not None:
+            output_container.close()
+
+    return num_frames
+
+
+def _parse_avcc(extradata: bytes) -> tuple[int, list[bytes]]:
+    """
+    Parse an H.264 decoder configuration record (avcC), as stored in MKV and MP4 extradata.
+    :param extradata: avcC bytes
+    :return: tuple (NAL unit length size in bytes, list of SPS and PPS NAL units)
+    """
+    length_size = (extradata[4] & 0x03) + 1
+    parameter_sets = []
+
+    pos = 5
+    num_sps = extradata[pos] & 0x1F
+    pos += 1
+    for _ in range(num_sps):
+        size = int.from_bytes(extradata[pos:pos + 2], "big")
+        parameter_sets.append(extradata[pos + 2:pos + 2 + size])
+        pos += 2 + size
+
+    num_pps = extradata[pos]
+    pos += 1
+    for _ in range(num_pps):
+        size = int.from_bytes(extradata[pos:pos + 2], "big")
+        parameter_sets.append(extradata[pos + 2:pos + 2 + size])
+        pos += 2 + size
+
+    return length_size, parameter_sets
+
+
+def _length_prefixed(nal_units: list[bytes], length_size: int) -> bytes:
+    return b"".join(len(nal_unit).to_bytes(length_size, "big") + nal_unit for nal_unit in nal_units)
+
+
+def _annexb_nal_units(data: bytes) -> list[bytes]:
+    """
+    Split an Annex B byte stream (start code delimited) into NAL units.
+    """
+    starts = []
+    pos = data.find(b"\x00\x00\x01")
+    while pos != -1:
+        starts.append(pos + 3)
+        pos = data.find(b"\x00\x00\x01", pos + 3)
+
+    ends = [start - 3 for start in starts[1:]] + [len(data)]
+    # Zero bytes before a start code belong to the start code
+    return [data[start:end].rstrip(b"\x00") for start, end in zip(starts, ends)]
+
+
+def _supports_smart_cut(input_stream: av.video.stream.VideoStream) -> bool:
+    codec_context = input_stream.codec_context
+    extradata = codec_context.extradata
+    return (
+        codec_context.name == "h264" and
+        extradata is not None and len(extradata) > 6 and extradata[0] == 1 and    # avcC, i.e., length-prefixed NAL units
+        not codec_context.has_b_frames                                            # PTS == DTS, so copied and re-encoded packets can be interleaved
+    )
+
+
+def _open_boundary_encoder(input_stream: av.video.stream.VideoStream) -> av.video.codeccontext.VideoCodecContext:
+    """
+    Create an encoder for the partial GOPs at the clip boundaries, matching the recording's resolution, pixel format and profile.
+    Without a global header, libx264 writes SPS and PPS in-band in front of each keyframe.
+    """
+    encoder = av.CodecContext.create("libx264", "w")
+    encoder.width = input_stream.codec_context.width
+    encoder.height = input_stream.codec_context.height
+    encoder.pix_fmt = input_stream.codec_context.pix_fmt
+    encoder.time_base = input_stream.time_base
+    if input_stream.average_rate is not None:
+        encoder.framerate = input_stream.average_rate
+
+    options = dict(SMART_CUT_ENCODER_OPTIONS)
+    profile = X264_PROFILES.get(input_stream.codec_context.profile)
+    if profile is not None:
+        options["profile"] = profile
+    encoder.options = options
+
+    return encoder
+
+
+def _iter_clip_gops(fragments_filepaths: list[str], clip: dict) -> Iterator[tuple[av.video.stream.VideoStream, list[av.Packet], int | None, int | None]]:
+    """
+    Demux the GOPs that overlap with a clip, without decoding them.
+    :param fragments_filepaths: fragments of the recording, in order
+    :param clip: clip boundaries, see `data.separators.find_clips`
+    :return: iterator over (input stream, packets of one GOP in decode order, exclusive lower and upper PTS bound of the clip within this fragment). The bounds are None if the clip extends beyond the fragment.
+    """
+    for fragment_idx in range(clip["start_fragment_idx"], clip["end_fragment_idx"] + 1):
+        after_pts = clip["after_pts"] if fragment_idx == clip["start_fragment_idx"] else None
+        before_pts = clip["before_pts"] if fragment_idx == clip["end_fragment_idx"] else None
+
+        with av.open(fragments_filepaths[fragment_idx]) as input_container:
+            input_stream = input_container.streams.video[0]
+
+            if after_pts is not None:
+                input_container.seek(after_pts, stream=input_stream, backward=True, any_frame=False)
+
+            # Group packets into GOPs
+            gops = []
+            for packet in input_container.demux(input_stream):
+                # Skip the empty packet at the end of the stream
+                if packet.pts is None or packet.size == 0:
+                    continue
+
+                if packet.is_keyframe or len(gops) == 0:
+                    gops.append([])
+                gops[-1].append(packet)
+
+            for gop in gops:
+                first_pts = min(packet.pts for packet in gop)
+                last_pts = max(packet.pts for packet in gop)
+
+                if after_pts is not None and last_pts <= after_pts:
+                    continue
+                if before_pts is not None and first_pts >= before_pts:
+                    break
+
+                yield input_stream, gop, after_pts, before_pts
+
+
+def extract_clip_smart(fragments_filepaths: list[str], clip: dict, output_filepath: str) -> int:
+    """
+    Extract a clip by copying the compressed packets of all GOPs inside the clip. Only the partial GOPs at the start and end of the clip are decoded and re-encoded.
+
+    The clip ends at its last content frame (see `data.separators.find_clips`), so trailing blank and marker frames before the next separator are not copied. Blank frames are dropped from the re-encoded GOPs, so the clip starts and ends with the same frames as with `extract_clip`. Blank frames inside copied GOPs, i.e., between content frames, are kept.
+    Falls back to `extract_clip` if the recording is not H.264 with length-prefixed NAL units and without B-frames.
+
+    :param fragments_filepaths: fragments of the recording, in order
+    :param clip: clip boundaries, see `data.separators.find_clips`
+    :param output_filepath: where to write the clip
+    :return: number of frames written. If the clip has no frames, no file is written.
+    """
+    with av.open(fragments_filepaths[clip["start_fragment_idx"]]) as input_container:
+        if not _supports_smart_cut(input_container.streams.video[0]):
+            log.warning(f"Recording does not support smart cuts. Re-encoding clip (item id: {clip['item_id']}, modifiers: {clip['modifiers']}).")
+            return extract_clip(fragments_filepaths, clip, output_filepath)
+
+    output_container = None
+    output_stream = None
+    time_base = None
+    start_pts = None
+    length_size = None
+    parameter_sets = None
+    encoder = None
+    num_frames = 0
+    instrumentation = get_instrumentation()
+
+    def mux(packet: av.Packet):
+        packet.stream = output_stream
+        packet.time_base = time_base
+        with instrumentation.time("mux"):
+            output_container.mux(packet)
+
+    def flush_encoder():
+        with instrumentation.time("encode"):
+            packets = encoder.encode(None)
+        for packet in packets:
+            mux_encoded(packet)
+
+    def mux_encoded(packet: av.Packet):
+        # libx264 writes Annex B, but the output stream expects length-prefixed NAL units
+        data = _length_prefixed(_annexb_nal_units(bytes(packet)), length_size)
+        output_packet = av.Packet(data)
+        output_packet.pts = packet.pts
+        output_packet.dts = packet.dts
+        output_packet.is_keyframe = packet.is_keyframe
+        mux(output_packet)
+
+    try:
+        for input_stream, gop, after_pts, before_pts in _iter_clip_gops(fragments_filepaths, clip):
+            if output_container is None:
+                output_container = av.open(output_filepath, mode="w")
+                output_stream = output_container.add_stream_from_template(input_stream)
+                time_base = input_stream.time_base
+                length_size, nal_units = _parse_avcc(input_stream.codec_context.extradata)
+                parameter_sets = _length_prefixed(nal_units, length_size)
+
+            first_pts = min(packet.pts for packet in gop)
+            last_pts = max(packet.pts for packet in gop)
+            is_inside = (
+                gop[0].is_keyframe and
+                (after_pts is None or first_pts > after_pts) and
+                (before_pts is None or last_pts < before_pts)
+            )
+
+            if is_inside:
+                if start_pts is None:
+                    start_pts = first_pts
+
+                for packet_idx, packet in enumerate(gop):
+                    if packet_idx == 0 and encoder is not None:
+                        # Switch back from the re-encoded frames. Repeat the recording's parameter sets in-band before the keyframe.
+                        flush_encoder()
+                        encoder = None
+
+                        output_packet = av.Packet(parameter_sets + bytes(packet))
+                        output_packet.pts = packet.pts - start_pts
+                        output_packet.dts = packet.dts - start_pts
+                        output_packet.is_keyframe = True
+                        mux(output_packet)
+                    else:
+                        packet.pts -= start_pts
+                        packet.dts -= start_pts
+                        mux(packet)
+
+                num_frames += len(gop)
+                instrumentation.count("frames_copied", len(gop))
+                continue
+
+            # Partial GOP: decode all frames, re-encode the ones inside the clip. Passing None at the end drains the decoder.
+            for packet in gop + [None]:
+                for input_frame in instrumentation.timed_iter("decode", input_stream.codec_context.decode(packet)):
+                    if after_pts is not None and input_frame.pts <= after_pts:
+                        continue
+                    if before_pts is not None and input_frame.pts >= before_pts:
+                        continue
+                    with instrumentation.time("blank_test"):
+                        is_blank = is_blank_video_frame(input_frame)
+                    if is_blank:
+                        instrumentation.count("frames_blank")
+                        continue
+
+                    if start_pts is None:
+                        start_pts = input_frame.pts
+                    if encoder is None:
+                        encoder = _open_boundary_encoder(input_stream)
+
+                    output_frame = prepare_output_frame(input_frame, input_frame.pts - start_pts, pix_fmt=encoder.pix_fmt)
+                    with instrumentation.time("encode"):
+                        encoded_packets = encoder.encode(output_frame)
+                    for encoded_packet in encoded_packets:
+                        mux_encoded(encoded_packet)
+
+                    num_frames += 1
+
+            # Reset the decoder for the next GOP
+            input_stream.codec_context.flush_buffers()
+
+        if encoder is not None:
+            flush_encoder()
+
+    finally:
+        if output_container is not None:
+            output_container.close()
+
+    if num_frames == 0 and os.path.exists(output_filepath):
+        os.remove(output_filepath)
+
+    return num_frames
+
+
+def write_clip(fragments_filepaths: list[str], clip: dict, clip_idx: int, output_dir: str, extraction_mode: str = "reencode") -> dict | None:
+    """
+    Extract a clip into a temporary file and move it into place once it is complete.
+    :param fragments_filepaths: fragments of the recording, in order
+    :param clip: clip boundaries, see `data.separators.find_clips`
+    :param clip_idx: number of the clip in the recording, see `data.separators.find_clips`
+    :param output_dir: where to write the clip
+    :param extraction_mode: one of EXTRACTION_MODES
+    :return: manifest entry, see `data.clip_manifest.append_manifest`. None if the clip has no frames.
+    """
+    output_filename = clip_filename(clip["item_id"], clip["modifiers"])
+    output_filepath = os.path.join(output_dir, output_filename)
+    tmp_filepath = temporary_filepath(output_filepath)
+    get_instrumentation().count("clips_started")
+
+    try:
+        if extraction_mode == "smart":
+            num_frames = extract_clip_smart(fragments_filepaths, clip, tmp_filepath)
+        else:
+            num_frames = extract_clip(fragments_filepaths, clip, tmp_filepath)
+    except BaseException:
+        get_instrumentation().count("clips_burnt")
+        discard_clip(tmp_filepath)
+        raise
+
+    if num_frames == 0:
+        discard_clip(tmp_filepath)
+        return None
+
+    return {
+        "clip_idx": clip_idx,
+        "item_id": clip["item_id"],
+        "modifiers": clip["modifiers"],
+        "filename": output_filename,
+        **commit_clip(tmp_filepath, output_filepath),
+    }
@@ -0,0 +1,148 @@
+import av
+import os
+import json
+from utils.instrumentation import get_instrumentation
+from utils.logger import log_event, setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+# One JSON line per completed clip, appended as soon as the clip is in place
+MANIFEST_FILENAME = "clips_manifest.jsonl"
+
+
+def temporary_filepath(output_filepath: str) -> str:
+    """
+    Where to write a clip before it is complete. The hidden file keeps the extension, so that the container format is still derived from the filename.
+    :param output_filepath: final path of the clip
+    :return: temporary path in the same directory
+    """
+    output_dir, output_filename = os.path.split(output_filepath)
+    return os.path.join(output_dir, "." + output_filename)
+
+
+def _fsync_dir(directory: str) -> None:
+    # Persist the rename. Not supported on all platforms.
+    try:
+        fd = os.open(directory or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def discard_clip(tmp_filepath: str) -> None:
+    """
+    Remove a partially written clip.
+    """
+    if os.path.exists(tmp_filepath):
+        os.remove(tmp_filepath)
+
+
+def probe_clip(filepath: str) -> dict:
+    """
+    Read the frame count and duration of a clip from the container header.
+    :param filepath: path to clip
+    :return: dict with num_frames, duration (in seconds) and num_bytes
+    """
+    with av.open(filepath) as container:
+        stream = container.streams.video[0]
+        if stream.duration is not None:
+            duration = float(stream.duration * stream.time_base)
+        else:
+            duration = container.duration / av.time_base if container.duration is not None else None
+
+        return {
+            "num_frames": stream.frames,
+            "duration": duration,
+            "num_bytes": os.path.getsize(filepath),
+        }
+
+
+def commit_clip(tmp_filepath: str, output_filepath: str) -> dict:
+    """
+    Move a completely written clip into place. The data is flushed to disk before the rename, so that the final path never refers to an incomplete file.
+    :param tmp_filepath: path returned by `temporary_filepath`
+    :param output_filepath: final path of the clip
+    :return: clip properties, see `probe_clip`
+    """
+    with open(tmp_filepath, "rb") as f:
+        os.fsync(f.fileno())
+
+    os.replace(tmp_filepath, output_filepath)
+    _fsync_dir(os.path.dirname(output_filepath))
+
+    properties = probe_clip(output_filepath)
+
+    instrumentation = get_instrumentation()
+    instrumentation.count("clips_finished")
+    instrumentation.count("frames_written", properties["num_frames"])
+    instrumentation.count("bytes_written", properties["num_bytes"])
+    return properties
+
+
+def load_manifest(output_dir: str) -> dict[str, dict]:
+    """
+    Read the completed clips of a previous run.
+    :param output_dir: directory with the clips
+    :return: dict that maps filenames to the latest manifest entry
+    """
+    manifest_filepath = os.path.join(output_dir, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_filepath):
+        return {}
+
+    entries = {}
+    with open(manifest_filepath, "r") as f:
+        for line in f:
+            # The last line may be truncated if the previous run was killed while appending
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                log.warning(f"Ignoring incomplete line in \"{manifest_filepath}\"")
+                continue
+            entries[entry["filename"]] = entry
+
+    return entries
+
+
+def append_manifest(output_dir: str, entry: dict) -> None:
+    """
+    Record a completed clip.
+    :param output_dir: directory with the clips
+    :param entry: dict with at least clip_idx, filename, num_frames and num_bytes
+    """
+    with open(os.path.join(output_dir, MANIFEST_FILENAME), "a") as f:
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+    log_event(log, "clip_finished", f"Finished clip \"{entry['filename']}\" ({entry['num_frames']} frames, {entry['num_bytes']} bytes).", output_dir=output_dir, **entry)
+
+
+def is_clip_complete(output_dir: str, entry: dict | None, clip_idx: int) -> bool:
+    """
+    Check whether a clip from a previous run can be kept.
+
+    The entry must belong to the same clip of the recording, and the file must have the recorded size and frame count.
+
+    :param output_dir: directory with the clips
+    :param entry: manifest entry for the clip's filename, or None
+    :param clip_idx: position of the clip in the recording. The same filename can occur more than once in a recording.
+    :return: True if the clip does not need to be written again
+    """
+    if entry is None or entry["clip_idx"] != clip_idx:
+        return False
+
+    output_filepath = os.path.join(output_dir, entry["filename"])
+    if not os.path.exists(output_filepath) or os.path.getsize(output_filepath) != entry["num_bytes"]:
+        return False
+
+    try:
+        return probe_clip(output_filepath)["num_frames"] == entry["num_frames"]
+    except av.error.FFmpegError:
+        return False
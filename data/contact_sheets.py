@@ -0,0 +1,291 @@
+import av
+import os
+import html
+import json
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from functools import partial
+from multiprocessing import Pool
+from data.extract_media_attributes import find_clip_ids
+from data.fingerprint_qa import find_pairs
+from data.frame_sampler import FrameSampler, uniform_frame_indices
+from utils.files import file_signature
+from utils.logger import setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+# keyframes: decode only keyframes, spread evenly over the video
+# timestamps: decode the frames shown at evenly spaced times, each from the closest keyframe before it
+# auto: keyframes if the video has enough of them, otherwise timestamps. Short clips often have a single keyframe.
+SHEET_MODES = ("auto", "keyframes", "timestamps")
+
+DEFAULT_NUM_TILES = 12
+DEFAULT_NUM_COLUMNS = 4
+DEFAULT_TILE_WIDTH = 240
+
+SHEET_EXTENSION = ".png"
+SIDECAR_EXTENSION = ".json"
+SHEET_VERSION = 1
+
+INDEX_FILENAME = "index.html"
+
+# Grey background for empty tiles
+BACKGROUND_VALUE = 64
+
+
+def sheet_filepath(video_filepath: str, sheets_dir: str) -> str:
+    """
+    :param video_filepath: path to clip or original video
+    :param sheets_dir: directory for the contact sheets
+    :return: path to the contact sheet. Videos from different directories may have the same basename, so the name includes a hash of the path.
+    """
+    path_hash = hashlib.sha1(os.path.abspath(video_filepath).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(sheets_dir, f"{os.path.basename(video_filepath)}.{path_hash}{SHEET_EXTENSION}")
+
+
+def select_frames(sampler: FrameSampler, num_tiles: int, mode: str = "auto") -> np.ndarray:
+    """
+    :param sampler: sampler of the video
+    :param num_tiles: maximum number of frames
+    :param mode: one of SHEET_MODES
+    :return: sorted indices of the frames to show
+    """
+    keyframe_positions = sampler.keyframe_positions
+    if mode == "keyframes" or (mode == "auto" and len(keyframe_positions) >= num_tiles):
+        return keyframe_positions[uniform_frame_indices(len(keyframe_positions), num_tiles)]
+
+    # Spread over time rather than over frames, so that variable frame rate recordings are covered evenly
+    pts = sampler.index["pts"]
+    duration = float((pts[-1] - pts[0]) * sampler.index["time_base"])
+    return np.unique(sampler.frame_indices_at(np.linspace(0, duration, num=min(num_tiles, sampler.num_frames))))
+
+
+def tile_images(images: list[np.ndarray], num_columns: int) -> np.ndarray:
+    """
+    Arrange images of the same size in a grid, row by row.
+    :param images: uint8 images of shape [height, width, 3]
+    :param num_columns: number of columns
+    :return: uint8 image of shape [rows * height, num_columns * width, 3]
+    """
+    tile_height, tile_width = images[0].shape[:2]
+    num_rows = -(-len(images) // num_columns)
+
+    sheet = np.full((num_rows * tile_height, num_columns * tile_width, 3), BACKGROUND_VALUE, dtype=np.uint8)
+    for i, img in enumerate(images):
+        row, column = divmod(i, num_columns)
+        sheet[row * tile_height:(row + 1) * tile_height, column * tile_width:(column + 1) * tile_width] = img
+    return sheet
+
+
+def write_png(filepath: str, img: np.ndarray) -> None:
+    """
+    Encode an RGB image as PNG with FFmpeg's encoder. The file is replaced in one step.
+    :param filepath: output path
+    :param img: uint8 image of shape [height, width, 3]
+    """
+    codec_context = av.CodecContext.create("png", "w")
+    codec_context.width = img.shape[1]
+    codec_context.height = img.shape[0]
+    codec_context.pix_fmt = "rgb24"
+
+    packets = codec_context.encode(av.VideoFrame.from_ndarray(np.ascontiguousarray(img), format="rgb24"))
+    packets += codec_context.encode(None)
+
+    with open(filepath + ".tmp", "wb") as f:
+        for packet in packets:
+            f.write(bytes(packet))
+    os.replace(filepath + ".tmp", filepath)
+
+
+def _load_sidecar(sidecar_filepath: str) -> dict | None:
+    if not os.path.exists(sidecar_filepath):
+        return None
+    try:
+        with open(sidecar_filepath, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        log.warning(f"Ignoring unreadable sidecar \"{sidecar_filepath}\": {e}")
+        return None
+
+
+def render_contact_sheet(video_filepath: str, output_filepath: str, num_tiles: int = DEFAULT_NUM_TILES, num_columns: int = DEFAULT_NUM_COLUMNS, tile_width: int = DEFAULT_TILE_WIDTH, mode: str = "auto") -> dict:
+    """
+    Decode a few frames of a video and tile them into one image. The decoder skips the loop filter and, for codecs that support it, decodes at a reduced size, see `data.frame_sampler.reduced_decode_options`.
+    Frames are scaled to the tile size while being converted from the decoder's pixel format.
+    :param video_filepath: path to clip or original video
+    :param output_filepath: path to the PNG file
+    :param num_tiles: maximum number of frames
+    :param num_columns: number of columns of the sheet
+    :param tile_width: width of every frame on the sheet. The height follows from the aspect ratio.
+    :param mode: one of SHEET_MODES
+    :return: dict with the number of frames in the video, the duration in seconds and the time of every tile in seconds
+    """
+    # The packet index is not cached, so nothing is written next to the videos
+    with FrameSampler(video_filepath, use_cache=False, decode_width=tile_width) as sampler:
+        width = sampler.stream.codec_context.width
+        height = sampler.stream.codec_context.height
+        tile_height = max(2, int(round(tile_width * height / width / 2)) * 2)
+
+        frame_indices = select_frames(sampler, num_tiles, mode=mode)
+        images = sampler.sample(frame_indices, format="rgb24", width=tile_width, height=tile_height)
+
+        pts = sampler.index["pts"]
+        time_base = float(sampler.index["time_base"])
+        timestamps = ((pts[frame_indices] - pts[0]) * time_base).tolist()
+        duration = float((pts[-1] - pts[0]) * time_base)
+
+    write_png(output_filepath, tile_images(images, num_columns))
+    return {"num_frames": len(pts), "duration": duration, "timestamps": timestamps}
+
+
+def contact_sheet_job(video_filepath: str, sheets_dir: str, num_tiles: int, num_columns: int, tile_width: int, mode: str) -> dict:
+    """
+    Render the contact sheet of one video unless an up-to-date sheet exists. A sidecar JSON file records the video's signature and the settings of the sheet.
+    :return: dict with filepath, sheet_filepath, status ("cached", "rendered" or "failed"), num_frames, duration, timestamps and error
+    """
+    output_filepath = sheet_filepath(video_filepath, sheets_dir)
+    sidecar_filepath = os.path.splitext(output_filepath)[0] + SIDECAR_EXTENSION
+    row = {"filepath": video_filepath, "sheet_filepath": output_filepath, "error": None}
+
+    try:
+        settings = {"version": SHEET_VERSION, "num_tiles": num_tiles, "num_columns": num_columns, "tile_width": tile_width, "mode": mode}
+        signature = file_signature(video_filepath)
+
+        sidecar = _load_sidecar(sidecar_filepath)
+        if sidecar is not None and sidecar["signature"] == signature and sidecar["settings"] == settings and os.path.exists(output_filepath):
+            return {**row, **sidecar["sheet"], "status": "cached"}
+
+        sheet = render_contact_sheet(video_filepath, output_filepath, num_tiles=num_tiles, num_columns=num_columns, tile_width=tile_width, mode=mode)
+        with open(sidecar_filepath + ".tmp", "w") as f:
+            json.dump({"signature": signature, "settings": settings, "sheet": sheet}, f)
+        os.replace(sidecar_filepath + ".tmp", sidecar_filepath)
+        return {**row, **sheet, "status": "rendered"}
+
+    except Exception as e:
+        log.warning(f"Failed to render contact sheet of \"{video_filepath}\": {e}")
+        return {**row, "num_frames": None, "duration": None, "timestamps": [], "status": "failed", "error": str(e)}
+
+
+def render_contact_sheets(video_filepaths: list[str], sheets_dir: str, num_workers: int, **kwargs) -> pd.DataFrame:
+    """
+    Render the contact sheets of many videos in parallel, see `contact_sheet_job`.
+    :param video_filepaths: paths to clips or original videos
+    :param sheets_dir: directory for the contact sheets
+    :param num_workers: number of processes
+    :param kwargs: num_tiles, num_columns, tile_width and mode
+    :return: data frame with one row per video
+    """
+    os.makedirs(sheets_dir, exist_ok=True)
+    job = partial(contact_sheet_job, sheets_dir=sheets_dir, **kwargs)
+
+    buffer = []
+    with Pool(num_workers) as pool:
+        for row in tqdm(pool.imap_unordered(job, sorted(set(video_filepaths)), chunksize=4), total=len(set(video_filepaths)), desc="Contact sheets", unit="video"):
+            buffer.append(row)
+
+    return pd.DataFrame(buffer, columns=["filepath", "sheet_filepath", "status", "num_frames", "duration", "timestamps", "error"])
+
+
+def _format_value(value) -> str:
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ""
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return html.escape(str(value))
+
+
+def _sheet_cell(sheet: dict | None, index_dir: str) -> str:
+    if sheet is None:
+        return "<td></td>"
+    if sheet["status"] == "failed":
+        return f"<td>{html.escape(sheet['error'] or 'failed')}</td>"
+
+    src = html.escape(os.path.relpath(sheet["sheet_filepath"], index_dir))
+    times = html.escape(", ".join(f"{t:.1f}s" for t in sheet["timestamps"]))
+    caption = f"{sheet['num_frames']} frames, {sheet['duration']:.1f}s"
+    return f"<td><a href=\"{src}\"><img src=\"{src}\" title=\"{times}\" loading=\"lazy\"></a><br>{caption}</td>"
+
+
+def write_index(rows_df: pd.DataFrame, sheets_df: pd.DataFrame, index_filepath: str, sheet_columns: list[str]) -> None:
+    """
+    Write an HTML page with one table row per clip, showing its columns next to the contact sheets.
+    :param rows_df: one row per clip. The columns in sheet_columns hold video paths, all other columns are shown as text.
+    :param sheets_df: output of `render_contact_sheets`
+    :param index_filepath: output path. Images are referenced relative to it.
+    :param sheet_columns: columns with the paths of the videos to show
+    """
+    index_dir = os.path.dirname(os.path.abspath(index_filepath))
+    sheets = {row["filepath"]: row for row in sheets_df.to_dict("records")}
+    text_columns = [column for column in rows_df.columns if column not in sheet_columns]
+
+    lines = [
+        "<!DOCTYPE html>",
+        "<html><head><meta charset=\"utf-8\"><title>Contact sheets</title>",
+        "<style>body { font-family: sans-serif; } table { border-collapse: collapse; } td, th { border: 1px solid #ccc; padding: 4px; vertical-align: top; font-size: 12px; } img { max-width: 480px; }</style>",
+        "</head><body>",
+        "<table>",
+        "<tr>" + "".join(f"<th>{html.escape(column)}</th>" for column in text_columns + sheet_columns) + "</tr>",
+    ]
+    for row in rows_df.to_dict("records"):
+        cells = [f"<td>{_format_value(row[column])}</td>" for column in text_columns]
+        cells += [_sheet_cell(sheets.get(row[column]), index_dir) for column in sheet_columns]
+        lines.append("<tr>" + "".join(cells) + "</tr>")
+    lines += ["</table>", "</body></html>"]
+
+    with open(index_filepath + ".tmp", "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(index_filepath + ".tmp", index_filepath)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render one contact sheet per clip and an HTML index to review the clips without opening every video")
+    parser.add_argument("--clips_dir", type=str, help="Directory with the recorded clips and their video_clips.csv files", required=True)
+    parser.add_argument("--output_dir", type=str, help="Directory for the contact sheets and the index. Sheets of unchanged videos are reused.", required=True)
+    parser.add_argument("--selection_csv", type=str, help="CSV file with the selected videos. Used with --originals_dir to show the original videos next to the clips.", default="assets/2025_07_16-selected_videos.csv")
+    parser.add_argument("--originals_dir", type=str, help="Directory with the downloaded original videos, see download_videos.py", default=None)
+    parser.add_argument("--qa_csv", type=str, help="Statistics written by fingerprint_qa.py or split_jobs.py export_qa, shown next to the sheets", default=None)
+    parser.add_argument("--mode", type=str, help="Which frames to show", choices=SHEET_MODES, default="auto")
+    parser.add_argument("--num_tiles", type=int, help="Maximum number of frames per sheet", default=DEFAULT_NUM_TILES)
+    parser.add_argument("--num_columns", type=int, help="Number of columns per sheet", default=DEFAULT_NUM_COLUMNS)
+    parser.add_argument("--tile_width", type=int, help="Width of every frame on the sheet", default=DEFAULT_TILE_WIDTH)
+    parser.add_argument("--num_workers", type=int, help="Number of worker processes", default=8)
+    args = vars(parser.parse_args())
+
+    if args["originals_dir"] is not None:
+        rows_df = find_pairs(args["selection_csv"], args["originals_dir"], args["clips_dir"])
+        sheet_columns = ["original_filepath", "recorded_filepath"]
+    else:
+        rows_df = find_clip_ids(args["clips_dir"]).rename(columns={"filepath": "recorded_filepath"})[["item_id", "modifiers", "recorded_filepath"]]
+        sheet_columns = ["recorded_filepath"]
+
+    if args["qa_csv"] is not None:
+        qa_df = pd.read_csv(args["qa_csv"])
+        qa_df = qa_df.drop(columns=[column for column in ["original_filepath", "recorded_filepath"] if column in qa_df.columns])
+        rows_df = rows_df.merge(qa_df, on=["item_id", "modifiers"], how="left")
+
+    # Text columns first, sheets last
+    rows_df = rows_df.sort_values(["item_id", "modifiers"]).reset_index(drop=True)
+    rows_df = rows_df[[column for column in rows_df.columns if column not in sheet_columns] + sheet_columns]
+
+    video_filepaths = [filepath for column in sheet_columns for filepath in rows_df[column]]
+    sheets_df = render_contact_sheets(
+        video_filepaths,
+        sheets_dir=os.path.join(args["output_dir"], "sheets"),
+        num_workers=args["num_workers"],
+        num_tiles=args["num_tiles"],
+        num_columns=args["num_columns"],
+        tile_width=args["tile_width"],
+        mode=args["mode"],
+    )
+
+    status_counts = sheets_df["status"].value_counts()
+    log.info(f"Rendered {status_counts.get('rendered', 0)} contact sheets, reused {status_counts.get('cached', 0)}, {status_counts.get('failed', 0)} failed.")
+
+    index_filepath = os.path.join(args["output_dir"], INDEX_FILENAME)
+    write_index(rows_df, sheets_df, index_filepath, sheet_columns)
+    log.info(f"Stored index to \"{index_filepath}\"")
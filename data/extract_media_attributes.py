@@ -0,0 +1,232 @@
+import av
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from functools import partial
+from multiprocessing import Pool
+from utils.files import file_signature, scan_files_recursively
+from utils.logger import setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".mkv")
+
+CACHE_FILENAME = "media_attributes_cache.json"
+CACHE_VERSION = 1
+
+# Names as printed by ffprobe for the enum values stored in the codec parameters
+COLOR_RANGES = {1: "tv", 2: "pc"}
+COLOR_PRIMARIES = {1: "bt709", 4: "bt470m", 5: "bt470bg", 6: "smpte170m", 7: "smpte240m", 8: "film", 9: "bt2020", 10: "smpte428", 11: "smpte431", 12: "smpte432", 22: "jedec-p22"}
+COLOR_TRANSFERS = {1: "bt709", 4: "gamma22", 5: "gamma28", 6: "smpte170m", 7: "smpte240m", 8: "linear", 9: "log100", 10: "log316", 11: "iec61966-2-4", 12: "bt1361e", 13: "iec61966-2-1", 14: "bt2020-10", 15: "bt2020-12", 16: "smpte2084", 17: "smpte428", 18: "arib-std-b67"}
+COLOR_SPACES = {0: "gbr", 1: "bt709", 4: "fcc", 5: "bt470bg", 6: "smpte170m", 7: "smpte240m", 8: "ycgco", 9: "bt2020nc", 10: "bt2020c", 11: "smpte2085", 12: "chroma-derived-nc", 13: "chroma-derived-c", 14: "ictcp"}
+FIELD_ORDERS = {1: "progressive", 2: "tt", 3: "bb", 4: "tb", 5: "bt"}
+
+
+def vfr_statistics(pts: np.ndarray) -> dict:
+    """
+    Same statistics as ffmpeg's vfrdet filter, computed from the presentation timestamps.
+
+    Every timestamp delta that differs from the previous delta counts as a VFR frame, every other delta after the first as a CFR frame. The column names follow `assets/2025_07_16-selected_videos.csv`, where vfrdet_total_frames holds the CFR count.
+
+    :param pts: presentation timestamps of all frames, in stream time base
+    :return: dict with the vfrdet_* columns
+    """
+    deltas = np.diff(np.sort(pts))
+    if len(deltas) == 0:
+        return {
+            "vfrdet_vfr_ratio": None,
+            "vfrdet_vfr_frames": 0,
+            "vfrdet_total_frames": 0,
+            "vfrdet_min_delta": None,
+            "vfrdet_max_delta": None,
+            "vfrdet_is_vfr": False,
+        }
+
+    # vfrdet compares every delta with the previous one, so the first delta is neither counted nor tracked
+    changes = deltas[1:] != deltas[:-1]
+    num_vfr = int(changes.sum())
+    num_cfr = len(changes) - num_vfr
+
+    # vfrdet only updates min and max when the delta changes
+    tracked_deltas = deltas[1:][changes]
+
+    return {
+        "vfrdet_vfr_ratio": num_vfr / len(changes) if num_vfr > 0 else None,
+        "vfrdet_vfr_frames": num_vfr,
+        "vfrdet_total_frames": num_cfr,
+        "vfrdet_min_delta": int(tracked_deltas.min()) if num_vfr > 0 else None,
+        "vfrdet_max_delta": int(tracked_deltas.max()) if num_vfr > 0 else None,
+        "vfrdet_is_vfr": num_vfr > 0,
+    }
+
+
+def extract_media_attributes(filepath: str, read_packets: bool = True) -> dict:
+    """
+    Read the container and stream attributes of a video file. No frame is decoded.
+    :param filepath: path to video file
+    :param read_packets: if True, read the packet timestamps to count frames where the header has no frame count and to compute the VFR statistics.
+        Packets are demuxed but not decoded. If False, only the headers are read.
+    :return: dict with one entry per attribute. Names follow the columns of `assets/2025_07_16-selected_videos.csv`.
+    """
+    with av.open(filepath) as container:
+        stream = container.streams.video[0]
+        codec_context = stream.codec_context
+        audio_streams = container.streams.audio
+
+        attributes = {
+            "filepath": filepath,
+            "type": os.path.splitext(filepath)[1][1:].lower(),
+            "duration": container.duration / av.time_base if container.duration is not None else None,
+            "r_fps": str(stream.base_rate) if stream.base_rate is not None else None,
+            "avg_fps": str(stream.average_rate) if stream.average_rate is not None else None,
+            "width": codec_context.width,
+            "height": codec_context.height,
+            "has_audio": len(audio_streams) > 0,
+            "audio_codec_ffprobe": audio_streams[0].codec_context.name if len(audio_streams) > 0 else None,
+            "video_codec_ffprobe": codec_context.name,
+            "frame_count": stream.frames if stream.frames > 0 else None,
+            "bit_rate": codec_context.bit_rate or container.bit_rate,
+            "profile": codec_context.profile,
+            "pix_fmt": codec_context.pix_fmt,
+            "chroma_subsampling": codec_context.pix_fmt,
+            "color_range": COLOR_RANGES.get(codec_context.color_range, "unknown"),
+            "color_space": COLOR_SPACES.get(codec_context.colorspace, "unknown"),
+            "color_transfer": COLOR_TRANSFERS.get(codec_context.color_trc, "unknown"),
+            "color_primaries": COLOR_PRIMARIES.get(codec_context.color_primaries, "unknown"),
+            "field_order": FIELD_ORDERS.get(codec_context.field_order, "unknown"),
+            "time_base": str(stream.time_base),
+        }
+        attributes["is_likely_vfr"] = attributes["r_fps"] != attributes["avg_fps"]
+
+        if read_packets:
+            # Demux only. The timestamps come from the packet headers, the payload is never decoded.
+            pts = np.fromiter((packet.pts for packet in container.demux(stream) if packet.pts is not None), dtype=np.int64)
+            if attributes["frame_count"] is None:
+                attributes["frame_count"] = len(pts)
+            attributes.update(vfr_statistics(pts))
+
+    return attributes
+
+
+def extract_media_attributes_job(filepath: str, read_packets: bool) -> dict:
+    """
+    Extract the attributes of one file. Unreadable files are reported in the error column instead of aborting the run.
+    """
+    try:
+        attributes = extract_media_attributes(filepath, read_packets=read_packets)
+        attributes["error"] = None
+    except Exception as e:
+        log.warning(f"Failed to read \"{filepath}\": {e}")
+        attributes = {"filepath": filepath, "error": f"{type(e).__name__}: {e}"}
+
+    return {"filepath": filepath, "signature": file_signature(filepath), "attributes": attributes}
+
+
+def load_cache(cache_filepath: str, read_packets: bool) -> dict[str, dict]:
+    """
+    :return: dict that maps file paths to their signature and attributes. Empty if there is no cache or it was built with other settings.
+    """
+    if cache_filepath is None or not os.path.exists(cache_filepath):
+        return {}
+
+    with open(cache_filepath, "r") as f:
+        cache = json.load(f)
+
+    if cache["version"] != CACHE_VERSION or cache["read_packets"] != read_packets:
+        return {}
+
+    return cache["files"]
+
+
+def save_cache(cache_filepath: str, read_packets: bool, files: dict[str, dict]) -> None:
+    with open(cache_filepath + ".tmp", "w") as f:
+        json.dump({"version": CACHE_VERSION, "read_packets": read_packets, "files": files}, f)
+    os.replace(cache_filepath + ".tmp", cache_filepath)
+
+
+def extract_all_media_attributes(filepaths: list[str], num_workers: int, read_packets: bool = True, cache_filepath: str = None) -> pd.DataFrame:
+    """
+    Extract the attributes of many files in a process pool. Files whose size and mtime match the cache are not opened.
+    :param filepaths: video files
+    :param num_workers: number of processes
+    :param read_packets: see `extract_media_attributes`
+    :param cache_filepath: where to cache the attributes. If None, nothing is cached.
+    :return: data frame with one row per file
+    """
+    cached_files = load_cache(cache_filepath, read_packets)
+
+    buffer = []
+    jobs = []
+    for filepath in filepaths:
+        cached = cached_files.get(filepath)
+        if cached is not None and cached["signature"] == file_signature(filepath):
+            buffer.append(cached["attributes"])
+        else:
+            jobs.append(filepath)
+
+    log.info(f"Reading {len(jobs)} files, {len(buffer)} files are cached.")
+
+    job = partial(extract_media_attributes_job, read_packets=read_packets)
+    with Pool(num_workers) as pool:
+        # Headers are small, so many files per task keep the overhead low
+        for result in tqdm(pool.imap_unordered(job, jobs, chunksize=16), total=len(jobs), desc="Media attributes", unit="file"):
+            buffer.append(result["attributes"])
+            cached_files[result["filepath"]] = {"signature": result["signature"], "attributes": result["attributes"]}
+
+    if cache_filepath is not None and jobs:
+        save_cache(cache_filepath, read_packets, cached_files)
+
+    output_df = pd.DataFrame(buffer)
+    return output_df.sort_values("filepath").reset_index(drop=True)
+
+
+def find_clip_ids(directory: str) -> pd.DataFrame:
+    """
+    Collect the item ids and modifiers of all clips from the video_clips.csv files written by the splitters.
+    :param directory: directory to search recursively
+    :return: data frame with columns filepath, item_id and modifiers
+    """
+    buffer = []
+    for csv_filepath in scan_files_recursively(directory, file_extensions=[".csv"]):
+        if os.path.basename(csv_filepath) != "video_clips.csv":
+            continue
+
+        clips_df = pd.read_csv(csv_filepath, usecols=["item_id", "modifiers", "filename"])
+        clips_df["filepath"] = [os.path.join(os.path.dirname(csv_filepath), filename) for filename in clips_df["filename"]]
+        buffer.append(clips_df[["filepath", "item_id", "modifiers"]])
+
+    if not buffer:
+        return pd.DataFrame(columns=["filepath", "item_id", "modifiers"])
+
+    return pd.concat(buffer, ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract container and stream attributes of video files without decoding")
+    parser.add_argument("--input_dir", type=str, help="Directory where to search for video files", required=True)
+    parser.add_argument("--output_csv", type=str, help="Where to write the attributes", required=True)
+    parser.add_argument("--num_workers", type=int, help="Number of worker processes", default=8)
+    parser.add_argument("--headers_only", action="store_true", help="Only read the headers. Skips the VFR statistics and the frame count of files without one in the header.")
+    parser.add_argument("--cache_dir", type=str, help="Directory for the attribute cache. By default, the input directory is used.", default=None)
+    parser.add_argument("--no_cache", action="store_true", help="Do not reuse or store the attributes")
+    args = vars(parser.parse_args())
+
+    filepaths = scan_files_recursively(args["input_dir"], file_extensions=VIDEO_EXTENSIONS)
+
+    cache_filepath = None
+    if not args["no_cache"]:
+        cache_filepath = os.path.join(args["cache_dir"] or args["input_dir"], CACHE_FILENAME)
+
+    attributes_df = extract_all_media_attributes(filepaths, num_workers=args["num_workers"], read_packets=not args["headers_only"], cache_filepath=cache_filepath)
+
+    # Add item ids and modifiers of clips written by the splitters
+    clip_ids_df = find_clip_ids(args["input_dir"])
+    attributes_df = clip_ids_df.merge(attributes_df, on="filepath", how="right")
+
+    attributes_df.to_csv(args["output_csv"], index=False)
+    log.info(f"Stored attributes of {len(attributes_df)} files to \"{args['output_csv']}\"")
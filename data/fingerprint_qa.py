@@ -0,0 +1,266 @@
+import av
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from multiprocessing import Pool
+from data.extract_media_attributes import find_clip_ids
+from data.frame_sampler import reduced_decode_options
+from utils.manifests import read_manifest
+from utils.logger import setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+# Difference hash: compare horizontally adjacent pixels of a 9x8 grayscale thumbnail, which gives 64 bits per frame
+HASH_WIDTH = 9
+HASH_HEIGHT = 8
+
+# Frames whose hashes differ in at most this many bits are considered to show the same image
+MATCH_THRESHOLD = 10
+
+# Alignment cost per second of difference between the relative timestamps of two frames, in bits. Breaks ties between identical frames, e.g., in static scenes.
+TIME_WEIGHT = 1.0
+
+# A recorded frame is only aligned to original frames whose relative timestamps differ by at most this much, which bounds the memory of the alignment.
+# Larger offsets, e.g., when more than this is missing at the head of the recording, are not found.
+ALIGNMENT_BAND_SECONDS = 10.0
+
+# Runs of at least this many recorded frames showing the same original frame count as a freeze
+MIN_FREEZE_FRAMES = 3
+
+# Number of set bits in every byte value
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def compute_fingerprints(filepath: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Compute a 64-bit difference hash of every frame.
+
+    The decoder skips the loop filter and, for codecs that support FFmpeg's lowres option, decodes at 1/8 of the size, see `data.frame_sampler.reduced_decode_options`. H.264 has no lowres, so H.264 frames are still decoded at full size.
+    Each frame is then scaled down to the hash size straight from its native pixel format.
+
+    :param filepath: path to video file
+    :return: tuple (timestamps in seconds, hashes as uint64), one entry per frame
+    """
+    timestamps = []
+    hashes = []
+    weights = (1 << np.arange(HASH_WIDTH - 1, dtype=np.uint64).reshape(1, -1)) << (np.arange(HASH_HEIGHT, dtype=np.uint64).reshape(-1, 1) * np.uint64(HASH_WIDTH - 1))
+
+    with av.open(filepath) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        stream.codec_context.options = reduced_decode_options(stream.codec_context.width, HASH_WIDTH)
+
+        for frame in container.decode(stream):
+            thumbnail = frame.reformat(width=HASH_WIDTH, height=HASH_HEIGHT, format="gray", interpolation="AREA").to_ndarray()
+            bits = thumbnail[:, 1:] > thumbnail[:, :-1]
+            hashes.append(np.bitwise_or.reduce(weights[bits]) if bits.any() else np.uint64(0))
+            timestamps.append(float(frame.pts * stream.time_base) if frame.pts is not None else np.nan)
+
+    return np.array(timestamps, dtype=np.float64), np.array(hashes, dtype=np.uint64)
+
+
+def hamming_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    :param a: hashes
+    :param b: hashes of a shape that broadcasts with a
+    :return: number of differing bits, in the broadcast shape
+    """
+    xor = np.bitwise_xor(a, b)
+    return _POPCOUNT[xor.view(np.uint8)].reshape(*xor.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+
+def _band_starts(original_times: np.ndarray, recorded_times: np.ndarray, band_width: int) -> np.ndarray:
+    """
+    :param original_times: relative timestamps of the original frames, in seconds
+    :param recorded_times: relative timestamps of the recorded frames, in seconds
+    :param band_width: number of original frames per band
+    :return: first original frame of the band of every recorded frame, never decreasing
+    """
+    num_original = len(original_times)
+    num_recorded = len(recorded_times)
+    if np.isfinite(original_times).all() and np.isfinite(recorded_times).all():
+        centers = np.searchsorted(original_times, recorded_times)
+    else:
+        # Without timestamps, the band follows the diagonal of the frame indices
+        centers = np.round(np.arange(num_recorded) * (num_original - 1) / max(num_recorded - 1, 1)).astype(np.int64)
+
+    starts = np.clip(centers - band_width // 2, 0, num_original - band_width)
+    return np.maximum.accumulate(starts)
+
+
+def align_fingerprints(original_timestamps: np.ndarray, original_hashes: np.ndarray, recorded_timestamps: np.ndarray, recorded_hashes: np.ndarray, band_seconds: float = ALIGNMENT_BAND_SECONDS) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Assign every recorded frame to an original frame, such that the assigned original frames never go backwards.
+
+    Dynamic programming over the cost matrix: the cost of assigning recorded frame i to original frame j is the Hamming distance of their hashes plus a small penalty on the difference of their relative timestamps.
+    The best predecessor is any original frame k <= j, so each row only needs a running minimum over the previous row. Repeated original frames are duplicates, skipped original frames are drops.
+    Only a band of original frames around the same relative time is considered for every recorded frame, so memory grows with the length of the recording, not with its square.
+
+    :param original_timestamps: timestamps of the original frames, in seconds
+    :param original_hashes: hashes of the original frames
+    :param recorded_timestamps: timestamps of the recorded frames, in seconds
+    :param recorded_hashes: hashes of the recorded frames
+    :param band_seconds: largest difference of relative timestamps between a recorded frame and its original frame
+    :return: tuple (index of the assigned original frame, Hamming distance to it), one entry per recorded frame
+    """
+    original_times = original_timestamps - original_timestamps[0]
+    recorded_times = recorded_timestamps - recorded_timestamps[0]
+    num_original = len(original_hashes)
+    num_recorded = len(recorded_hashes)
+
+    frame_intervals = np.diff(original_times)
+    frame_interval = float(np.nanmedian(frame_intervals)) if np.isfinite(frame_intervals).any() else 0.0
+    half_width = int(np.ceil(band_seconds / frame_interval)) if frame_interval > 0 else num_original
+    band_width = min(2 * half_width + 1, num_original)
+    starts = _band_starts(original_times, recorded_times, band_width)
+
+    band = np.arange(band_width)
+    backpointers = np.zeros((num_recorded, band_width), dtype=np.int32)
+
+    def band_costs(i: int) -> np.ndarray:
+        originals = slice(starts[i], starts[i] + band_width)
+        time_offsets = np.nan_to_num(np.abs(recorded_times[i] - original_times[originals]), nan=0.0)
+        return hamming_distances(recorded_hashes[i], original_hashes[originals]) + TIME_WEIGHT * time_offsets
+
+    accumulated = band_costs(0)
+    for i in range(1, num_recorded):
+        running_min = np.minimum.accumulate(accumulated)
+        # Last position up to j that attains the running minimum
+        best_predecessors = np.maximum.accumulate(np.where(accumulated == running_min, starts[i - 1] + band, starts[i - 1]))
+
+        # Original frames after the end of the previous band can follow any frame of it
+        predecessor_idx = np.minimum(starts[i] - starts[i - 1] + band, band_width - 1)
+        backpointers[i] = best_predecessors[predecessor_idx]
+        accumulated = band_costs(i) + running_min[predecessor_idx]
+
+    assignment = np.zeros(num_recorded, dtype=np.int64)
+    assignment[-1] = starts[-1] + int(np.argmin(accumulated))
+    for i in range(num_recorded - 1, 0, -1):
+        assignment[i - 1] = backpointers[i, assignment[i] - starts[i]]
+
+    return assignment, hamming_distances(recorded_hashes, original_hashes[assignment])
+
+
+def alignment_statistics(assignment: np.ndarray, distances: np.ndarray, num_original_frames: int) -> dict:
+    """
+    Summarize an alignment.
+    :param assignment: index of the assigned original frame for every recorded frame, see `align_fingerprints`
+    :param distances: Hamming distance of every recorded frame to its assigned original frame
+    :param num_original_frames: number of frames in the original video
+    :return: dict with the statistics
+    """
+    matched = distances <= MATCH_THRESHOLD
+    matched_assignment = assignment[matched]
+
+    # The assignment never goes backwards, so unmatched frames still keep their place in the sequence
+    steps = np.diff(assignment)
+    num_duplicated = int((steps == 0).sum())
+    num_dropped = int(np.clip(steps - 1, 0, None).sum())
+
+    # Runs of recorded frames that show the same original frame
+    run_lengths = np.diff(np.flatnonzero(np.diff(np.concatenate([[-1], assignment, [-1]])) != 0))
+    freezes = run_lengths[run_lengths >= MIN_FREEZE_FRAMES]
+
+    return {
+        "num_original_frames": num_original_frames,
+        "num_recorded_frames": len(assignment),
+        "num_matched_frames": int(matched.sum()),
+        "num_unmatched_frames": int((~matched).sum()),
+        "num_duplicated_frames": num_duplicated,
+        "num_dropped_frames": num_dropped,
+        "num_missing_head_frames": int(matched_assignment[0]) if len(matched_assignment) > 0 else num_original_frames,
+        "num_missing_tail_frames": int(num_original_frames - 1 - matched_assignment[-1]) if len(matched_assignment) > 0 else num_original_frames,
+        "num_freezes": len(freezes),
+        "max_freeze_frames": int(freezes.max()) if len(freezes) > 0 else 0,
+        "mean_hamming_distance": float(distances[matched].mean()) if matched.any() else None,
+    }
+
+
+def fingerprint_job(filepath: str) -> tuple[str, tuple[np.ndarray, np.ndarray] | None]:
+    try:
+        return filepath, compute_fingerprints(filepath)
+    except Exception as e:
+        log.warning(f"Failed to fingerprint \"{filepath}\": {e}")
+        return filepath, None
+
+
+def pair_statistics(original: tuple[np.ndarray, np.ndarray] | None, recorded: tuple[np.ndarray, np.ndarray] | None) -> dict:
+    """
+    Align a recorded clip to its original video.
+    :param original: fingerprints of the original video, see `compute_fingerprints`. None if fingerprinting failed.
+    :param recorded: fingerprints of the recorded clip
+    :return: dict with the statistics, see `alignment_statistics`, and an error message or None
+    """
+    if original is None or recorded is None or len(original[1]) == 0 or len(recorded[1]) == 0:
+        return {"error": "missing fingerprints"}
+
+    assignment, distances = align_fingerprints(*original, *recorded)
+    return {**alignment_statistics(assignment, distances, len(original[1])), "error": None}
+
+
+def find_pairs(selection_csv: str, originals_dir: str, clips_dir: str) -> pd.DataFrame:
+    """
+    Match the recorded clips to the downloaded original videos.
+    :param selection_csv: CSV file with the selected videos
+    :param originals_dir: directory with the downloaded original videos, see download_videos.py
+    :param clips_dir: directory with the recorded clips and their video_clips.csv files
+    :return: data frame with columns item_id, modifiers, original_filepath and recorded_filepath
+    """
+    selection_df = read_manifest(selection_csv, columns=["item_id", "modifiers", "s3_object_key"])
+    selection_df["original_filepath"] = [os.path.join(originals_dir, key) for key in selection_df["s3_object_key"]]
+
+    clips_df = find_clip_ids(clips_dir).rename(columns={"filepath": "recorded_filepath"})
+    pairs_df = selection_df.merge(clips_df, on=["item_id", "modifiers"], how="inner")
+
+    missing_mask = ~pairs_df["original_filepath"].map(os.path.exists)
+    if missing_mask.any():
+        log.warning(f"Skipping {missing_mask.sum()} clips whose original video has not been downloaded.")
+        pairs_df = pairs_df[~missing_mask]
+
+    return pairs_df[["item_id", "modifiers", "original_filepath", "recorded_filepath"]].reset_index(drop=True)
+
+
+def compare_clips(pairs_df: pd.DataFrame, num_workers: int) -> pd.DataFrame:
+    """
+    Compare original and recorded videos frame by frame.
+    :param pairs_df: data frame with columns item_id, modifiers, original_filepath and recorded_filepath
+    :param num_workers: number of processes for fingerprinting
+    :return: data frame with one row per pair, see `alignment_statistics`
+    """
+    filepaths = sorted(set(pairs_df["original_filepath"]) | set(pairs_df["recorded_filepath"]))
+
+    # Decoding is the expensive part, so every video is fingerprinted exactly once
+    fingerprints = {}
+    with Pool(num_workers) as pool:
+        for filepath, result in tqdm(pool.imap_unordered(fingerprint_job, filepaths), total=len(filepaths), desc="Fingerprinting", unit="video"):
+            fingerprints[filepath] = result
+
+    buffer = []
+    for item_id, modifiers, original_filepath, recorded_filepath in tqdm(zip(pairs_df["item_id"], pairs_df["modifiers"], pairs_df["original_filepath"], pairs_df["recorded_filepath"]), total=len(pairs_df), desc="Aligning", unit="clip"):
+        row = {"item_id": item_id, "modifiers": modifiers, "original_filepath": original_filepath, "recorded_filepath": recorded_filepath}
+
+        row.update(pair_statistics(fingerprints[original_filepath], fingerprints[recorded_filepath]))
+        buffer.append(row)
+
+    return pd.DataFrame(buffer)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find dropped, duplicated and frozen frames in recorded clips")
+    parser.add_argument("--selection_csv", type=str, help="CSV file with the selected videos", default="assets/2025_07_16-selected_videos.csv")
+    parser.add_argument("--originals_dir", type=str, help="Directory with the downloaded original videos, see download_videos.py", required=True)
+    parser.add_argument("--clips_dir", type=str, help="Directory with the recorded clips and their video_clips.csv files", required=True)
+    parser.add_argument("--output_csv", type=str, help="Where to write the statistics", required=True)
+    parser.add_argument("--num_workers", type=int, help="Number of worker processes", default=8)
+    args = vars(parser.parse_args())
+
+    pairs_df = find_pairs(args["selection_csv"], args["originals_dir"], args["clips_dir"])
+
+    log.info(f"Comparing {len(pairs_df)} clips.")
+    stats_df = compare_clips(pairs_df, num_workers=args["num_workers"])
+    stats_df.to_csv(args["output_csv"], index=False)
+    log.info(f"Stored statistics to \"{args['output_csv']}\"")
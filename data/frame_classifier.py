@@ -0,0 +1,251 @@
+import av
+import os
+import numpy as np
+from collections.abc import Iterable, Iterator
+from data.split_utils import BLANK_BLACK_COLOR, BLANK_GREEN_COLOR, BLANK_BLUE_COLOR, BLANK_FRAME_ATOL, BLANK_FRAME_LUMA_MARGIN, BLANK_FRAME_STRIDE, BLANK_FRAME_THRESHOLD, PLANAR_YUV_FORMATS, is_blank_frame, is_color_frame, luma_view, plane_view, try_read_qr_code
+from data.separators import LABEL_BLANK, LABEL_CONTENT, LABEL_SEPARATOR, is_separator_metadata
+from utils.instrumentation import get_instrumentation
+from utils.logger import setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+# Classes assigned by `FrameClassifier.classify`
+FRAME_CONTENT = 0
+FRAME_BLANK = 1
+FRAME_MARKER = 2
+FRAME_QR_CANDIDATE = 3
+
+# Colour markers shown by the recording client. Marker frames are blank frames of a known colour.
+MARKER_COLORS = {
+    "black": BLANK_BLACK_COLOR,
+    "green": BLANK_GREEN_COLOR,
+    "blue": BLANK_BLUE_COLOR,
+}
+
+DEFAULT_WINDOW_SIZE = 16
+
+# A non-blank frame starts a new scene, and its QR code is decoded, if the texture of any block of this many luma samples (64x64 pixels at the default blank test stride) has changed by more than `QR_TEXTURE_CHANGE_ATOL` since the last decoded frame.
+# Texture is the mean absolute difference between horizontally neighbouring samples. A QR code adds about 64 to every block it covers, whatever the background, and any code taller than 128 pixels covers a whole block.
+# Blocks are not averaged over the luma itself, because a QR code on a mid-grey background has the same mean as the background.
+QR_TEXTURE_BLOCK_SIZE = 16
+QR_TEXTURE_CHANGE_ATOL = 24.0
+
+# The QR code is also decoded again when the luma samples differ from the last decoded frame by more than this on average, e.g., after a lot of motion
+QR_SCENE_CHANGE_ATOL = 32.0
+
+# After a failed decode on a new scene, this many following frames are still decoded, because the first frames after a cut are often compressed more coarsely
+QR_RETRY_FRAMES = 3
+
+
+def sample_luma(frames: list[av.VideoFrame], stride: int = BLANK_FRAME_STRIDE) -> np.ndarray:
+    """
+    Stack the strided Y samples of a window of frames, as used by the luma pre-test of `data.split_utils.is_blank_video_frame`.
+    :param frames: decoded frames of the same size. Frames that are not planar YUV are converted to grayscale.
+    :param stride: sampling stride along both axes
+    :return: uint8 array of shape [num_frames, height // stride, width // stride] (rounded up)
+    """
+    planes = [plane_view(frame, 0) if frame.format.name in PLANAR_YUV_FORMATS else luma_view(frame) for frame in frames]
+    return np.stack([plane[::stride, ::stride] for plane in planes])
+
+
+def block_texture(images: np.ndarray, block_size: int = QR_TEXTURE_BLOCK_SIZE) -> np.ndarray:
+    """
+    :param images: int16 array of shape [num_frames, height, width], see `sample_luma`
+    :param block_size: edge length of the blocks
+    :return: float32 array of shape [num_frames, height // block_size, (width - 1) // block_size] with the mean absolute horizontal gradient per block
+    """
+    gradients = np.abs(np.diff(images, axis=2))
+    num_frames, height, width = gradients.shape
+    height -= height % block_size
+    width -= width % block_size
+    blocks = gradients[:, :height, :width].reshape(num_frames, height // block_size, block_size, width // block_size, block_size)
+    return blocks.mean(axis=(2, 4), dtype=np.float32)
+
+
+def luma_pretest(samples: np.ndarray, atol: int = BLANK_FRAME_ATOL + BLANK_FRAME_LUMA_MARGIN, threshold: float = BLANK_FRAME_THRESHOLD) -> np.ndarray:
+    """
+    Vectorized `data.split_utils.is_blank_frame` on the luma samples of a window. Gives the same decision for every frame.
+    :param samples: uint8 array of shape [num_frames, height, width], see `sample_luma`
+    :param atol: tolerance around the median
+    :param threshold: fraction of samples that must be within the tolerance
+    :return: bool array with one entry per frame
+    """
+    num_frames = samples.shape[0]
+    values = samples.reshape(num_frames, -1)
+    num_samples = values.shape[1]
+    if num_samples == 0:
+        return np.zeros(num_frames, dtype=bool)
+
+    # Lower median per frame via one histogram per frame, like `_histogram_median`
+    offsets = (np.arange(num_frames, dtype=np.int64) * 256)[:, None]
+    histograms = np.bincount((values + offsets).ravel(), minlength=256 * num_frames).reshape(num_frames, 256)
+    medians = np.argmax(np.cumsum(histograms, axis=1) >= (num_samples + 1) // 2, axis=1)
+
+    # Count the samples within the tolerance from the histograms, without another pass over the samples
+    levels = np.arange(256)
+    within = np.abs(levels[None, :] - medians[:, None]) <= atol
+    num_matches = (histograms * within).sum(axis=1)
+    return num_matches >= int(np.floor(threshold * num_samples)) + 1
+
+
+class FrameClassifier:
+    """
+    Classify windows of decoded frames as blank, colour marker, QR candidate or content, and label them like `data.separators.label_frame`.
+
+    The blank test of a whole window runs on the stacked Y samples, see `luma_pretest`. Only frames that pass it are converted to RGB for the exact test, and blank frames are then matched against `MARKER_COLORS`.
+    Non-blank frames that start a new scene are QR candidates and are passed to pyzbar. A new scene starts after a blank frame or when the texture of a block has changed by more than `QR_TEXTURE_CHANGE_ATOL` since the last decoded frame.
+    A failed decode on a new scene is retried on the next `QR_RETRY_FRAMES` frames. Frames after a separator are always decoded, so that a different code shown right after it is not missed.
+    All other non-blank frames are content and reuse the last (failed) decode, unless the image has changed by more than `QR_SCENE_CHANGE_ATOL` on average.
+
+    There is no per-frame contrast or finder-pattern test. At the blank test's sampling density, a decodable 400 pixel code with 30 levels of contrast has a block texture of 6.5, while the synthetic moving content of the benchmarks reaches 16, so any contrast threshold either drops separators or passes most content.
+    The classifier remembers the last decoded frame, so scenes can span several windows. Use one classifier per sequence of frames.
+    """
+
+    def __init__(self, atol: int = BLANK_FRAME_ATOL, threshold: float = BLANK_FRAME_THRESHOLD, texture_change_atol: float = QR_TEXTURE_CHANGE_ATOL, scene_change_atol: float = QR_SCENE_CHANGE_ATOL, retry_frames: int = QR_RETRY_FRAMES):
+        """
+        :param atol: tolerance per channel of the blank test
+        :param threshold: fraction of pixels that must match in the blank test
+        :param texture_change_atol: texture difference of any block to the last decoded frame above which a new scene starts, see `block_texture`
+        :param scene_change_atol: mean luma difference to the last decoded frame above which a QR code is decoded again
+        :param retry_frames: number of frames after a failed decode on a new scene that are still decoded
+        """
+        self.atol = atol
+        self.threshold = threshold
+        self.texture_change_atol = texture_change_atol
+        self.scene_change_atol = scene_change_atol
+        self.retry_frames = retry_frames
+
+        # Luma samples, block texture and decoded metadata of the last decoded frame, None after a blank frame
+        self._anchor = None
+        self._num_retries = 0
+
+    def reset(self) -> None:
+        self._anchor = None
+        self._num_retries = 0
+
+    def _classify_blank(self, frames: list[av.VideoFrame], samples: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        is_blank = luma_pretest(samples, atol=self.atol + BLANK_FRAME_LUMA_MARGIN, threshold=self.threshold)
+
+        # Frames without a Y plane have no pre-test, see `is_blank_video_frame`
+        for i, frame in enumerate(frames):
+            if frame.format.name not in PLANAR_YUV_FORMATS:
+                is_blank[i] = True
+
+        # The few nearly flat frames are decided exactly in RGB, and so are their marker colours
+        markers = np.full(len(frames), -1, dtype=np.int8)
+        for i in np.flatnonzero(is_blank):
+            img = frames[i].to_ndarray(format="rgb24")
+            is_blank[i] = is_blank_frame(img, atol=self.atol, threshold=self.threshold)
+            if not is_blank[i]:
+                continue
+            for marker_idx, color in enumerate(MARKER_COLORS.values()):
+                if is_color_frame(img, color, atol=self.atol, threshold=self.threshold):
+                    markers[i] = marker_idx
+                    break
+        return is_blank, markers
+
+    def _is_candidate(self, image: np.ndarray, texture: np.ndarray) -> bool:
+        if self._anchor is None or is_separator_metadata(self._anchor[2]) or np.abs(texture - self._anchor[1]).max() > self.texture_change_atol:
+            self._num_retries = self.retry_frames
+            return True
+        if self._num_retries > 0:
+            self._num_retries -= 1
+            return True
+        return np.abs(image - self._anchor[0]).mean() > self.scene_change_atol
+
+    def _decode(self, frame: av.VideoFrame, image: np.ndarray, texture: np.ndarray, counters: dict[str, int] = None):
+        instrumentation = get_instrumentation()
+
+        if counters is not None:
+            counters["qr_decodes"] += 1
+        with instrumentation.time("qr_decode"):
+            metadata = try_read_qr_code(luma_view(frame))
+
+        self._anchor = (image, texture, metadata)
+        return metadata
+
+    def classify(self, frames: list[av.VideoFrame], counters: dict[str, int] = None) -> tuple[np.ndarray, np.ndarray, list[dict | None]]:
+        """
+        Classify consecutive frames and decode the QR codes of the candidates.
+        :param frames: decoded frames in presentation order, continuing the frames of the previous call
+        :param counters: optional counters to update, see `data.separators.new_counters`
+        :return: tuple (class of every frame, index into `MARKER_COLORS` for marker frames and -1 otherwise, decoded QR metadata of every candidate and None otherwise)
+        """
+        classes = np.full(len(frames), FRAME_CONTENT, dtype=np.int8)
+        if len(frames) == 0:
+            return classes, np.full(0, -1, dtype=np.int8), []
+
+        instrumentation = get_instrumentation()
+        if counters is not None:
+            counters["blank_tests"] += len(frames)
+
+        with instrumentation.time("blank_test"):
+            samples = sample_luma(frames)
+            is_blank, markers = self._classify_blank(frames, samples)
+        classes[is_blank] = FRAME_BLANK
+        classes[markers >= 0] = FRAME_MARKER
+        instrumentation.count("frames_blank", int(np.count_nonzero(is_blank)))
+        instrumentation.count("frames_marker", int(np.count_nonzero(markers >= 0)))
+
+        # Signed, so that the scene change test can subtract images
+        images = samples.astype(np.int16)
+        textures = block_texture(images)
+        metadata = [None] * len(frames)
+        for i in range(len(frames)):
+            if is_blank[i]:
+                self.reset()
+            elif self._is_candidate(images[i], textures[i]):
+                classes[i] = FRAME_QR_CANDIDATE
+                metadata[i] = self._decode(frames[i], images[i], textures[i], counters)
+            else:
+                instrumentation.count("qr_reused")
+
+        return classes, markers, metadata
+
+    def label(self, frames: list[av.VideoFrame], counters: dict[str, int] = None) -> list[tuple[str, tuple | None]]:
+        """
+        Label consecutive frames. Marker frames are blank, and candidates are separators if their QR code was decoded.
+        :param frames: decoded frames in presentation order, continuing the frames of the previous call
+        :param counters: optional counters to update, see `data.separators.new_counters`
+        :return: one tuple (label, key) per frame, see `data.separators.label_frame`
+        """
+        instrumentation = get_instrumentation()
+        classes, _, metadata = self.classify(frames, counters)
+
+        labels = []
+        for frame_class, frame_metadata in zip(classes, metadata):
+            if frame_class in (FRAME_BLANK, FRAME_MARKER):
+                labels.append((LABEL_BLANK, None))
+            elif is_separator_metadata(frame_metadata):
+                instrumentation.count("qr_hits")
+                labels.append((LABEL_SEPARATOR, (frame_metadata["item_id"], frame_metadata["modifiers"])))
+            else:
+                instrumentation.count("qr_misses")
+                labels.append((LABEL_CONTENT, None))
+
+        return labels
+
+
+def label_frames(frames: Iterable[av.VideoFrame], window_size: int = DEFAULT_WINDOW_SIZE, classifier: FrameClassifier = None, counters: dict[str, int] = None) -> Iterator[tuple[av.VideoFrame, tuple[str, tuple | None]]]:
+    """
+    Label a stream of decoded frames in windows. At most `window_size` frames are held in memory.
+    :param frames: decoded frames in presentation order
+    :param window_size: number of frames classified at once
+    :param classifier: classifier to use. If None, a new classifier is created.
+    :param counters: optional counters to update, see `data.separators.new_counters`
+    :return: iterator over (frame, (label, key))
+    """
+    if classifier is None:
+        classifier = FrameClassifier()
+
+    window = []
+    for frame in frames:
+        window.append(frame)
+        if len(window) == window_size:
+            yield from zip(window, classifier.label(window, counters))
+            window = []
+
+    if window:
+        yield from zip(window, classifier.label(window, counters))
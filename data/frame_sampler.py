@@ -0,0 +1,262 @@
+import av
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+from tqdm import tqdm
+from fractions import Fraction
+from functools import partial
+from multiprocessing import Pool
+from utils.files import file_signature, scan_files_recursively
+from utils.logger import setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+CACHE_SUFFIX = ".packets.npz"
+CACHE_VERSION = 1
+
+# Largest reduction of FFmpeg's lowres decoder option, i.e., 1/8 of the width and height
+MAX_LOWRES = 3
+
+
+def cache_filepath(filepath: str, cache_dir: str = None) -> str:
+    """
+    Location of the cached packet index of a clip.
+    :param filepath: path to clip
+    :param cache_dir: directory for the cached indices. If None, the index is stored next to the clip.
+    :return: path to the index file
+    """
+    if cache_dir is None:
+        return filepath + CACHE_SUFFIX
+
+    # Clips from different sessions may have the same basename
+    path_hash = hashlib.sha1(os.path.abspath(filepath).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{os.path.basename(filepath)}.{path_hash}{CACHE_SUFFIX}")
+
+
+def build_packet_index(filepath: str) -> dict:
+    """
+    Read the timestamps and keyframe flags of all video packets. Packets are demuxed but not decoded.
+    :param filepath: path to clip
+    :return: dict with pts (presentation order), is_keyframe (per frame) and time_base (Fraction)
+    """
+    with av.open(filepath) as container:
+        stream = container.streams.video[0]
+        packets = [(packet.pts, packet.is_keyframe) for packet in container.demux(stream) if packet.pts is not None]
+        time_base = stream.time_base
+
+    pts = np.array([packet_pts for packet_pts, _ in packets], dtype=np.int64)
+    is_keyframe = np.array([packet_is_keyframe for _, packet_is_keyframe in packets], dtype=bool)
+
+    # Frame indices refer to presentation order
+    order = np.argsort(pts, kind="stable")
+    return {"pts": pts[order], "is_keyframe": is_keyframe[order], "time_base": time_base}
+
+
+def save_packet_index(filepath: str, index: dict, cache_dir: str = None) -> None:
+    header = {
+        "version": CACHE_VERSION,
+        "signature": file_signature(filepath),
+        "time_base": [index["time_base"].numerator, index["time_base"].denominator],
+    }
+
+    index_filepath = cache_filepath(filepath, cache_dir)
+    os.makedirs(os.path.dirname(os.path.abspath(index_filepath)), exist_ok=True)
+
+    # Write to a temporary file first, so that a crash never leaves a corrupt index behind
+    tmp_filepath = index_filepath + ".tmp.npz"
+    np.savez(tmp_filepath, header=np.array(json.dumps(header)), pts=index["pts"], is_keyframe=index["is_keyframe"])
+    os.replace(tmp_filepath, index_filepath)
+
+
+def load_packet_index(filepath: str, cache_dir: str = None) -> dict | None:
+    """
+    :return: cached packet index, see `build_packet_index`. None if there is no index or the clip has changed.
+    """
+    index_filepath = cache_filepath(filepath, cache_dir)
+    if not os.path.exists(index_filepath):
+        return None
+
+    try:
+        with np.load(index_filepath, allow_pickle=False) as data:
+            header = json.loads(str(data["header"]))
+            pts = data["pts"]
+            is_keyframe = data["is_keyframe"]
+    except Exception as e:
+        log.warning(f"Ignoring unreadable index \"{index_filepath}\": {e}")
+        return None
+
+    if header["version"] != CACHE_VERSION or header["signature"] != file_signature(filepath):
+        return None
+
+    return {"pts": pts, "is_keyframe": is_keyframe, "time_base": Fraction(*header["time_base"])}
+
+
+def get_packet_index(filepath: str, cache_dir: str = None, use_cache: bool = True) -> dict:
+    """
+    Load the packet index of a clip, or build and cache it.
+    """
+    index = load_packet_index(filepath, cache_dir) if use_cache else None
+    if index is None:
+        index = build_packet_index(filepath)
+        if use_cache:
+            save_packet_index(filepath, index, cache_dir)
+    return index
+
+
+def reduced_decode_options(width: int, decode_width: int) -> dict[str, str]:
+    """
+    Decoder options for frames that are only needed at a reduced size. The loop filter is skipped, and codecs that support FFmpeg's lowres option decode at a power-of-two fraction of the size.
+    Only a few codecs support lowres, e.g., MJPEG. H.264 ignores it and decodes at full size.
+    :param width: width of the video
+    :param decode_width: smallest width the frames are needed at
+    :return: options for the codec context
+    """
+    lowres = 0
+    while lowres < MAX_LOWRES and width >> (lowres + 1) >= decode_width:
+        lowres += 1
+    return {"skip_loop_filter": "all", "lowres": str(lowres)}
+
+
+def uniform_frame_indices(num_frames: int, num_samples: int) -> np.ndarray:
+    """
+    :return: up to num_samples distinct frame indices, evenly spread over the clip
+    """
+    return np.unique(np.linspace(0, num_frames - 1, num=min(num_samples, num_frames)).round().astype(np.int64))
+
+
+class FrameSampler:
+    """
+    Random access to the frames of a clip.
+
+    Each requested frame is decoded starting from the closest keyframe before it. Requests are sorted and grouped by GOP, so every GOP is decoded at most once per call, and only up to the last requested frame.
+    This is cheap for the clips written by the splitters, which have no B-frames and a single reference frame.
+    """
+
+    def __init__(self, filepath: str, cache_dir: str = None, use_cache: bool = True, decode_width: int = None):
+        """
+        :param filepath: path to clip
+        :param cache_dir: directory for the cached packet index. If None, the index is stored next to the clip.
+        :param use_cache: if False, the packet index is built without reading or writing the cache
+        :param decode_width: if given, frames are only needed at this width or less, and the decoder may reduce its work, see `reduced_decode_options`
+        """
+        self.filepath = filepath
+        self.index = get_packet_index(filepath, cache_dir=cache_dir, use_cache=use_cache)
+        self.keyframe_positions = np.flatnonzero(self.index["is_keyframe"])
+
+        self.container = av.open(filepath)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = "AUTO"
+        if decode_width is not None:
+            self.stream.codec_context.options = reduced_decode_options(self.stream.codec_context.width, decode_width)
+
+        # Number of frames decoded so far, including the frames between keyframes and requested frames
+        self.num_decoded = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self) -> None:
+        self.container.close()
+
+    @property
+    def num_frames(self) -> int:
+        return len(self.index["pts"])
+
+    def frame_indices_at(self, timestamps) -> np.ndarray:
+        """
+        :param timestamps: times in seconds, relative to the first frame
+        :return: index of the frame shown at each time
+        """
+        pts = self.index["pts"]
+        target_pts = pts[0] + np.round(np.asarray(timestamps, dtype=np.float64) / float(self.index["time_base"])).astype(np.int64)
+        return np.clip(np.searchsorted(pts, target_pts, side="right") - 1, 0, self.num_frames - 1)
+
+    def _decode_gop(self, keyframe_pts: int, requested_pts: set[int], last_pts: int, format: str, width: int, height: int) -> dict[int, np.ndarray]:
+        self.container.seek(int(keyframe_pts), stream=self.stream, backward=True, any_frame=False)
+
+        images = {}
+        for frame in self.container.decode(self.stream):
+            self.num_decoded += 1
+            if frame.pts is None or frame.pts < keyframe_pts:
+                continue
+
+            if frame.pts in requested_pts:
+                images[frame.pts] = frame.reformat(width=width, height=height, format=format).to_ndarray()
+            if frame.pts >= last_pts:
+                break
+
+        return images
+
+    def sample(self, frame_indices, format: str = "rgb24", width: int = None, height: int = None) -> list[np.ndarray]:
+        """
+        Decode the frames with the given indices.
+        :param frame_indices: frame indices in presentation order. Can be unsorted and contain duplicates.
+        :param format: pixel format of the returned images
+        :param width: scale the images to this width. If None, the clip's width is kept.
+        :param height: scale the images to this height. If None, the clip's height is kept.
+        :return: one image per requested index, in the requested order
+        """
+        frame_indices = np.asarray(frame_indices, dtype=np.int64)
+        if np.any((frame_indices < 0) | (frame_indices >= self.num_frames)):
+            raise IndexError(f"Frame index out of range for \"{self.filepath}\" with {self.num_frames} frames")
+
+        pts = self.index["pts"]
+        requested = np.unique(frame_indices)
+
+        # GOP of every requested frame, i.e., the last keyframe at or before it
+        gop_starts = self.keyframe_positions[np.searchsorted(self.keyframe_positions, requested, side="right") - 1]
+
+        images = {}
+        for gop_start in np.unique(gop_starts):
+            gop_requested = requested[gop_starts == gop_start]
+            images.update(self._decode_gop(pts[gop_start], set(pts[gop_requested].tolist()), pts[gop_requested[-1]], format, width, height))
+
+        missing = [int(frame_idx) for frame_idx in requested if pts[frame_idx] not in images]
+        if missing:
+            raise RuntimeError(f"Failed to decode frames {missing} of \"{self.filepath}\"")
+
+        return [images[pts[frame_idx]] for frame_idx in frame_indices]
+
+    def sample_timestamps(self, timestamps, **kwargs) -> list[np.ndarray]:
+        """
+        Decode the frames shown at the given times, see `frame_indices_at` and `sample`.
+        """
+        return self.sample(self.frame_indices_at(timestamps), **kwargs)
+
+
+def index_clip_job(filepath: str, cache_dir: str) -> tuple[str, int | None]:
+    try:
+        return filepath, len(get_packet_index(filepath, cache_dir=cache_dir)["pts"])
+    except Exception as e:
+        log.warning(f"Failed to index \"{filepath}\": {e}")
+        return filepath, None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the packet indices used for random access to the frames of the clips")
+    parser.add_argument("--clips_dir", type=str, help="Directory where to search for clips", required=True)
+    parser.add_argument("--cache_dir", type=str, help="Directory for the packet indices. By default, they are stored next to the clips.", default=None)
+    parser.add_argument("--num_workers", type=int, help="Number of worker processes", default=8)
+    args = vars(parser.parse_args())
+
+    filepaths = scan_files_recursively(args["clips_dir"], file_extensions=[".mp4"])
+
+    job = partial(index_clip_job, cache_dir=args["cache_dir"])
+    num_frames = 0
+    num_failed = 0
+    with Pool(args["num_workers"]) as pool:
+        for filepath, clip_frames in tqdm(pool.imap_unordered(job, filepaths, chunksize=8), total=len(filepaths), desc="Indexing clips", unit="clip"):
+            if clip_frames is None:
+                num_failed += 1
+            else:
+                num_frames += clip_frames
+
+    log.info(f"Indexed {len(filepaths) - num_failed} clips with {num_frames} frames, {num_failed} failed.")
@@ -0,0 +1,292 @@
+import av
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from functools import partial
+from multiprocessing import Pool
+from data.extract_media_attributes import find_clip_ids
+from data.select_videos import read_participants
+from utils.logger import setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+INDEX_FILENAME = "index.parquet"
+CHUNK_EXTENSION = ".bin"
+
+# A new chunk file is started once the current one exceeds this size. Clips never span two chunks.
+DEFAULT_CHUNK_SIZE_MB = 1024
+
+# Frames are stored as height x width x 3 bytes
+PIXEL_FORMAT = "rgb24"
+NUM_CHANNELS = 3
+
+
+def participant_id(item_id: str) -> int:
+    """
+    :param item_id: e.g., "00681--94e0f494-6103-4968-88ac-96d0e8d726b8"
+    :return: participant id, the part before "--"
+    """
+    return int(item_id.split("--")[0])
+
+
+def assign_splits(clips_df: pd.DataFrame, splits: dict[str, set[int]]) -> pd.DataFrame:
+    """
+    :param clips_df: data frame with column item_id
+    :param splits: dict that maps split names to participant ids, see `data.select_videos.read_participants`
+    :return: copy with columns participant_id and split. Clips of participants in no split have split None.
+    """
+    clips_df = clips_df.copy()
+    clips_df["participant_id"] = clips_df["item_id"].map(participant_id)
+    clips_df["split"] = None
+    for split, participants in splits.items():
+        clips_df.loc[clips_df["participant_id"].isin(participants), "split"] = split
+    return clips_df
+
+
+def count_frames(filepath: str) -> int:
+    """
+    :return: number of frames from the header, or from the packets if the header has no count. Nothing is decoded.
+    """
+    with av.open(filepath) as container:
+        stream = container.streams.video[0]
+        if stream.frames > 0:
+            return stream.frames
+        return sum(1 for packet in container.demux(stream) if packet.pts is not None)
+
+
+def write_clip_frames(f, filepath: str, frame_stride: int = 1, width: int = None, height: int = None) -> tuple[int, int, int, np.ndarray]:
+    """
+    Decode a clip and append its frames to an open chunk file.
+    :param f: chunk file opened for binary writing
+    :param filepath: path to clip
+    :param frame_stride: keep every n-th frame
+    :param width: output width. If None, the clip's width is kept.
+    :param height: output height. If None, the clip's height is kept.
+    :return: tuple (number of frames, height, width, PTS of the frames in the clip's time base)
+    """
+    pts = []
+    with av.open(filepath) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        output_width = width or stream.codec_context.width
+        output_height = height or stream.codec_context.height
+
+        for frame_idx, frame in enumerate(container.decode(stream)):
+            if frame_idx % frame_stride != 0:
+                continue
+
+            # Scale and convert in one step
+            img = frame.reformat(width=output_width, height=output_height, format=PIXEL_FORMAT, interpolation="AREA").to_ndarray()
+            f.write(np.ascontiguousarray(img).data)
+            pts.append(frame.pts)
+
+    return len(pts), output_height, output_width, np.array(pts, dtype=np.int64)
+
+
+def export_clips_job(
+    indexed_clips: tuple[int, list[dict]],
+    split_dir: str,
+    frame_stride: int,
+    width: int,
+    height: int,
+    chunk_size_mb: int,
+) -> list[dict]:
+    """
+    Export a group of clips into chunks that only this worker writes to.
+    :param indexed_clips: tuple (worker index, list of clips with keys filepath, item_id, modifiers and participant_id)
+    :return: one index entry per exported clip
+    """
+    worker_idx, clips = indexed_clips
+    chunk_size = chunk_size_mb * 1024 * 1024
+
+    entries = []
+    f = None
+    chunk_idx = 0
+    chunk_filename = None
+
+    try:
+        for clip in clips:
+            # Start a new chunk between clips, so that every clip is contiguous
+            if f is None or f.tell() >= chunk_size:
+                if f is not None:
+                    f.close()
+                    chunk_idx += 1
+                chunk_filename = f"chunk_{worker_idx:03d}_{chunk_idx:05d}{CHUNK_EXTENSION}"
+                f = open(os.path.join(split_dir, chunk_filename), "wb")
+
+            offset = f.tell()
+            try:
+                num_frames, output_height, output_width, pts = write_clip_frames(f, clip["filepath"], frame_stride=frame_stride, width=width, height=height)
+            except Exception as e:
+                # Drop the partially written clip
+                log.warning(f"Failed to export \"{clip['filepath']}\": {e}")
+                f.seek(offset)
+                f.truncate()
+                continue
+
+            entries.append({
+                "item_id": clip["item_id"],
+                "modifiers": clip["modifiers"],
+                "participant_id": clip["participant_id"],
+                "source_filepath": clip["filepath"],
+                "chunk": chunk_filename,
+                "offset": offset,
+                "num_frames": num_frames,
+                "height": output_height,
+                "width": output_width,
+                "frame_stride": frame_stride,
+                "pts": pts,
+            })
+
+    finally:
+        if f is not None:
+            f.close()
+
+    return entries
+
+
+def export_split(
+    clips_df: pd.DataFrame,
+    split_dir: str,
+    num_workers: int,
+    frame_stride: int = 1,
+    width: int = None,
+    height: int = None,
+    chunk_size_mb: int = DEFAULT_CHUNK_SIZE_MB,
+) -> pd.DataFrame:
+    """
+    Decode all clips of a split into a frame store. The index is written last, so an interrupted export leaves no readable store behind.
+    :param clips_df: clips with columns filepath, item_id, modifiers and participant_id
+    :param split_dir: output directory of the split. Existing chunks are replaced.
+    :param num_workers: number of processes. Each worker writes its own chunks.
+    :param frame_stride: keep every n-th frame
+    :param width: output width. If None, the clips are not scaled.
+    :param height: output height. If None, the clips are not scaled.
+    :param chunk_size_mb: approximate size of each chunk file
+    :return: index with one row per clip
+    """
+    os.makedirs(split_dir, exist_ok=True)
+    for filename in os.listdir(split_dir):
+        if filename.endswith(CHUNK_EXTENSION) or filename == INDEX_FILENAME:
+            os.remove(os.path.join(split_dir, filename))
+
+    # Balance the workers by the number of frames, largest clips first
+    clips = clips_df[["filepath", "item_id", "modifiers", "participant_id"]].to_dict("records")
+    for clip in clips:
+        clip["num_frames"] = count_frames(clip["filepath"])
+    clips = sorted(clips, key=lambda clip: clip["num_frames"], reverse=True)
+
+    groups = [[] for _ in range(num_workers)]
+    group_frames = np.zeros(num_workers, dtype=np.int64)
+    for clip in clips:
+        group_idx = int(np.argmin(group_frames))
+        groups[group_idx].append(clip)
+        group_frames[group_idx] += clip["num_frames"]
+
+    job = partial(export_clips_job, split_dir=split_dir, frame_stride=frame_stride, width=width, height=height, chunk_size_mb=chunk_size_mb)
+
+    entries = []
+    with Pool(num_workers) as pool:
+        for group_entries in tqdm(pool.imap_unordered(job, enumerate(groups)), total=len(groups), desc="Exporting frames", unit="worker"):
+            entries.extend(group_entries)
+
+    index_df = pd.DataFrame(entries, columns=["item_id", "modifiers", "participant_id", "source_filepath", "chunk", "offset", "num_frames", "height", "width", "frame_stride", "pts"])
+    index_df = index_df.sort_values(["item_id", "modifiers"]).reset_index(drop=True)
+
+    index_filepath = os.path.join(split_dir, INDEX_FILENAME)
+    index_df.to_parquet(index_filepath + ".tmp", index=False)
+    os.replace(index_filepath + ".tmp", index_filepath)
+    return index_df
+
+
+class FrameStore:
+    """
+    Read-only access to the frames of one split. Chunks are memory-mapped, so the frames of a clip are a view into the page cache and nothing is decoded or copied.
+    """
+
+    def __init__(self, split_dir: str):
+        """
+        :param split_dir: directory written by `export_split`
+        """
+        self.split_dir = split_dir
+        self.index_df = pd.read_parquet(os.path.join(split_dir, INDEX_FILENAME))
+        self._positions = {(item_id, modifiers): i for i, (item_id, modifiers) in enumerate(zip(self.index_df["item_id"], self.index_df["modifiers"]))}
+        self._chunks = {}
+
+    def __len__(self) -> int:
+        return len(self.index_df)
+
+    def keys(self) -> list[tuple[str, str]]:
+        """
+        :return: (item_id, modifiers) of all clips
+        """
+        return list(self._positions)
+
+    def _chunk(self, chunk_filename: str) -> np.memmap:
+        chunk = self._chunks.get(chunk_filename)
+        if chunk is None:
+            chunk = np.memmap(os.path.join(self.split_dir, chunk_filename), dtype=np.uint8, mode="r")
+            self._chunks[chunk_filename] = chunk
+        return chunk
+
+    def get(self, item_id: str, modifiers: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :param item_id: item id of the clip
+        :param modifiers: modifiers of the clip
+        :return: tuple (read-only frames of shape (num_frames, height, width, 3), PTS of the frames in the clip's time base)
+        """
+        row = self.index_df.iloc[self._positions[(item_id, modifiers)]]
+        num_bytes = int(row["num_frames"]) * int(row["height"]) * int(row["width"]) * NUM_CHANNELS
+
+        chunk = self._chunk(row["chunk"])
+        frames = chunk[int(row["offset"]):int(row["offset"]) + num_bytes].reshape(int(row["num_frames"]), int(row["height"]), int(row["width"]), NUM_CHANNELS)
+        return frames, np.asarray(row["pts"], dtype=np.int64)
+
+    def __iter__(self):
+        """
+        Iterate over the clips in chunk order, which reads the chunk files sequentially.
+        :return: iterator over (item_id, modifiers, frames, pts)
+        """
+        for item_id, modifiers in zip(*self.index_df.sort_values(["chunk", "offset"])[["item_id", "modifiers"]].to_numpy().T):
+            yield item_id, modifiers, *self.get(item_id, modifiers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Decode clips once into memory-mapped frame stores, one per split")
+    parser.add_argument("--clips_dir", type=str, help="Directory with the clips and their video_clips.csv files", required=True)
+    parser.add_argument("--store_dir", type=str, help="Output directory. Each split is written to a subdirectory.", required=True)
+    parser.add_argument("--train_split", type=str, help="Participant ids of the training split", default="assets/train_split.txt")
+    parser.add_argument("--val_split", type=str, help="Participant ids of the validation split", default="assets/val_split.txt")
+    parser.add_argument("--width", type=int, help="Scale the frames to this width. Requires --height.", default=None)
+    parser.add_argument("--height", type=int, help="Scale the frames to this height. Requires --width.", default=None)
+    parser.add_argument("--frame_stride", type=int, help="Only store every n-th frame", default=1)
+    parser.add_argument("--chunk_size_mb", type=int, help="Approximate size of each chunk file", default=DEFAULT_CHUNK_SIZE_MB)
+    parser.add_argument("--num_workers", type=int, help="Number of worker processes", default=8)
+    args = vars(parser.parse_args())
+
+    if (args["width"] is None) != (args["height"] is None):
+        parser.error("--width and --height must be given together")
+
+    splits = {"train": read_participants(args["train_split"]), "val": read_participants(args["val_split"])}
+    clips_df = assign_splits(find_clip_ids(args["clips_dir"]), splits)
+
+    missing_mask = clips_df["split"].isna()
+    if missing_mask.any():
+        log.warning(f"Skipping {missing_mask.sum()} clips of participants in neither split.")
+
+    for split, split_df in clips_df[~missing_mask].groupby("split"):
+        split_dir = os.path.join(args["store_dir"], split)
+        index_df = export_split(
+            split_df,
+            split_dir,
+            num_workers=args["num_workers"],
+            frame_stride=args["frame_stride"],
+            width=args["width"],
+            height=args["height"],
+            chunk_size_mb=args["chunk_size_mb"],
+        )
+        log.info(f"Stored {index_df['num_frames'].sum()} frames of {len(index_df)} clips to \"{split_dir}\"")
@@ -0,0 +1,181 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from utils.manifests import read_manifest, write_manifest
+from utils.logger import setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+REAL_MODIFIERS = "raw"
+DEFAULT_MODIFIERS = ("raw", "facefusion-v1", "facefusion-identity-swap-v1")
+DEFAULT_RESOLUTION = "1280x720"
+DEFAULT_VIDEO_CODEC = "h264"
+
+# Settings of the selection in `assets/2025_07_16-selected_videos.csv`
+DEFAULT_NUM_ITEMS = 200
+DEFAULT_SEED = 2000
+
+
+def read_participants(filepath: str) -> set[int]:
+    """
+    :param filepath: text file with one participant id per line, e.g., `assets/val_split.txt`
+    :return: set of participant ids
+    """
+    return set(pd.read_csv(filepath, header=None, names=["participant"])["participant"])
+
+
+def filter_videos(
+    videos_df: pd.DataFrame,
+    participants: set[int],
+    modifiers: tuple[str, ...] = DEFAULT_MODIFIERS,
+    resolution: str = DEFAULT_RESOLUTION,
+    video_codec: str = DEFAULT_VIDEO_CODEC,
+) -> pd.DataFrame:
+    """
+    :param videos_df: metadata of all videos
+    :param participants: participant ids to keep
+    :param modifiers: modifiers to keep
+    :param resolution: resolution to keep, e.g., "1280x720"
+    :param video_codec: codec of the original video to keep
+    :return: rows of the videos that can be selected
+    """
+    return videos_df[
+        videos_df["participant_id"].isin(participants) &
+        videos_df["modifiers"].isin(set(modifiers)) &
+        (videos_df["resolution"] == resolution) &
+        (videos_df["video_codec_original"] == video_codec)
+    ]
+
+
+def sample_positions(seeds: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """
+    Draw one position per group, like `group.sample(1, random_state=seed)`.
+
+    pandas seeds a `np.random.RandomState` with the integer and draws `choice(size, 1, replace=False)`. The draw only depends on the seed and the group size, so it is computed once per distinct pair.
+
+    :param seeds: integer seed of every group
+    :param sizes: number of rows of every group
+    :return: position of the sampled row within every group
+    """
+    pairs, inverse = np.unique(np.stack([seeds, sizes], axis=1), axis=0, return_inverse=True)
+
+    # Seeding is the expensive part, so every seed is only used once. Its state is restored for each group size.
+    positions = np.zeros(len(pairs), dtype=np.int64)
+    random_state = np.random.RandomState()
+    for seed in np.unique(pairs[:, 0]):
+        random_state.seed(seed)
+        initial_state = random_state.get_state()
+        for pair_idx in np.flatnonzero(pairs[:, 0] == seed):
+            random_state.set_state(initial_state)
+            positions[pair_idx] = random_state.choice(pairs[pair_idx, 1], 1, replace=False)[0]
+
+    return positions[inverse.reshape(-1)]
+
+
+def select_pairs(videos_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Select one real and one fake video per item. The fake video is sampled with the participant id as seed.
+
+    Gives the same rows in the same order as grouping by item id (in order of appearance) and sampling one fake row per group with `DataFrame.sample`.
+
+    :param videos_df: candidate videos, see `filter_videos`
+    :return: two rows per item, the real video first
+    """
+    real_mask = (videos_df["modifiers"] == REAL_MODIFIERS).to_numpy()
+
+    # Groups in order of appearance
+    codes, item_ids = pd.factorize(videos_df["item_id"])
+    num_reals = np.bincount(codes[real_mask], minlength=len(item_ids))
+    num_fakes = np.bincount(codes[~real_mask], minlength=len(item_ids))
+    assert np.all(num_reals <= 1), "Expected exactly one real video per item"
+
+    # Only items with a real and a fake version
+    is_valid = (num_reals == 1) & (num_fakes > 0)
+    seeds = np.zeros(len(item_ids), dtype=np.int64)
+    seeds[codes[real_mask]] = videos_df["participant_id"].to_numpy()[real_mask]
+
+    chosen = np.full(len(item_ids), -1, dtype=np.int64)
+    chosen[is_valid] = sample_positions(seeds[is_valid], num_fakes[is_valid])
+
+    # Position of every fake row among the fake rows of its item
+    fake_codes = codes[~real_mask]
+    fake_positions = pd.Series(fake_codes).groupby(fake_codes).cumcount().to_numpy()
+
+    rows = np.flatnonzero(real_mask)[is_valid[codes[real_mask]]]
+    fake_rows = np.flatnonzero(~real_mask)[fake_positions == chosen[fake_codes]]
+
+    # Real row first, then the sampled fake row, in order of the items
+    selected = np.concatenate([rows, fake_rows])
+    order = np.lexsort((np.concatenate([np.zeros(len(rows)), np.ones(len(fake_rows))]), codes[selected]))
+    return videos_df.iloc[selected[order]].reset_index(drop=True)
+
+
+def select_items(pairs_df: pd.DataFrame, num_items: int, seed: int = DEFAULT_SEED) -> pd.DataFrame:
+    """
+    Keep a random subset of the items.
+    :param pairs_df: output of `select_pairs`
+    :param num_items: number of items to keep
+    :param seed: seed of the item sampling
+    :return: rows of the kept items, in their original order
+    """
+    rng = np.random.default_rng(seed)
+    selected_item_ids = rng.choice(pairs_df["item_id"].unique(), size=num_items, replace=False)
+    return pairs_df[pairs_df["item_id"].isin(selected_item_ids)]
+
+
+def select_videos(
+    videos_df: pd.DataFrame,
+    participants: set[int],
+    num_items: int = DEFAULT_NUM_ITEMS,
+    seed: int = DEFAULT_SEED,
+    modifiers: tuple[str, ...] = DEFAULT_MODIFIERS,
+    resolution: str = DEFAULT_RESOLUTION,
+    video_codec: str = DEFAULT_VIDEO_CODEC,
+) -> pd.DataFrame:
+    """
+    Select pairs of real and fake videos of the given participants, see `notebooks/2025_06_16-select_videos.ipynb`.
+    :param videos_df: metadata of all videos
+    :param participants: participant ids, e.g., of the validation split
+    :param num_items: number of items. Each item contributes one real and one fake video.
+    :param seed: seed of the item sampling
+    :param modifiers: see `filter_videos`
+    :param resolution: see `filter_videos`
+    :param video_codec: see `filter_videos`
+    :return: two rows per selected item
+    """
+    available_df = filter_videos(videos_df, participants, modifiers=modifiers, resolution=resolution, video_codec=video_codec)
+    pairs_df = select_pairs(available_df)
+    log.info(f"Found {len(pairs_df) // 2} items with a real and a fake video.")
+    return select_items(pairs_df, num_items=num_items, seed=seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Select pairs of real and fake videos")
+    parser.add_argument("--videos_csv", type=str, help="Metadata of all videos, as .csv or .parquet", default="assets/training_data_20250710_103210_ffprobe_metadata_vfr.csv")
+    parser.add_argument("--participants_txt", type=str, help="Participant ids to select from, one per line", default="assets/val_split.txt")
+    parser.add_argument("--output", type=str, help="Where to write the selection. The format follows the extension, .csv or .parquet.", default="assets/2025_07_16-selected_videos.csv")
+    parser.add_argument("--num_items", type=int, help="Number of items", default=DEFAULT_NUM_ITEMS)
+    parser.add_argument("--seed", type=int, help="Seed of the item sampling", default=DEFAULT_SEED)
+    parser.add_argument("--modifiers", type=str, nargs="+", help="Modifiers to select from", default=list(DEFAULT_MODIFIERS))
+    parser.add_argument("--resolution", type=str, help="Resolution to select", default=DEFAULT_RESOLUTION)
+    parser.add_argument("--video_codec", type=str, help="Codec of the original videos to select", default=DEFAULT_VIDEO_CODEC)
+    parser.add_argument("--cache_dir", type=str, help="Directory for the Parquet cache of the metadata. By default, it is stored next to the CSV file.", default=None)
+    args = vars(parser.parse_args())
+
+    videos_df = read_manifest(args["videos_csv"], cache_dir=args["cache_dir"])
+    selected_videos_df = select_videos(
+        videos_df,
+        participants=read_participants(args["participants_txt"]),
+        num_items=args["num_items"],
+        seed=args["seed"],
+        modifiers=tuple(args["modifiers"]),
+        resolution=args["resolution"],
+        video_codec=args["video_codec"],
+    )
+    log.info(f"Selected {len(selected_videos_df)} videos with a duration of {selected_videos_df['duration'].sum() / 60 / 60:.1f} hours.")
+
+    write_manifest(selected_videos_df, args["output"])
+    log.info(f"Stored selection to \"{args['output']}\"")
@@ -0,0 +1,196 @@
+import os
+import json
+import hashlib
+import numpy as np
+from tqdm import tqdm
+from data.separators import scan_fragment, find_clips, new_counters, LABEL_BLANK, LABEL_CONTENT, LABEL_SEPARATOR, DEFAULT_SEARCH_STRIDE
+from utils.files import file_signature
+from utils.logger import setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+CACHE_SUFFIX = ".separators.npz"
+CACHE_VERSION = 2
+
+# How to check whether a cached index is still valid
+# mtime: file size and modification time
+# hash: additionally hash the first and last megabyte of the fragment
+CACHE_VALIDATIONS = ("mtime", "hash")
+
+LABEL_CODES = {LABEL_CONTENT: 0, LABEL_BLANK: 1, LABEL_SEPARATOR: 2}
+LABEL_NAMES = {code: label for label, code in LABEL_CODES.items()}
+
+
+def cache_filepath(fragment_filepath: str, cache_dir: str = None) -> str:
+    """
+    Location of the cached index of a fragment.
+    :param fragment_filepath: path to fragment
+    :param cache_dir: directory for the cached indices. If None, the index is stored next to the fragment.
+    :return: path to the index file
+    """
+    if cache_dir is None:
+        return fragment_filepath + CACHE_SUFFIX
+
+    # Fragments from different sessions may have the same basename
+    path_hash = hashlib.sha1(os.path.abspath(fragment_filepath).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{os.path.basename(fragment_filepath)}.{path_hash}{CACHE_SUFFIX}")
+
+
+def save_segments(fragment_filepath: str, segments: list[dict], mode: str, stride: int, cache_dir: str = None, validation: str = "mtime") -> None:
+    """
+    Store the segments of a fragment as a compact array file.
+
+    Each segment is stored as one row of integer arrays (label code, start PTS, end PTS, key index). The separator metadata is stored once per distinct key.
+    If the index cannot be written, a warning is logged and the split continues without it.
+
+    :param fragment_filepath: path to fragment
+    :param segments: segments of the fragment, see `data.separators.scan_fragment`
+    :param mode: search mode that produced the segments
+    :param stride: search stride that produced the segments
+    :param cache_dir: directory for the cached indices. If None, the index is stored next to the fragment.
+    :param validation: one of CACHE_VALIDATIONS
+    """
+    keys = []
+    key_indices = []
+    for segment in segments:
+        if segment["key"] is None:
+            key_indices.append(-1)
+            continue
+        if segment["key"] not in keys:
+            keys.append(segment["key"])
+        key_indices.append(keys.index(segment["key"]))
+
+    header = {
+        "version": CACHE_VERSION,
+        "mode": mode,
+        "stride": stride,
+        "signature": file_signature(fragment_filepath, content_hash=validation == "hash"),
+        "keys": [list(key) for key in keys],
+    }
+
+    filepath = cache_filepath(fragment_filepath, cache_dir)
+
+    # Write to a temporary file first, so that a crash never leaves a corrupt index behind
+    tmp_filepath = filepath + ".tmp.npz"
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+        np.savez(
+            tmp_filepath,
+            header=np.array(json.dumps(header)),
+            labels=np.array([LABEL_CODES[segment["label"]] for segment in segments], dtype=np.int8),
+            start_pts=np.array([segment["start_pts"] for segment in segments], dtype=np.int64),
+            end_pts=np.array([segment["end_pts"] for segment in segments], dtype=np.int64),
+            keys=np.array(key_indices, dtype=np.int32),
+        )
+        os.replace(tmp_filepath, filepath)
+    except OSError as e:
+        # The cache is optional, e.g., the recordings may be on a read-only mount
+        log.warning(f"Failed to cache the separators of \"{fragment_filepath}\" to \"{filepath}\": {e}")
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+
+
+def load_segments(fragment_filepath: str, mode: str, stride: int, cache_dir: str = None, validation: str = "mtime") -> list[dict] | None:
+    """
+    Load the cached segments of a fragment.
+
+    A cached index is used if the fragment has not changed and the index was produced by the same search, or by the linear search, which is exact.
+
+    :param fragment_filepath: path to fragment
+    :param mode: requested search mode
+    :param stride: requested search stride
+    :param cache_dir: directory for the cached indices. If None, the index is expected next to the fragment.
+    :param validation: one of CACHE_VALIDATIONS
+    :return: list of segments, or None if there is no valid cached index
+    """
+    filepath = cache_filepath(fragment_filepath, cache_dir)
+    if not os.path.exists(filepath):
+        return None
+
+    try:
+        with np.load(filepath, allow_pickle=False) as data:
+            header = json.loads(str(data["header"]))
+            labels = data["labels"]
+            start_pts = data["start_pts"]
+            end_pts = data["end_pts"]
+            key_indices = data["keys"]
+    except Exception as e:
+        log.warning(f"Ignoring unreadable index \"{filepath}\": {e}")
+        return None
+
+    if header["version"] != CACHE_VERSION:
+        return None
+
+    if header["mode"] != "linear" and (header["mode"] != mode or header["stride"] != stride):
+        return None
+
+    if header["signature"] != file_signature(fragment_filepath, content_hash="sha1" in header["signature"] or validation == "hash"):
+        return None
+
+    keys = [tuple(key) for key in header["keys"]]
+    return [
+        {
+            "label": LABEL_NAMES[int(label)],
+            "key": keys[key_idx] if key_idx >= 0 else None,
+            "start_pts": int(start),
+            "end_pts": int(end),
+        }
+        for label, start, end, key_idx in zip(labels, start_pts, end_pts, key_indices)
+    ]
+
+
+def scan_fragment_cached(
+    fragment_filepath: str,
+    mode: str = "stride",
+    stride: int = DEFAULT_SEARCH_STRIDE,
+    counters: dict[str, int] = None,
+    cache_dir: str = None,
+    validation: str = "mtime",
+) -> list[dict]:
+    """
+    Same as `data.separators.scan_fragment`, but reuses a valid cached index and stores new results.
+    :param fragment_filepath: path to fragment
+    :param mode: search mode
+    :param stride: search stride
+    :param counters: optional analysis counters
+    :param cache_dir: directory for the cached indices. If None, indices are stored next to the fragments.
+    :param validation: one of CACHE_VALIDATIONS
+    :return: list of segments
+    """
+    segments = load_segments(fragment_filepath, mode=mode, stride=stride, cache_dir=cache_dir, validation=validation)
+    if segments is not None:
+        if counters is not None:
+            counters["cache_hits"] += 1
+        return segments
+
+    if counters is None:
+        counters = new_counters()
+
+    segments = scan_fragment(fragment_filepath, mode=mode, stride=stride, counters=counters)
+    save_segments(fragment_filepath, segments, mode=mode, stride=stride, cache_dir=cache_dir, validation=validation)
+    return segments
+
+
+def find_clip_boundaries_cached(
+    fragments_filepaths: list[str],
+    mode: str = "stride",
+    stride: int = DEFAULT_SEARCH_STRIDE,
+    counters: dict[str, int] = None,
+    cache_dir: str = None,
+    validation: str = "mtime",
+) -> list[dict]:
+    """
+    Same as `data.separators.find_clip_boundaries`, but with cached fragment indices. On an unchanged recording, no frame is decoded.
+    """
+    if counters is None:
+        counters = new_counters()
+
+    fragments_segments = []
+    for fragment_filepath in tqdm(fragments_filepaths, desc="Searching separators", unit="fragment"):
+        fragments_segments.append(scan_fragment_cached(fragment_filepath, mode=mode, stride=stride, counters=counters, cache_dir=cache_dir, validation=validation))
+
+    clips = find_clips(fragments_segments)
+    log.info(f"Found {len(clips)} clips with {counters['qr_decodes']} QR decode calls, {counters['blank_tests']} blank tests and {counters['cache_hits']} cached fragments (mode: {mode}).")
+    return clips
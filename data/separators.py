@@ -0,0 +1,390 @@
+import av
+import os
+import numpy as np
+from collections.abc import Iterable, Iterator
+from tqdm import tqdm
+from data.split_utils import is_blank_video_frame, luma_view, try_read_qr_code
+from utils.instrumentation import get_instrumentation
+from utils.logger import setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+LABEL_BLANK = "blank"
+LABEL_CONTENT = "content"
+LABEL_SEPARATOR = "separator"
+
+# linear: analyse every frame
+# stride: decode every frame, but only analyse every n-th frame and bisect where the label changed.
+#   Separators and blank runs shorter than the stride can be missed, so the boundaries can differ from the linear scan.
+# keyframes: decode and analyse only keyframes, then refine the GOPs where the label changed with the stride search.
+#   Separators shorter than the keyframe interval of the recording can be missed.
+SEARCH_MODES = ("linear", "stride", "keyframes")
+
+# Default distance between probed frames in the stride search. Separators must be displayed for at least this many frames to be found.
+DEFAULT_SEARCH_STRIDE = 8
+
+
+def new_counters() -> dict[str, int]:
+    """
+    Counters of the analysis work done during a boundary search
+    """
+    return {"blank_tests": 0, "qr_decodes": 0, "cache_hits": 0}
+
+
+def is_separator_metadata(metadata) -> bool:
+    return metadata is not None and isinstance(metadata, dict) and "item_id" in metadata
+
+
+def label_frame(frame: av.VideoFrame, counters: dict[str, int] = None) -> tuple[str, tuple | None]:
+    """
+    Classify a decoded frame as blank, separator or content.
+    :param frame: decoded video frame
+    :param counters: optional counters to update, see `new_counters`
+    :return: tuple (label, key). The key is (item_id, modifiers) for separator frames and None otherwise.
+    """
+    instrumentation = get_instrumentation()
+    if counters is not None:
+        counters["blank_tests"] += 1
+
+    with instrumentation.time("blank_test"):
+        is_blank = is_blank_video_frame(frame)
+    if is_blank:
+        instrumentation.count("frames_blank")
+        return LABEL_BLANK, None
+
+    if counters is not None:
+        counters["qr_decodes"] += 1
+
+    with instrumentation.time("qr_decode"):
+        metadata = try_read_qr_code(luma_view(frame))
+    if is_separator_metadata(metadata):
+        instrumentation.count("qr_hits")
+        return LABEL_SEPARATOR, (metadata["item_id"], metadata["modifiers"])
+
+    instrumentation.count("qr_misses")
+    return LABEL_CONTENT, None
+
+
+def extend_segments(segments: list[dict], label: tuple[str, tuple | None], start_pts: int, end_pts: int) -> None:
+    """
+    Append the frames from start_pts to end_pts (inclusive) with the given label. Extends the last segment if it has the same label.
+
+    Blank frames directly after a separator are folded into the separator, so that all search modes agree on where a separator ends. This does not change the extracted clips because blank frames are never written.
+    """
+    name, key = label
+    if segments and name == LABEL_BLANK and segments[-1]["label"] == LABEL_SEPARATOR:
+        name, key = LABEL_SEPARATOR, segments[-1]["key"]
+
+    if segments and segments[-1]["label"] == name and segments[-1]["key"] == key:
+        segments[-1]["end_pts"] = max(segments[-1]["end_pts"], end_pts)
+        return
+
+    segments.append({
+        "label": name,
+        "key": key,
+        "start_pts": start_pts,
+        "end_pts": end_pts,
+    })
+
+
+def segments_lookup(segments: list[dict]):
+    """
+    Build a function that maps the PTS of a frame to its label.
+    :param segments: segments of one fragment, see `scan_fragment`
+    :return: function pts -> (label, key)
+    """
+    start_pts = np.array([segment["start_pts"] for segment in segments], dtype=np.int64)
+
+    def lookup(pts: int) -> tuple[str, tuple | None]:
+        segment_idx = int(np.searchsorted(start_pts, pts, side="right")) - 1
+        if segment_idx < 0:
+            return LABEL_CONTENT, None
+        return segments[segment_idx]["label"], segments[segment_idx]["key"]
+
+    return lookup
+
+
+def _bisect_last(predicate, lo: int, hi: int) -> int:
+    """
+    Find the last index in [lo, hi] for which the predicate holds. Assumes that the predicate holds on a prefix of the range, including lo.
+    """
+    if predicate(hi):
+        return hi
+
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if predicate(mid):
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def _bisect_first(predicate, lo: int, hi: int) -> int:
+    """
+    Find the first index in (lo, hi] for which the predicate holds. Assumes that the predicate holds on a suffix of the range, including hi.
+    """
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if predicate(mid):
+            hi = mid
+        else:
+            lo = mid
+    return hi
+
+
+def _resolve_interval(buffer: list[av.VideoFrame], first_label: tuple, segments: list[dict], counters: dict[str, int]) -> tuple:
+    """
+    Label the frames between two probed frames.
+
+    The first frame in the buffer has already been labelled. The last frame is probed here. If both labels agree, all frames in between get the same label. Otherwise, the end of a leading separator and the start of a trailing separator or of trailing blank frames are found by bisection, which only analyses O(log n) frames.
+
+    Separator frames are assumed to form contiguous runs, apart from blank frames directly after a separator. Blank frames after content are assumed to last until the next probe.
+
+    :param buffer: decoded frames, starting with the previous probe and ending with the next probe
+    :param first_label: label of buffer[0]
+    :param segments: segments to extend
+    :param counters: analysis counters
+    :return: label of the last frame in the buffer
+    """
+    labels = {0: first_label}
+
+    def label_at(i):
+        if i not in labels:
+            labels[i] = label_frame(buffer[i], counters)
+        return labels[i]
+
+    last = len(buffer) - 1
+    start_label = first_label
+    end_label = label_at(last)
+
+    if start_label == end_label:
+        extend_segments(segments, start_label, buffer[1].pts, buffer[last].pts)
+        return end_label
+
+    # Last frame of the leading separator
+    split_end = 0
+    if start_label[0] == LABEL_SEPARATOR:
+        split_end = _bisect_last(lambda i: label_at(i) == start_label or label_at(i)[0] == LABEL_BLANK, 0, last)
+
+    # First frame of the trailing separator, or of the blank frames after the last content frame. Clips end at their last content frame, see `find_clips`.
+    split_start = last + 1
+    if end_label[0] == LABEL_SEPARATOR:
+        split_start = _bisect_first(lambda i: label_at(i) == end_label, split_end, last)
+    elif start_label[0] == LABEL_CONTENT and end_label[0] == LABEL_BLANK:
+        split_start = _bisect_first(lambda i: label_at(i)[0] == LABEL_BLANK, split_end, last)
+
+    if split_end > 0:
+        extend_segments(segments, start_label, buffer[1].pts, buffer[split_end].pts)
+
+    if split_end + 1 < split_start:
+        # Frames in between were not all analysed. They may contain content unless the interval is bounded by blank frames and separators only.
+        names = {start_label[0], end_label[0]}
+        middle_label = (LABEL_BLANK, None) if LABEL_BLANK in names and LABEL_CONTENT not in names else (LABEL_CONTENT, None)
+        extend_segments(segments, middle_label, buffer[split_end + 1].pts, buffer[split_start - 1].pts)
+
+    if split_start <= last:
+        extend_segments(segments, end_label, buffer[split_start].pts, buffer[last].pts)
+
+    return end_label
+
+
+def _scan_frames(frames: Iterable[av.VideoFrame], stride: int, counters: dict[str, int], first_label: tuple = None) -> list[dict]:
+    """
+    Label a sequence of decoded frames by probing every stride-th frame and the last frame.
+    :param frames: decoded frames in presentation order
+    :param stride: distance between probed frames. With stride 1, every frame is analysed.
+    :param counters: analysis counters
+    :param first_label: label of the first frame, if already known
+    :return: list of segments
+    """
+    segments = []
+    buffer = []
+    previous_label = first_label
+
+    for frame_idx, frame in enumerate(frames):
+        if frame_idx == 0:
+            if previous_label is None:
+                previous_label = label_frame(frame, counters)
+            extend_segments(segments, previous_label, frame.pts, frame.pts)
+            buffer = [frame]
+            continue
+
+        buffer.append(frame)
+        if frame_idx % stride == 0:
+            previous_label = _resolve_interval(buffer, previous_label, segments, counters)
+            buffer = [frame]
+
+    # Always probe the last frame
+    if len(buffer) > 1:
+        _resolve_interval(buffer, previous_label, segments, counters)
+
+    return segments
+
+
+def _decode_range(input_container: av.container.InputContainer, input_stream: av.video.stream.VideoStream, start_pts: int, end_pts: int) -> Iterator[av.VideoFrame]:
+    """
+    Decode the frames with start_pts <= pts <= end_pts by seeking to the preceding keyframe.
+    """
+    input_container.seek(start_pts, stream=input_stream, backward=True, any_frame=False)
+    for frame in get_instrumentation().timed_iter("decode", input_container.decode(input_stream)):
+        if frame.pts < start_pts:
+            continue
+        if frame.pts > end_pts:
+            break
+        yield frame
+
+
+def _scan_fragment_keyframes(fragment_filepath: str, stride: int, counters: dict[str, int]) -> list[dict]:
+    """
+    Coarse-to-fine scan of a fragment. First, only keyframes are decoded (the decoder drops all other frames). Then the GOPs where the label changes, and the GOP at the end of the fragment, are decoded and refined with the stride search.
+    """
+    with av.open(fragment_filepath) as input_container:
+        input_stream = input_container.streams.video[0]
+
+        # Pass 1: keyframes only
+        input_stream.codec_context.skip_frame = "NONKEY"
+        keyframes = []
+        last_pts = None
+        for packet in input_container.demux(input_stream):
+            if packet.pts is not None:
+                last_pts = packet.pts if last_pts is None else max(last_pts, packet.pts)
+
+            for frame in get_instrumentation().timed_iter("decode", packet.decode()):
+                keyframes.append((frame.pts, label_frame(frame, counters)))
+
+        if len(keyframes) == 0:
+            return []
+
+        # Pass 2: refine intervals where the label changes
+        input_stream.codec_context.skip_frame = "DEFAULT"
+        segments = []
+        extend_segments(segments, keyframes[0][1], keyframes[0][0], keyframes[0][0])
+
+        intervals = list(zip(keyframes[:-1], keyframes[1:]))
+        if last_pts > keyframes[-1][0]:
+            # The last frame of the fragment has not been analysed yet
+            intervals.append((keyframes[-1], (last_pts, None)))
+
+        for (start_pts, start_label), (end_pts, end_label) in intervals:
+            if start_label == end_label:
+                extend_segments(segments, start_label, start_pts, end_pts)
+                continue
+
+            frames = _decode_range(input_container, input_stream, start_pts, end_pts)
+            for segment in _scan_frames(frames, stride=stride, counters=counters, first_label=start_label):
+                extend_segments(segments, (segment["label"], segment["key"]), segment["start_pts"], segment["end_pts"])
+
+    return segments
+
+
+def scan_fragment(fragment_filepath: str, mode: str = "stride", stride: int = DEFAULT_SEARCH_STRIDE, counters: dict[str, int] = None) -> list[dict]:
+    """
+    Segment a fragment into runs of blank, separator and content frames.
+    :param fragment_filepath: path to fragment
+    :param mode: one of SEARCH_MODES
+    :param stride: distance between probed frames, ignored in linear mode
+    :param counters: optional analysis counters
+    :return: list of segments, each a dict with keys label, key, start_pts and end_pts. PTS are inclusive and in units of the fragment's video stream time base.
+    """
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode \"{mode}\". Expected one of {SEARCH_MODES}.")
+
+    if counters is None:
+        counters = new_counters()
+
+    if mode == "keyframes":
+        return _scan_fragment_keyframes(fragment_filepath, stride=stride, counters=counters)
+
+    with av.open(fragment_filepath) as input_container:
+        frames = get_instrumentation().timed_iter("decode", input_container.decode(video=0))
+        return _scan_frames(frames, stride=1 if mode == "linear" else stride, counters=counters)
+
+
+def find_clips(fragments_segments: list[list[dict]]) -> list[dict]:
+    """
+    Derive the clip boundaries from the segments of all fragments of a recording.
+
+    This follows the same rules as the linear splitter: a clip consists of the non-blank frames between the end of a separator and the start of the next separator. Content before the first separator is skipped. If the same (item_id, modifiers) occurs several times, the last occurrence with content wins.
+    The clip ends after its last content frame, so blank and marker frames before the next separator are outside the clip.
+    Every occurrence of a separator followed by content is numbered in recording order, like the clips started by the single-pass splitter. The number of the winning occurrence is the clip's clip_idx, which identifies the clip in the manifest, see `data.clip_manifest.is_clip_complete`.
+
+    :param fragments_segments: list of segments for each fragment, in recording order
+    :return: list of clips in recording order. Each clip is a dict with keys clip_idx, item_id, modifiers, start_fragment_idx, after_pts, end_fragment_idx and before_pts. after_pts and before_pts are exclusive bounds within the start and end fragment.
+    """
+    clips = {}
+    current = None
+    num_occurrences = 0
+
+    def close():
+        nonlocal num_occurrences
+        if current is None or current["last_content"] is None:
+            return
+
+        end_fragment_idx, last_content_pts = current["last_content"]
+
+        key = current["key"]
+        # Re-insert to keep the clips in the order of their final occurrence
+        clips.pop(key, None)
+        clips[key] = {
+            "clip_idx": num_occurrences,
+            "item_id": key[0],
+            "modifiers": key[1],
+            "start_fragment_idx": current["start_fragment_idx"],
+            "after_pts": current["after_pts"],
+            "end_fragment_idx": end_fragment_idx,
+            "before_pts": last_content_pts + 1,
+        }
+        num_occurrences += 1
+
+    for fragment_idx, segments in enumerate(fragments_segments):
+        for segment in segments:
+            if segment["label"] == LABEL_SEPARATOR:
+                if current is not None and current["key"] == segment["key"] and current["last_content"] is None:
+                    # Same separator continues, possibly across a fragment boundary or after some blank frames
+                    current["start_fragment_idx"] = fragment_idx
+                    current["after_pts"] = segment["end_pts"]
+                    continue
+
+                close()
+                current = {
+                    "key": segment["key"],
+                    "start_fragment_idx": fragment_idx,
+                    "after_pts": segment["end_pts"],
+                    # (fragment index, PTS) of the last content frame, None until the clip has content
+                    "last_content": None,
+                }
+
+            elif segment["label"] == LABEL_CONTENT and current is not None:
+                current["last_content"] = (fragment_idx, segment["end_pts"])
+
+    close()
+    return list(clips.values())
+
+
+def find_clip_boundaries(
+    fragments_filepaths: list[str],
+    mode: str = "stride",
+    stride: int = DEFAULT_SEARCH_STRIDE,
+    counters: dict[str, int] = None,
+) -> list[dict]:
+    """
+    Find the clip boundaries in a recording without extracting any clips.
+    :param fragments_filepaths: fragments of the recording, in order
+    :param mode: one of SEARCH_MODES
+    :param stride: distance between probed frames
+    :param counters: optional analysis counters
+    :return: list of clips, see `find_clips`
+    """
+    if counters is None:
+        counters = new_counters()
+
+    fragments_segments = []
+    for fragment_filepath in tqdm(fragments_filepaths, desc="Searching separators", unit="fragment"):
+        fragments_segments.append(scan_fragment(fragment_filepath, mode=mode, stride=stride, counters=counters))
+
+    clips = find_clips(fragments_segments)
+    log.info(f"Found {len(clips)} clips with {counters['qr_decodes']} QR decode calls and {counters['blank_tests']} blank tests (mode: {mode}).")
+    return clips
@@ -0,0 +1,367 @@
+import os
+import argparse
+import pandas as pd
+from multiprocessing import Process
+from data.separators import find_clips, SEARCH_MODES, DEFAULT_SEARCH_STRIDE
+from data.separator_cache import CACHE_VALIDATIONS
+from data.clip_extraction import clip_filename, write_clip, EXTRACTION_MODES
+from data.clip_manifest import append_manifest, is_clip_complete, load_manifest
+from data.fingerprint_qa import compute_fingerprints, find_pairs, pair_statistics
+from data.split_recordings_into_clips_parallel import scan_fragment_job
+from data.split_sessions_batch import find_sessions
+from utils.job_queue import JobQueue, run_worker, JOB_DONE, JOB_FAILED, JOB_STATUSES, DEFAULT_LEASE_SECONDS, DEFAULT_MAX_ATTEMPTS, DEFAULT_POLL_INTERVAL, DEFAULT_RETRY_DELAY
+from utils.logger import setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+# Splitting a recording: every fragment is scanned by its own job. Once all scans are finished, a plan job derives the clips and adds one extraction job per clip.
+# A finalize job writes the clip list once all extraction jobs are finished.
+KIND_SCAN = "scan_fragment"
+KIND_PLAN = "plan_clips"
+KIND_EXTRACT = "extract_clip"
+KIND_FINALIZE = "finalize_recording"
+
+# Comparing one recorded clip with its original video, see `data.fingerprint_qa`
+KIND_QA = "qa_clip"
+
+QA_GROUP = "qa"
+
+
+def _group(recording: str, kind: str) -> str:
+    return f"{recording}/{kind}"
+
+
+def submit_recording(
+    job_queue: JobQueue,
+    recording: str,
+    fragments_filepaths: list[str],
+    output_dir: str,
+    search_mode: str = "linear",
+    search_stride: int = DEFAULT_SEARCH_STRIDE,
+    extraction_mode: str = "reencode",
+    use_cache: bool = False,
+    cache_dir: str = None,
+    cache_validation: str = "mtime",
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+) -> None:
+    """
+    Add the jobs that split a recording into clips. Submitting the same recording again adds no jobs.
+    :param job_queue: queue to add the jobs to
+    :param recording: unique name of the recording, used in the job keys
+    :param fragments_filepaths: fragments of the recording, in order
+    :param output_dir: where to write the clips
+    :param search_mode: boundary search mode, see `data.separators.SEARCH_MODES`
+    :param search_stride: distance between probed frames
+    :param extraction_mode: one of `data.clip_extraction.EXTRACTION_MODES`
+    :param use_cache: if True, reuse and store the fragment indices, see `data.separator_cache`
+    :param cache_dir: directory for the cached indices. If None, indices are stored next to the fragments.
+    :param cache_validation: one of `data.separator_cache.CACHE_VALIDATIONS`
+    :param max_attempts: attempts per job
+    """
+    scan_group = _group(recording, "scan")
+    jobs = []
+    for fragment_idx, fragment_filepath in enumerate(fragments_filepaths):
+        jobs.append({
+            "kind": KIND_SCAN,
+            "key": f"{scan_group}/{fragment_idx}",
+            "group": scan_group,
+            "max_attempts": max_attempts,
+            "payload": {
+                "fragment_idx": fragment_idx,
+                "fragment_filepath": fragment_filepath,
+                "search_mode": search_mode,
+                "search_stride": search_stride,
+                "use_cache": use_cache,
+                "cache_dir": cache_dir,
+                "cache_validation": cache_validation,
+            },
+        })
+
+    jobs.append({
+        "kind": KIND_PLAN,
+        "key": _group(recording, "plan"),
+        "after_group": scan_group,
+        "max_attempts": max_attempts,
+        # Extraction jobs of earlier recordings run first, so that finished recordings are not held up by new ones
+        "priority": 1,
+        "payload": {
+            "recording": recording,
+            "fragments_filepaths": fragments_filepaths,
+            "output_dir": output_dir,
+            "extraction_mode": extraction_mode,
+            "max_attempts": max_attempts,
+        },
+    })
+    job_queue.submit_many(jobs)
+
+
+def scan_handler(job_queue: JobQueue, job: dict) -> dict:
+    """
+    Find the separators in one fragment.
+    :return: dict with the fragment's segments and analysis counters
+    """
+    payload = job["payload"]
+    segments, counters, _ = scan_fragment_job(
+        payload["fragment_filepath"],
+        search_mode=payload["search_mode"],
+        search_stride=payload["search_stride"],
+        use_cache=payload["use_cache"],
+        cache_dir=payload["cache_dir"],
+        cache_validation=payload["cache_validation"],
+        instrument=False,
+    )
+    return {"segments": segments, "counters": counters}
+
+
+def plan_handler(job_queue: JobQueue, job: dict) -> dict:
+    """
+    Derive the clips of a recording from the scanned fragments and add one extraction job per clip that is not complete yet.
+    :return: dict with the number of clips and of clips completed by a previous run
+    """
+    payload = job["payload"]
+    recording = payload["recording"]
+
+    scan_jobs = job_queue.jobs(kind=KIND_SCAN, group=_group(recording, "scan"))
+    failed = [scan_job["payload"]["fragment_filepath"] for scan_job in scan_jobs if scan_job["status"] != JOB_DONE]
+    if failed:
+        raise RuntimeError(f"{len(failed)} fragments could not be scanned, e.g., \"{failed[0]}\"")
+
+    # JSON has no tuples, so the separator keys come back as lists
+    fragments_segments = []
+    for scan_job in sorted(scan_jobs, key=lambda scan_job: scan_job["payload"]["fragment_idx"]):
+        segments = scan_job["result"]["segments"]
+        for segment in segments:
+            segment["key"] = tuple(segment["key"]) if segment["key"] is not None else None
+        fragments_segments.append(segments)
+
+    clips = find_clips(fragments_segments)
+
+    # Clips that were completed by a previous run are not extracted again
+    os.makedirs(payload["output_dir"], exist_ok=True)
+    manifest = load_manifest(payload["output_dir"])
+
+    extract_group = _group(recording, "extract")
+    completed_entries = []
+    jobs = []
+    for clip in clips:
+        clip_idx = clip["clip_idx"]
+        entry = manifest.get(clip_filename(clip["item_id"], clip["modifiers"]))
+        if is_clip_complete(payload["output_dir"], entry, clip_idx):
+            completed_entries.append(entry)
+            continue
+
+        jobs.append({
+            "kind": KIND_EXTRACT,
+            "key": f"{extract_group}/{clip_idx}",
+            "group": extract_group,
+            "max_attempts": payload["max_attempts"],
+            "priority": 1,
+            "payload": {
+                "fragments_filepaths": payload["fragments_filepaths"],
+                "clip": clip,
+                "clip_idx": clip_idx,
+                "output_dir": payload["output_dir"],
+                "extraction_mode": payload["extraction_mode"],
+            },
+        })
+
+    jobs.append({
+        "kind": KIND_FINALIZE,
+        "key": _group(recording, "finalize"),
+        "after_group": extract_group,
+        "max_attempts": payload["max_attempts"],
+        "priority": 2,
+        "payload": {
+            "recording": recording,
+            "output_dir": payload["output_dir"],
+            "completed_entries": completed_entries,
+        },
+    })
+    job_queue.submit_many(jobs)
+
+    log.info(f"Found {len(clips)} clips in recording \"{recording}\", {len(completed_entries)} were completed by a previous run.")
+    return {"num_clips": len(clips), "num_completed": len(completed_entries)}
+
+
+def extract_handler(job_queue: JobQueue, job: dict) -> dict:
+    """
+    Extract one clip. The clip is only moved into place once it is complete, so a failed attempt leaves nothing behind.
+    :return: dict with the manifest entry, which is None if the clip has no frames
+    """
+    payload = job["payload"]
+    entry = write_clip(payload["fragments_filepaths"], payload["clip"], payload["clip_idx"], payload["output_dir"], extraction_mode=payload["extraction_mode"])
+    return {"entry": entry}
+
+
+def finalize_handler(job_queue: JobQueue, job: dict) -> dict:
+    """
+    Record the extracted clips in the manifest and write the clip list, like the splitters do at the end of a run.
+    :return: dict with the number of clips and of clips that could not be extracted
+    """
+    payload = job["payload"]
+    extract_jobs = job_queue.jobs(kind=KIND_EXTRACT, group=_group(payload["recording"], "extract"))
+
+    # Only this job writes to the manifest
+    buffer = list(payload["completed_entries"])
+    for extract_job in extract_jobs:
+        if extract_job["status"] == JOB_DONE and extract_job["result"]["entry"] is not None:
+            append_manifest(payload["output_dir"], extract_job["result"]["entry"])
+            buffer.append(extract_job["result"]["entry"])
+
+    num_failed = sum(1 for extract_job in extract_jobs if extract_job["status"] == JOB_FAILED)
+    if num_failed > 0:
+        log.warning(f"{num_failed} clips of recording \"{payload['recording']}\" could not be extracted.")
+
+    # Restore the recording order
+    buffer = sorted(buffer, key=lambda entry: entry["clip_idx"])
+    output_df = pd.DataFrame(buffer, columns=["item_id", "modifiers", "filename"])
+
+    # Replace the list of clips in one step
+    output_csv_filepath = os.path.join(payload["output_dir"], "video_clips.csv")
+    output_df.to_csv(output_csv_filepath + ".tmp", index=False)
+    os.replace(output_csv_filepath + ".tmp", output_csv_filepath)
+
+    return {"num_clips": len(output_df), "num_failed": num_failed}
+
+
+def submit_qa(job_queue: JobQueue, pairs_df: pd.DataFrame, max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> None:
+    """
+    Add one QA job per recorded clip. Clips that already have a QA job are not added again.
+    :param pairs_df: data frame with columns item_id, modifiers, original_filepath and recorded_filepath, see `data.fingerprint_qa.find_pairs`
+    """
+    jobs = []
+    for pair in pairs_df[["item_id", "modifiers", "original_filepath", "recorded_filepath"]].to_dict("records"):
+        jobs.append({
+            "kind": KIND_QA,
+            "key": f"{QA_GROUP}/{os.path.abspath(pair['recorded_filepath'])}",
+            "group": QA_GROUP,
+            "max_attempts": max_attempts,
+            "payload": pair,
+        })
+    job_queue.submit_many(jobs)
+
+
+def qa_handler(job_queue: JobQueue, job: dict) -> dict:
+    """
+    Compare a recorded clip with its original video.
+    :return: dict with the pair and its statistics, see `data.fingerprint_qa.pair_statistics`
+    """
+    pair = job["payload"]
+    return {**pair, **pair_statistics(compute_fingerprints(pair["original_filepath"]), compute_fingerprints(pair["recorded_filepath"]))}
+
+
+HANDLERS = {
+    KIND_SCAN: scan_handler,
+    KIND_PLAN: plan_handler,
+    KIND_EXTRACT: extract_handler,
+    KIND_FINALIZE: finalize_handler,
+    KIND_QA: qa_handler,
+}
+
+
+def worker_process(queue_filepath: str, **kwargs) -> None:
+    counters = run_worker(queue_filepath, HANDLERS, **kwargs)
+    log.info(f"Worker finished: {counters['done']} jobs done, {counters['failed']} failed, {counters['lost']} lost.")
+
+
+def print_status(job_queue: JobQueue, show_failed: bool) -> None:
+    counts_df = pd.DataFrame.from_dict(job_queue.counts(), orient="index", columns=list(JOB_STATUSES))
+    print(counts_df.to_string() if len(counts_df) > 0 else "No jobs")
+
+    if show_failed:
+        for job in job_queue.jobs(status=JOB_FAILED):
+            print(f"{job['id']} {job['kind']} {job['key']}: {job['error']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split and QA recordings cooperatively with a job queue in a SQLite file. Start workers on any number of machines that can access the file.")
+    parser.add_argument("--queue", type=str, help="Path to the queue database, e.g., on shared storage", required=True)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    submit_parser = subparsers.add_parser("submit", help="Add the jobs that split every session below a root directory")
+    submit_parser.add_argument("--input_root", type=str, help="Directory where to search for session directories", required=True)
+    submit_parser.add_argument("--output_root", type=str, help="Directory where to save the clips. Each session gets a subdirectory.", required=True)
+    submit_parser.add_argument("--boundary_search", type=str, help="Search mode for the separators. The stride mode requires separators and blank runs to be displayed for at least the stride, the keyframes mode for longer than the keyframe interval.", choices=SEARCH_MODES, default="linear")
+    submit_parser.add_argument("--search_stride", type=int, help="Distance between analysed frames for the stride and keyframes boundary searches", default=DEFAULT_SEARCH_STRIDE)
+    submit_parser.add_argument("--extraction", type=str, help="How to write the clips", choices=EXTRACTION_MODES, default="reencode")
+    submit_parser.add_argument("--cache", action="store_true", help="Reuse and store per-fragment separator indices, so that unchanged fragments are not analysed again")
+    submit_parser.add_argument("--cache_dir", type=str, help="Directory for the separator indices, used with --cache. By default, they are stored next to the fragments.", default=None)
+    submit_parser.add_argument("--cache_validation", type=str, help="How to detect changed fragments", choices=CACHE_VALIDATIONS, default="mtime")
+    submit_parser.add_argument("--listing_cache_dir", type=str, help="Directory for a cached listing of the input root", default=None)
+    submit_parser.add_argument("--max_attempts", type=int, help="Attempts per job", default=DEFAULT_MAX_ATTEMPTS)
+
+    qa_parser = subparsers.add_parser("submit_qa", help="Add one QA job per recorded clip, see fingerprint_qa.py")
+    qa_parser.add_argument("--selection_csv", type=str, help="CSV file with the selected videos", default="assets/2025_07_16-selected_videos.csv")
+    qa_parser.add_argument("--originals_dir", type=str, help="Directory with the downloaded original videos, see download_videos.py", required=True)
+    qa_parser.add_argument("--clips_dir", type=str, help="Directory with the recorded clips and their video_clips.csv files", required=True)
+    qa_parser.add_argument("--max_attempts", type=int, help="Attempts per job", default=DEFAULT_MAX_ATTEMPTS)
+
+    worker_parser = subparsers.add_parser("worker", help="Run jobs")
+    worker_parser.add_argument("--num_processes", type=int, help="Number of worker processes to start on this machine", default=1)
+    worker_parser.add_argument("--kinds", type=str, nargs="+", help="Only run jobs of these kinds", choices=list(HANDLERS), default=None)
+    worker_parser.add_argument("--lease_seconds", type=float, help="Jobs of workers that stop sending heartbeats for this long are handed to other workers", default=DEFAULT_LEASE_SECONDS)
+    worker_parser.add_argument("--retry_delay", type=float, help="Delay before the first retry of a failed job, in seconds", default=DEFAULT_RETRY_DELAY)
+    worker_parser.add_argument("--poll_interval", type=float, help="How long to wait when no job is ready, in seconds", default=DEFAULT_POLL_INTERVAL)
+    worker_parser.add_argument("--max_jobs", type=int, help="Stop each process after this many jobs", default=None)
+    worker_parser.add_argument("--exit_when_idle", action="store_true", help="Stop once no job is pending or running")
+
+    status_parser = subparsers.add_parser("status", help="Show the number of jobs per kind and status")
+    status_parser.add_argument("--failed", action="store_true", help="Also list the failed jobs and their errors")
+
+    retry_parser = subparsers.add_parser("retry", help="Give failed jobs a new set of attempts. The plan and finalize jobs that depend on them are run again.")
+    retry_parser.add_argument("--kind", type=str, help="Only retry jobs of this kind", choices=list(HANDLERS), default=None)
+
+    export_parser = subparsers.add_parser("export_qa", help="Write the statistics of the finished QA jobs to a CSV file")
+    export_parser.add_argument("--output_csv", type=str, help="Where to write the statistics", required=True)
+
+    args = vars(parser.parse_args())
+
+    if args["command"] == "worker":
+        worker_kwargs = {k: args[k] for k in ["kinds", "lease_seconds", "retry_delay", "poll_interval", "max_jobs", "exit_when_idle"]}
+
+        # Create the database before the workers start
+        JobQueue(args["queue"]).close()
+
+        processes = [Process(target=worker_process, args=(args["queue"],), kwargs=worker_kwargs) for _ in range(args["num_processes"])]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+    else:
+        with JobQueue(args["queue"]) as job_queue:
+            if args["command"] == "submit":
+                sessions_df = find_sessions(args["input_root"], cache_dir=args["listing_cache_dir"])
+                for session in sessions_df.to_dict("records"):
+                    submit_recording(
+                        job_queue,
+                        recording=session["input_dir"],
+                        fragments_filepaths=session["fragments_filepaths"],
+                        output_dir=os.path.join(args["output_root"], session["session"]),
+                        search_mode=args["boundary_search"],
+                        search_stride=args["search_stride"],
+                        extraction_mode=args["extraction"],
+                        use_cache=args["cache"],
+                        cache_dir=args["cache_dir"],
+                        cache_validation=args["cache_validation"],
+                        max_attempts=args["max_attempts"],
+                    )
+                log.info(f"Submitted {len(sessions_df)} sessions with {sessions_df['num_fragments'].sum()} fragments.")
+
+            elif args["command"] == "submit_qa":
+                pairs_df = find_pairs(args["selection_csv"], args["originals_dir"], args["clips_dir"])
+                submit_qa(job_queue, pairs_df, max_attempts=args["max_attempts"])
+                log.info(f"Submitted {len(pairs_df)} clips for QA.")
+
+            elif args["command"] == "status":
+                print_status(job_queue, show_failed=args["failed"])
+
+            elif args["command"] == "retry":
+                log.info(f"Retrying {job_queue.retry(kind=args['kind'])} jobs, including the jobs that depend on the failed ones.")
+
+            elif args["command"] == "export_qa":
+                stats_df = pd.DataFrame([job["result"] for job in job_queue.jobs(kind=KIND_QA, status=JOB_DONE)])
+                stats_df.to_csv(args["output_csv"], index=False)
+                log.info(f"Stored statistics of {len(stats_df)} clips to \"{args['output_csv']}\"")
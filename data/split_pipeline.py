@@ -0,0 +1,290 @@
+import av
+import os
+import types
+import logging
+import itertools
+import threading
+import pandas as pd
+from tqdm import tqdm
+from data.clip_extraction import clip_filename
+from data.clip_manifest import append_manifest, commit_clip, discard_clip, is_clip_complete, load_manifest, temporary_filepath
+from data.separators import extend_segments, label_frame, segments_lookup, LABEL_BLANK, LABEL_SEPARATOR
+from data.separator_cache import load_segments, save_segments
+from data.split_utils import encode_and_mux, open_output_writer, prepare_output_frame
+from utils.instrumentation import get_instrumentation
+from utils.logger import log_event, setup_basic_logger
+from utils.pipeline import Pipeline, PipelineStopped, END_OF_STREAM
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+DEFAULT_NUM_ANALYSIS_WORKERS = 2
+DEFAULT_NUM_ENCODE_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 32
+
+
+def _decode_stage(pipeline: Pipeline, fragments_filepaths: list[str], analysis_queue, in_flight: threading.Semaphore, num_analysis_workers: int, cache: dict | None):
+    """
+    Decode all fragments in order and hand out numbered frames to the analysis workers. Frames of fragments with a valid cached index already carry their label.
+    """
+    seq = 0
+    for fragment_filepath in tqdm(fragments_filepaths, desc="Processing fragments", unit="fragment"):
+
+        # The pipelined splitter analyses every frame, which corresponds to the linear search
+        lookup_label = None
+        if cache is not None:
+            cached_segments = load_segments(fragment_filepath, mode="linear", stride=1, **cache)
+            lookup_label = segments_lookup(cached_segments) if cached_segments is not None else None
+        fragment = types.SimpleNamespace(filepath=fragment_filepath, is_cached=lookup_label is not None)
+
+        with av.open(fragment_filepath) as input_container:
+            input_stream = input_container.streams.video[0]
+
+            # The encoders need the stream properties after the input container has been closed
+            template = types.SimpleNamespace(width=input_stream.width, height=input_stream.height, time_base=input_stream.time_base)
+
+            for input_frame in get_instrumentation().timed_iter("decode", input_container.decode(input_stream)):
+                label = lookup_label(input_frame.pts) if lookup_label is not None else None
+
+                # Analysis workers can finish out of order. Limit how many frames can wait to be put back in order.
+                pipeline.acquire(in_flight)
+                pipeline.put(analysis_queue, (seq, input_frame, template, fragment, label))
+                seq += 1
+
+    # One end marker per analysis worker
+    for _ in range(num_analysis_workers):
+        pipeline.put(analysis_queue, END_OF_STREAM)
+
+
+def _analysis_stage(pipeline: Pipeline, analysis_queue, results_queue):
+    """
+    Label frames as blank, separator or content. Several analysis workers run concurrently, so results arrive out of order.
+    """
+    while True:
+        item = pipeline.get(analysis_queue)
+        if item is END_OF_STREAM:
+            pipeline.put(results_queue, END_OF_STREAM)
+            return
+
+        seq, input_frame, template, fragment, label = item
+        if label is None:
+            label = label_frame(input_frame)
+        pipeline.put(results_queue, (seq, input_frame, template, fragment, label))
+
+
+def _dispatch_stage(pipeline: Pipeline, results_queue, in_flight: threading.Semaphore, encode_queues: list, output_dir: str, num_analysis_workers: int, buffer: list[dict], cache: dict | None):
+    """
+    Restore the frame order and run the same state machine as `split_fragments`. Frames of each clip are sent to one of the encode workers.
+    """
+    instrumentation = get_instrumentation()
+
+    # Clips that were completed by a previous run are not encoded again
+    manifest = load_manifest(output_dir)
+
+    pending = {}
+    next_seq = 0
+    num_finished_workers = 0
+
+    current_item_id = None
+    current_modifiers = None
+    is_recording = False
+    current_queue = None
+    current_start_pts = None
+
+    # Labels of the current fragment, stored in the cache once the fragment is complete
+    current_fragment = None
+    segments = []
+
+    def save_fragment_segments():
+        if cache is not None and current_fragment is not None and not current_fragment.is_cached:
+            save_segments(current_fragment.filepath, segments, mode="linear", stride=1, **cache)
+
+    # Clips with the same filename go to the same encode worker, so that a later clip overwrites an earlier one in order
+    filename_to_queue = {}
+    round_robin = itertools.cycle(encode_queues)
+
+    while num_finished_workers < num_analysis_workers:
+        item = pipeline.get(results_queue)
+        if item is END_OF_STREAM:
+            num_finished_workers += 1
+            continue
+
+        pending[item[0]] = item[1:]
+
+        while next_seq in pending:
+            input_frame, template, fragment, (label, key) = pending.pop(next_seq)
+            next_seq += 1
+            in_flight.release()
+
+            if fragment is not current_fragment:
+                save_fragment_segments()
+                current_fragment = fragment
+                segments = []
+
+            if fragment.is_cached:
+                if label == LABEL_BLANK:
+                    instrumentation.count("frames_blank")
+            else:
+                extend_segments(segments, (label, key), input_frame.pts, input_frame.pts)
+
+            # Skip over black frames
+            if label == LABEL_BLANK:
+                continue
+
+            if label == LABEL_SEPARATOR:
+                # If we are currently recording, stop the recording
+                if current_queue is not None:
+                    pipeline.put(current_queue, ("close",))
+                    current_queue = None
+                is_recording = False
+
+                current_item_id, current_modifiers = key
+                continue
+
+            # If we don't have any metadata yet, we will have to skip this frame
+            if current_item_id is None:
+                continue
+
+            # First frame of a new sequence
+            if not is_recording:
+                output_filename = clip_filename(current_item_id, current_modifiers)
+                is_recording = True
+                current_start_pts = input_frame.pts
+
+                # Every started clip counts, also if a later clip has the same filename, see `data.separators.find_clips`
+                buffer.append({
+                    "clip_idx": len(buffer),
+                    "item_id": current_item_id,
+                    "modifiers": current_modifiers,
+                    "filename": output_filename,
+                })
+
+                if is_clip_complete(output_dir, manifest.get(output_filename), buffer[-1]["clip_idx"]):
+                    log_event(log, "clip_skipped", f"Skipping completed clip (item id: {current_item_id}, modifiers: {current_modifiers}).", item_id=current_item_id, modifiers=current_modifiers, filename=output_filename)
+                    instrumentation.count("clips_skipped")
+                else:
+                    if output_filename not in filename_to_queue:
+                        filename_to_queue[output_filename] = next(round_robin)
+                    current_queue = filename_to_queue[output_filename]
+
+                    pipeline.put(current_queue, ("open", os.path.join(output_dir, output_filename), template, buffer[-1]))
+                    log_event(log, "clip_started", f"Starting new clip (item id: {current_item_id}, modifiers: {current_modifiers}).", item_id=current_item_id, modifiers=current_modifiers, filename=output_filename)
+
+            # The clip has been completed by a previous run
+            if current_queue is None:
+                continue
+
+            pipeline.put(current_queue, ("frame", input_frame, input_frame.pts - current_start_pts))
+
+    save_fragment_segments()
+
+    # Close the last output file
+    if current_queue is not None:
+        pipeline.put(current_queue, ("close",))
+
+    for encode_queue in encode_queues:
+        pipeline.put(encode_queue, END_OF_STREAM)
+
+
+def _encode_stage(pipeline: Pipeline, encode_queue, output_dir: str, manifest_lock: threading.Lock):
+    """
+    Encode and mux the frames of the clips assigned to this worker. Each clip is written to a temporary file and only moved into place and recorded in the manifest once it is complete.
+    """
+    instrumentation = get_instrumentation()
+    output_container = None
+    output_stream = None
+    output_filepath = None
+    tmp_filepath = None
+    entry = None
+    time_base = None
+
+    try:
+        while True:
+            item = pipeline.get(encode_queue)
+            if item is END_OF_STREAM:
+                return
+
+            if item[0] == "open":
+                _, output_filepath, template, entry = item
+                tmp_filepath = temporary_filepath(output_filepath)
+                output_container, output_stream = open_output_writer(tmp_filepath, template)
+                time_base = template.time_base
+                instrumentation.count("clips_started")
+
+            elif item[0] == "frame":
+                _, input_frame, rel_pts = item
+                encode_and_mux(output_container, output_stream, prepare_output_frame(input_frame, rel_pts), time_base)
+
+            elif item[0] == "close":
+                # Flush and close current video
+                encode_and_mux(output_container, output_stream, None, time_base)
+                output_container.close()
+                output_container = None
+
+                # Move the complete clip into place and record it. The encode workers share the manifest.
+                properties = commit_clip(tmp_filepath, output_filepath)
+                with manifest_lock:
+                    append_manifest(output_dir, {**entry, **properties})
+
+    except Exception as e:
+        # The partial clip is never moved into place. If another stage failed, this clip is not to blame.
+        if output_container is not None:
+            if not isinstance(e, PipelineStopped):
+                log_event(log, "clip_burnt", f"Error encoding {output_filepath}: {e}", level=logging.ERROR, exc_info=True, item_id=entry["item_id"], modifiers=entry["modifiers"], filename=entry["filename"], error=str(e))
+                instrumentation.count("clips_burnt")
+            output_container.close()
+            output_container = None
+            discard_clip(tmp_filepath)
+        raise
+
+    finally:
+        if output_container is not None:
+            output_container.close()
+
+
+def split_fragments_pipelined(
+    fragments_filepaths: list[str],
+    output_dir: str,
+    num_analysis_workers: int = DEFAULT_NUM_ANALYSIS_WORKERS,
+    num_encode_workers: int = DEFAULT_NUM_ENCODE_WORKERS,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    use_cache: bool = False,
+    cache_dir: str = None,
+    cache_validation: str = "mtime",
+):
+    """
+    Same output as `split_fragments`, but decoding, analysis and encoding run in separate threads connected by bounded queues.
+
+    PyAV and pyzbar release the GIL for most of their work, so the stages keep several cores busy on a single recording.
+
+    :param fragments_filepaths: fragments of the recording, in order
+    :param output_dir: where to write the clips
+    :param num_analysis_workers: number of threads running the blank test and QR decoding
+    :param num_encode_workers: number of threads encoding clips. Consecutive clips can be encoded concurrently.
+    :param queue_size: capacity of each queue, in frames. Together with the number of workers, this bounds the number of decoded frames in memory.
+    :param use_cache: if True, frames of fragments with a valid cached index are not analysed again. New indices are stored.
+    :param cache_dir: directory for the cached indices. If None, indices are stored next to the fragments.
+    :param cache_validation: one of `data.separator_cache.CACHE_VALIDATIONS`
+    :return: data frame with one row per clip
+    """
+    cache = {"cache_dir": cache_dir, "validation": cache_validation} if use_cache else None
+    pipeline = Pipeline()
+    analysis_queue = pipeline.new_queue(queue_size)
+    results_queue = pipeline.new_queue(queue_size)
+    encode_queues = [pipeline.new_queue(queue_size) for _ in range(num_encode_workers)]
+    in_flight = threading.Semaphore(2 * queue_size + num_analysis_workers)
+    manifest_lock = threading.Lock()
+    buffer = []
+
+    pipeline.add_stage("decode", _decode_stage, pipeline, fragments_filepaths, analysis_queue, in_flight, num_analysis_workers, cache)
+    for i in range(num_analysis_workers):
+        pipeline.add_stage(f"analysis-{i}", _analysis_stage, pipeline, analysis_queue, results_queue)
+    pipeline.add_stage("dispatch", _dispatch_stage, pipeline, results_queue, in_flight, encode_queues, output_dir, num_analysis_workers, buffer, cache)
+    for i, encode_queue in enumerate(encode_queues):
+        pipeline.add_stage(f"encode-{i}", _encode_stage, pipeline, encode_queue, output_dir, manifest_lock)
+
+    pipeline.run()
+
+    output_df = pd.DataFrame(buffer, columns=["item_id", "modifiers", "filename"])
+    return output_df
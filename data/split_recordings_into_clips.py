@@ -1,20 +1,47 @@
 import os
 import av
+import logging
 import argparse
 import pandas as pd
 from tqdm import tqdm
-from data.split_utils import is_blank_frame, try_read_qr_code, open_output_writer
-from utils.files import find_files_recursively
-from utils.logger import setup_basic_logger
+from collections.abc import Iterable
+from data.split_utils import encode_and_mux, open_output_writer, prepare_output_frame
+from data.frame_classifier import label_frames
+from data.separators import extend_segments, find_clip_boundaries, label_frame, segments_lookup, SEARCH_MODES, DEFAULT_SEARCH_STRIDE, LABEL_BLANK, LABEL_SEPARATOR
+from data.clip_manifest import append_manifest, commit_clip, discard_clip, is_clip_complete, load_manifest, temporary_filepath
+from data.separator_cache import find_clip_boundaries_cached, load_segments, save_segments, CACHE_VALIDATIONS
+from data.split_pipeline import split_fragments_pipelined, DEFAULT_NUM_ANALYSIS_WORKERS, DEFAULT_NUM_ENCODE_WORKERS, DEFAULT_QUEUE_SIZE
+from data.clip_extraction import clip_filename, write_clip, EXTRACTION_MODES
+from utils.files import scan_files_recursively
+from utils.instrumentation import get_instrumentation, instrumented
+from utils.logger import background_logging, log_event, setup_basic_logger
 
 
 log = setup_basic_logger(os.path.basename(__file__))
 
 
 def split_fragments(
-    fragments_filepaths: list[str],
+    fragments_filepaths: Iterable[str],
     output_dir: str,
+    use_cache: bool = False,
+    cache_dir: str = None,
+    cache_validation: str = "mtime",
+    classify_window: int = None,
 ):
+    """
+    Split the fragments of a recording into clips in a single pass.
+    :param fragments_filepaths: fragments of the recording, in order. Each fragment is opened once, so this can also be an iterator over fragments that are still being downloaded, see `data.stream_split`.
+    :param output_dir: where to write the clips
+    :param use_cache: if True, frames of fragments with a valid cached index are not analysed again. New indices are stored.
+    :param cache_dir: directory for the cached indices. If None, indices are stored next to the fragments.
+    :param cache_validation: one of `data.separator_cache.CACHE_VALIDATIONS`
+    :param classify_window: if given, frames are labelled in windows of this many frames with `data.frame_classifier`, which runs the blank test on stacked Y samples and only decodes QR codes when the scene changes. By default, every frame is labelled with `label_frame`.
+    :return: data frame with one row per clip
+    """
+    # Clips that were completed by a previous run are not encoded again
+    manifest = load_manifest(output_dir)
+    instrumentation = get_instrumentation()
+
     current_item_id = None
     current_modifiers = None
 
@@ -22,44 +49,64 @@ def split_fragments(
 
     output_container = None
     output_stream = None
+    output_filepath = None
+    tmp_filepath = None
     current_start_pts = None
 
     buffer = []
 
     for fragment_filepath in tqdm(fragments_filepaths, desc="Processing fragments", unit="fragment"):
 
+        # Reuse the labels from a previous run. The single-pass splitter analyses every frame, which corresponds to the linear search.
+        cached_segments = None
+        if use_cache:
+            cached_segments = load_segments(fragment_filepath, mode="linear", stride=1, cache_dir=cache_dir, validation=cache_validation)
+        lookup_label = segments_lookup(cached_segments) if cached_segments is not None else None
+        segments = []
+
         # Open the video file
         with av.open(fragment_filepath) as input_container:
             input_stream = input_container.streams.video[0]
 
+            # Blank test and QR decoding. The analysis runs on views of the decoded planes, without converting to RGB.
+            frames = instrumentation.timed_iter("decode", input_container.decode(video=0))
+            if lookup_label is not None:
+                labelled_frames = ((frame, lookup_label(frame.pts)) for frame in frames)
+            elif classify_window:
+                labelled_frames = label_frames(frames, window_size=classify_window)
+            else:
+                labelled_frames = ((frame, label_frame(frame)) for frame in frames)
+
             # Decode input fragment frame by frame
-            for frame_idx, input_frame in enumerate(input_container.decode(video=0)):
+            for frame_idx, (input_frame, (label, key)) in enumerate(labelled_frames):
 
-                # Convert frame to RGB
-                frame_rgb = input_frame.to_ndarray(format="rgb24")
+                if lookup_label is not None:
+                    if label == LABEL_BLANK:
+                        instrumentation.count("frames_blank")
+                else:
+                    extend_segments(segments, (label, key), input_frame.pts, input_frame.pts)
 
                 # Skip over black frames
-                if is_blank_frame(frame_rgb):
+                if label == LABEL_BLANK:
                     continue
 
-                # Check if the frame is a separator frame
-                metadata = try_read_qr_code(frame_rgb)
-
-                if metadata is not None and isinstance(metadata, dict) and "item_id" in metadata:
+                if label == LABEL_SEPARATOR:
                     # It is a metadata frame
 
                     # If we are currently recording, stop the recording
                     if is_recording:
-                        # Flush and close current video
-                        for packet in output_stream.encode():
-                            packet.time_base = input_stream.time_base
-                            output_container.mux(packet)
-                        output_container.close()
+                        if output_container is not None:
+                            # Flush and close current video
+                            encode_and_mux(output_container, output_stream, None, input_stream.time_base)
+                            output_container.close()
+                            output_container = None
+
+                            # Move the complete clip into place and record it
+                            append_manifest(output_dir, {**buffer[-1], **commit_clip(tmp_filepath, output_filepath)})
                         is_recording = False
 
                     # Decode QR code
-                    current_item_id = metadata["item_id"]
-                    current_modifiers = metadata["modifiers"]
+                    current_item_id, current_modifiers = key
 
                     # Continue to next frame
                     continue
@@ -74,48 +121,121 @@ def split_fragments(
 
                     # First frame of a new sequence
                     if not is_recording:
-                        # Create new output writer
-                        output_filename = f"{current_item_id}_{current_modifiers}.mp4"
+                        output_filename = clip_filename(current_item_id, current_modifiers)
                         output_filepath = os.path.join(output_dir, output_filename)
-                        output_container, output_stream = open_output_writer(output_filepath, input_stream)
                         is_recording = True
                         current_start_pts = input_frame.pts
-                        log.info(f"Starting new clip (item id: {current_item_id}, modifiers: {current_modifiers}).")
 
+                        # Every started clip counts, also if a later clip has the same filename, see `data.separators.find_clips`
                         buffer.append({
+                            "clip_idx": len(buffer),
                             "item_id": current_item_id,
                             "modifiers": current_modifiers,
                             "filename": output_filename,
                         })
 
-                    # Create a new frame with the pixel values of the input frame
-                    output_frame = av.VideoFrame.from_ndarray(input_frame.to_ndarray(), format=input_frame.format.name)
+                        if is_clip_complete(output_dir, manifest.get(output_filename), buffer[-1]["clip_idx"]):
+                            log_event(log, "clip_skipped", f"Skipping completed clip (item id: {current_item_id}, modifiers: {current_modifiers}).", item_id=current_item_id, modifiers=current_modifiers, filename=output_filename)
+                            instrumentation.count("clips_skipped")
+                        else:
+                            # Create new output writer. The clip is written to a temporary file until it is complete.
+                            tmp_filepath = temporary_filepath(output_filepath)
+                            output_container, output_stream = open_output_writer(tmp_filepath, input_stream)
+                            log_event(log, "clip_started", f"Starting new clip (item id: {current_item_id}, modifiers: {current_modifiers}).", item_id=current_item_id, modifiers=current_modifiers, filename=output_filename)
+                            instrumentation.count("clips_started")
+
+                    # The clip has been completed by a previous run
+                    if output_container is None:
+                        continue
 
-                    # Calculate new PTS relative to the first frame of the clip
+                    # Calculate new PTS relative to the first frame of the clip and pass the decoded frame on to the encoder
                     rel_pts = input_frame.pts - current_start_pts
-                    output_frame.pts = rel_pts
+                    output_frame = prepare_output_frame(input_frame, rel_pts)
 
                     # Encode and write to output
                     try:
                         # Encode and mux
-                        for packet in output_stream.encode(output_frame):
-                            packet.time_base = input_stream.time_base
-                            output_container.mux(packet)
+                        encode_and_mux(output_container, output_stream, output_frame, input_stream.time_base)
 
                     except Exception as e:
-                        log.exception(f"Error encoding frame {frame_idx} in {output_filepath}: {e}")
+                        log_event(log, "clip_burnt", f"Error encoding frame {frame_idx} in {output_filepath}: {e}", level=logging.ERROR, exc_info=True, item_id=current_item_id, modifiers=current_modifiers, filename=output_filename, error=str(e))
+                        instrumentation.count("clips_burnt")
+                        output_container.close()
+                        discard_clip(tmp_filepath)
                         raise e
 
+        if use_cache and lookup_label is None:
+            save_segments(fragment_filepath, segments, mode="linear", stride=1, cache_dir=cache_dir, validation=cache_validation)
+
+        instrumentation.maybe_log_snapshot(log)
+
     # Close the last output file
-    if is_recording:
+    if output_container is not None:
         # Flush residue from this fragment
-        for packet in output_stream.encode():
-            packet.time_base = input_stream.time_base
-            output_container.mux(packet)
+        encode_and_mux(output_container, output_stream, None, input_stream.time_base)
 
         output_container.close()
+        append_manifest(output_dir, {**buffer[-1], **commit_clip(tmp_filepath, output_filepath)})
+
+    output_df = pd.DataFrame(buffer, columns=["item_id", "modifiers", "filename"])
+    return output_df
 
-    output_df = pd.DataFrame(buffer)
+
+def split_fragments_by_boundaries(
+    fragments_filepaths: list[str],
+    output_dir: str,
+    search_mode: str = "linear",
+    search_stride: int = DEFAULT_SEARCH_STRIDE,
+    extraction_mode: str = "reencode",
+    use_cache: bool = False,
+    cache_dir: str = None,
+    cache_validation: str = "mtime",
+):
+    """
+    Two-step alternative to `split_fragments`: first find all clip boundaries, then extract each clip.
+    :param fragments_filepaths: fragments of the recording, in order
+    :param output_dir: where to write the clips
+    :param search_mode: boundary search mode, see `data.separators.SEARCH_MODES`
+    :param search_stride: distance between probed frames
+    :param extraction_mode: "reencode" to re-encode all frames losslessly, "smart" to copy the GOPs inside each clip and only re-encode the boundary GOPs
+    :param use_cache: if True, reuse and store the fragment indices, see `data.separator_cache`
+    :param cache_dir: directory for the cached indices. If None, indices are stored next to the fragments.
+    :param cache_validation: one of `data.separator_cache.CACHE_VALIDATIONS`
+    :return: data frame with one row per clip
+    """
+    if use_cache:
+        clips = find_clip_boundaries_cached(fragments_filepaths, mode=search_mode, stride=search_stride, cache_dir=cache_dir, validation=cache_validation)
+    else:
+        clips = find_clip_boundaries(fragments_filepaths, mode=search_mode, stride=search_stride)
+
+    # Clips that were completed by a previous run are not extracted again
+    manifest = load_manifest(output_dir)
+    instrumentation = get_instrumentation()
+
+    buffer = []
+    for clip in tqdm(clips, desc="Extracting clips", unit="clip"):
+        clip_idx = clip["clip_idx"]
+        output_filename = clip_filename(clip["item_id"], clip["modifiers"])
+
+        entry = manifest.get(output_filename)
+        if is_clip_complete(output_dir, entry, clip_idx):
+            log_event(log, "clip_skipped", f"Skipping completed clip (item id: {clip['item_id']}, modifiers: {clip['modifiers']}).", item_id=clip["item_id"], modifiers=clip["modifiers"], filename=output_filename)
+            instrumentation.count("clips_skipped")
+        else:
+            log_event(log, "clip_started", f"Extracting clip (item id: {clip['item_id']}, modifiers: {clip['modifiers']}).", item_id=clip["item_id"], modifiers=clip["modifiers"], filename=output_filename)
+            entry = write_clip(fragments_filepaths, clip, clip_idx, output_dir, extraction_mode=extraction_mode)
+            if entry is None:
+                continue
+            append_manifest(output_dir, entry)
+
+        instrumentation.maybe_log_snapshot(log)
+        buffer.append({
+            "item_id": clip["item_id"],
+            "modifiers": clip["modifiers"],
+            "filename": output_filename,
+        })
+
+    output_df = pd.DataFrame(buffer, columns=["item_id", "modifiers", "filename"])
     return output_df
 
 
@@ -124,16 +244,74 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Annotate recorded frames")
     parser.add_argument("--input_dir", type=str, help="Directory where to search for fragments", default="/media/bene/getreal/video-streaming-linux/recordings/27005680-3421-436a-bdc1-06fecc993edd")
     parser.add_argument("--output_dir", type=str, help="Directory where to save the output fragments", default="/tmp")
+    parser.add_argument("--boundary_search", type=str, help="Find all clip boundaries first with the given search mode, then extract the clips. By default, the fragments are split in a single pass. The stride mode requires separators and blank runs to be displayed for at least the stride, the keyframes mode for longer than the keyframe interval.", choices=SEARCH_MODES, default=None)
+    parser.add_argument("--search_stride", type=int, help="Distance between analysed frames for the stride and keyframes boundary searches", default=DEFAULT_SEARCH_STRIDE)
+    parser.add_argument("--extraction", type=str, help="How to write the clips when using --boundary_search. \"smart\" copies the compressed GOPs inside each clip and only re-encodes the partial GOPs at the boundaries.", choices=EXTRACTION_MODES, default="reencode")
+    parser.add_argument("--pipeline", action="store_true", help="Split in a single pass, but run decoding, analysis and encoding in separate threads")
+    parser.add_argument("--num_analysis_workers", type=int, help="Number of analysis threads in pipeline mode", default=DEFAULT_NUM_ANALYSIS_WORKERS)
+    parser.add_argument("--num_encode_workers", type=int, help="Number of encoder threads in pipeline mode", default=DEFAULT_NUM_ENCODE_WORKERS)
+    parser.add_argument("--queue_size", type=int, help="Capacity of the queues between pipeline stages, in frames", default=DEFAULT_QUEUE_SIZE)
+    parser.add_argument("--classify_window", type=int, help="In the single pass, label frames in windows of this many frames and only decode QR codes when the scene changes", default=None)
+    parser.add_argument("--cache", action="store_true", help="Reuse and store per-fragment separator indices, so that unchanged fragments are not analysed again")
+    parser.add_argument("--cache_dir", type=str, help="Directory for the separator indices, used with --cache. By default, they are stored next to the fragments.", default=None)
+    parser.add_argument("--cache_validation", type=str, help="How to detect changed fragments", choices=CACHE_VALIDATIONS, default="mtime")
+    parser.add_argument("--listing_cache_dir", type=str, help="Directory for a cached listing of the input directory. Speeds up repeated runs on large trees.", default=None)
+    parser.add_argument("--report_json", type=str, help="Write the per-stage timers and counters of the run to this JSON file", default=None)
+    parser.add_argument("--snapshot_interval", type=float, help="Log the per-stage timers and counters every this many seconds", default=None)
+    parser.add_argument("--background_logging", action="store_true", help="Write log messages from a background thread and rate-limit repeated messages")
+    parser.add_argument("--events_jsonl", type=str, help="Append per-clip events to this JSON-lines file. Implies --background_logging.", default=None)
     args = vars(parser.parse_args())
 
-    fragments_filepaths = sorted(list(find_files_recursively(args["input_dir"], file_extensions=[".mkv"])))
+    fragments_filepaths = scan_files_recursively(args["input_dir"], file_extensions=[".mkv"], cache_dir=args["listing_cache_dir"])
 
     # fragments_attributes_df = extract_video_attributes(fragments_filepaths)
     # assert len(fragments_attributes_df["width"].unique()) == 1 and len(fragments_attributes_df["height"].unique()) == 1, "Expected all fragments to have the same width and height"
 
-    output_videos_df = split_fragments(fragments_filepaths=fragments_filepaths, output_dir=args["output_dir"])
+    # Instrumentation is disabled unless a report or snapshots are requested
+    enable_instrumentation = args["report_json"] is not None or args["snapshot_interval"] is not None
+    enable_background_logging = args["background_logging"] or args["events_jsonl"] is not None
+    with background_logging(enable_background_logging, events_filepath=args["events_jsonl"]), instrumented(enable_instrumentation, snapshot_interval=args["snapshot_interval"]) as instrumentation:
+        if args["boundary_search"] is not None:
+            output_videos_df = split_fragments_by_boundaries(
+                fragments_filepaths=fragments_filepaths,
+                output_dir=args["output_dir"],
+                search_mode=args["boundary_search"],
+                search_stride=args["search_stride"],
+                extraction_mode=args["extraction"],
+                use_cache=args["cache"],
+                cache_dir=args["cache_dir"],
+                cache_validation=args["cache_validation"],
+            )
+        elif args["pipeline"]:
+            output_videos_df = split_fragments_pipelined(
+                fragments_filepaths=fragments_filepaths,
+                output_dir=args["output_dir"],
+                num_analysis_workers=args["num_analysis_workers"],
+                num_encode_workers=args["num_encode_workers"],
+                queue_size=args["queue_size"],
+                use_cache=args["cache"],
+                cache_dir=args["cache_dir"],
+                cache_validation=args["cache_validation"],
+            )
+        else:
+            output_videos_df = split_fragments(
+                fragments_filepaths=fragments_filepaths,
+                output_dir=args["output_dir"],
+                use_cache=args["cache"],
+                cache_dir=args["cache_dir"],
+                cache_validation=args["cache_validation"],
+                classify_window=args["classify_window"],
+            )
+
+    if instrumentation.enabled:
+        log.info(instrumentation.summary())
+    if args["report_json"] is not None:
+        instrumentation.write_report(args["report_json"], args=args)
+        log.info(f"Stored instrumentation report to \"{args['report_json']}\"")
     log.info(f"Stored individual videos to \"{args['output_dir']}\"")
 
+    # Replace the list of clips in one step
     output_csv_filepath = os.path.join(args["output_dir"], "video_clips.csv")
-    output_videos_df.to_csv(output_csv_filepath, index=False)
+    output_videos_df.to_csv(output_csv_filepath + ".tmp", index=False)
+    os.replace(output_csv_filepath + ".tmp", output_csv_filepath)
 
@@ -1,170 +1,215 @@
 import os
-import av
+import logging
 import argparse
+import pandas as pd
 from tqdm import tqdm
-from utils.files import find_files_recursively
-from utils.logger import setup_basic_logger
-from threading import Thread, Lock
-from data.split_utils import is_blank_frame, try_read_qr_code, open_output_writer
+from functools import partial
+from multiprocessing import Pool
+from utils.files import scan_files_recursively
+from utils.instrumentation import get_instrumentation, instrumented
+from utils.logger import background_logging, log_event, setup_basic_logger
+from data.separators import scan_fragment, find_clips, new_counters, SEARCH_MODES, DEFAULT_SEARCH_STRIDE
+from data.separator_cache import scan_fragment_cached, CACHE_VALIDATIONS
+from data.clip_extraction import clip_filename, write_clip, EXTRACTION_MODES
+from data.clip_manifest import append_manifest, is_clip_complete, load_manifest
 
 
 log = setup_basic_logger(os.path.basename(__file__))
 
 
-def worker(
-    worker_name: str,
-    fragments_filepaths: list[str],
-    output_dir: str,
-    shared_set: set[str],
-    lock: Lock,
-    pbar: tqdm) -> None:
-
-    current_item_id = None
-    current_modifiers = None
-
-    is_recording = False
-
-    output_container = None
-    output_stream = None
-    current_start_pts = None
-
-    for fragment_filepath in tqdm(fragments_filepaths, desc=f"[{worker_name}] Processing fragments", unit="fragment", disable=True):
-
-        # Open the video file
-        with av.open(fragment_filepath) as input_container:
-            input_stream = input_container.streams.video[0]
-
-            # Decode input fragment frame by frame
-            for frame_idx, input_frame in enumerate(input_container.decode(video=0)):
-
-                # Convert frame to RGB
-                frame_rgb = input_frame.to_ndarray(format="rgb24")
-
-                # Skip over black frames
-                if is_blank_frame(frame_rgb):
-                    continue
-
-                # Check if the frame is a separator frame
-                metadata = try_read_qr_code(frame_rgb)
-
-                if metadata is not None and isinstance(metadata, dict) and "item_id" in metadata:
-                    # It is a metadata frame
-
-                    # If we are currently recording, stop the recording
-                    if is_recording:
-                        # Flush and close current video
-                        for packet in output_stream.encode():
-                            packet.time_base = input_stream.time_base
-                            output_container.mux(packet)
-                        output_container.close()
-                        is_recording = False
-
-                    if (current_item_id == metadata["item_id"]) and (current_modifiers == metadata["modifiers"]):
-                        # We already saw this metadata frame
-                        continue
-
-                    # Decode QR code
-                    current_item_id = metadata["item_id"]
-                    current_modifiers = metadata["modifiers"]
-
-                    # Check the set
-                    video_id = f"{fragment_filepath}_{current_item_id}_{current_modifiers}"
-                    with lock:
-                        if video_id in shared_set:
-                            # Another thread already started processing that video. This thread's job is done.
-                            log.info(f"[Thread {worker_name}] Video {video_id} already processed.]")
-                            return
-
-                        else:
-                            shared_set.add(video_id)
-                            pbar.update(1)
-
-                    # Continue to next frame
-                    continue
+def scan_fragment_job(fragment_filepath: str, search_mode: str, search_stride: int, use_cache: bool, cache_dir: str, cache_validation: str, instrument: bool) -> tuple[list[dict], dict[str, int], dict | None]:
+    """
+    Pass 1: find the separators in one fragment. Fragments are independent, so they can be scanned in any order.
+    :param instrument: if True, collect timers and counters in this worker, see `utils.instrumentation`
+    :return: tuple (segments, analysis counters, instrumentation snapshot or None)
+    """
+    counters = new_counters()
+    with instrumented(instrument) as instrumentation:
+        if use_cache:
+            segments = scan_fragment_cached(fragment_filepath, mode=search_mode, stride=search_stride, counters=counters, cache_dir=cache_dir, validation=cache_validation)
+        else:
+            segments = scan_fragment(fragment_filepath, mode=search_mode, stride=search_stride, counters=counters)
+    return segments, counters, instrumentation.snapshot()
 
-                else:
-                    # This is not a metadata frame
 
-                    # If we don't have any metadata yet, we will have to skip this frame
-                    if current_item_id is None:
-                        # log.info(f"[{worker_name}] Need to skip frame {frame_idx} because we haven't seen a metadata frame yet.")
-                        continue
+def extract_clip_job(indexed_clip: tuple[int, dict], fragments_filepaths: list[str], output_dir: str, extraction_mode: str, instrument: bool) -> tuple[dict | None, dict | None]:
+    """
+    Pass 2: extract one clip. Each clip is decoded exactly once, by exactly one worker. The clip is only moved into place once it is complete.
+    :param indexed_clip: tuple (position of the clip in the recording, clip)
+    :param instrument: if True, collect timers and counters in this worker, see `utils.instrumentation`
+    :return: tuple (manifest entry, instrumentation snapshot or None). The entry is None if the clip could not be written, see `data.clip_extraction.write_clip`.
+    """
+    clip_idx, clip = indexed_clip
 
-                    # First frame of a new sequence
-                    if not is_recording:
-                        # Create new output writer
-                        output_filename = f"{current_item_id}_{current_modifiers}.mp4"
-                        output_filepath = os.path.join(output_dir, output_filename)
-                        output_container, output_stream = open_output_writer(output_filepath, input_stream)
-                        is_recording = True
-                        current_start_pts = input_frame.pts
-                        log.info(f"[Thread {worker_name}] Starting new clip (item id: {current_item_id}, modifiers: {current_modifiers}). Output filepath is \"{output_filepath}\".")
+    with instrumented(instrument) as instrumentation:
+        try:
+            entry = write_clip(fragments_filepaths, clip, clip_idx, output_dir, extraction_mode=extraction_mode)
 
-                    # Create a new frame with the pixel values of the input frame
-                    output_frame = av.VideoFrame.from_ndarray(input_frame.to_ndarray(), format=input_frame.format.name)
+        except Exception as e:
+            # This recording is burnt. The partial file has already been removed.
+            log_event(log, "clip_burnt", f"Error extracting clip (item id: {clip['item_id']}, modifiers: {clip['modifiers']}): {e}", level=logging.ERROR, exc_info=True, item_id=clip["item_id"], modifiers=clip["modifiers"], error=str(e))
+            entry = None
 
-                    # Calculate new PTS relative to the first frame of the clip
-                    rel_pts = input_frame.pts - current_start_pts
-                    output_frame.pts = rel_pts
+    return entry, instrumentation.snapshot()
 
-                    # Encode and write to output
-                    try:
-                        # Encode and mux
-                        for packet in output_stream.encode(output_frame):
-                            packet.time_base = input_stream.time_base
-                            output_container.mux(packet)
 
-                    except Exception as e:
-                        log.exception(f"[Thread {worker_name}] Error encoding frame {frame_idx} of fragment {fragment_filepath} to {output_filepath}: {e}")
-
-                        # Stop recording
-                        current_item_id = None
-                        current_modifiers = None
-                        is_recording = False
-
-                        # This recording is burnt
-                        if os.path.exists(output_filepath):
-                            os.remove(output_filepath)
-
-                        # Skip ahead until we find the next metadata frame
-
-    # Close the last output file
-    if is_recording:
-        # Flush residue from this fragment
-        for packet in output_stream.encode():
-            packet.time_base = input_stream.time_base
-            output_container.mux(packet)
-
-        output_container.close()
+def build_clip_index(
+    fragments_filepaths: list[str],
+    num_workers: int,
+    search_mode: str = "linear",
+    search_stride: int = DEFAULT_SEARCH_STRIDE,
+    use_cache: bool = False,
+    cache_dir: str = None,
+    cache_validation: str = "mtime",
+) -> list[dict]:
+    """
+    Pass 1: scan all fragments in parallel and derive the clip boundaries. Separators that cross fragment boundaries are merged by `find_clips`.
+    :param fragments_filepaths: fragments of the recording, in order
+    :param num_workers: number of processes
+    :param search_mode: boundary search mode, see `data.separators.SEARCH_MODES`
+    :param search_stride: distance between probed frames
+    :param use_cache: if True, reuse and store the fragment indices, see `data.separator_cache`
+    :param cache_dir: directory for the cached indices. If None, indices are stored next to the fragments.
+    :param cache_validation: one of `data.separator_cache.CACHE_VALIDATIONS`
+    :return: list of clips, see `data.separators.find_clips`
+    """
+    # Workers collect their own timers and counters, which are merged into the instrumentation of this process
+    instrumentation = get_instrumentation()
+    job = partial(scan_fragment_job, search_mode=search_mode, search_stride=search_stride, use_cache=use_cache, cache_dir=cache_dir, cache_validation=cache_validation, instrument=instrumentation.enabled)
+
+    fragments_segments = []
+    counters = new_counters()
+    with Pool(num_workers) as pool:
+        # imap keeps the results in fragment order
+        for segments, fragment_counters, snapshot in tqdm(pool.imap(job, fragments_filepaths), total=len(fragments_filepaths), desc="Scanning fragments", unit="fragment"):
+            fragments_segments.append(segments)
+            for k, v in fragment_counters.items():
+                counters[k] += v
+            instrumentation.merge(snapshot)
+            instrumentation.maybe_log_snapshot(log)
+
+    clips = find_clips(fragments_segments)
+    log.info(f"Found {len(clips)} clips with {counters['qr_decodes']} QR decode calls, {counters['blank_tests']} blank tests and {counters['cache_hits']} cached fragments (mode: {search_mode}).")
+    return clips
+
+
+def split_fragments_parallel(
+    fragments_filepaths: list[str],
+    output_dir: str,
+    num_workers: int,
+    search_mode: str = "linear",
+    search_stride: int = DEFAULT_SEARCH_STRIDE,
+    extraction_mode: str = "reencode",
+    use_cache: bool = False,
+    cache_dir: str = None,
+    cache_validation: str = "mtime",
+) -> pd.DataFrame:
+    """
+    Split a recording into clips in two passes. Pass 1 builds the clip index, pass 2 extracts every clip as an independent job.
+    :param fragments_filepaths: fragments of the recording, in order
+    :param output_dir: where to write the clips
+    :param num_workers: number of processes
+    :param search_mode: boundary search mode, see `data.separators.SEARCH_MODES`
+    :param search_stride: distance between probed frames
+    :param extraction_mode: one of `data.clip_extraction.EXTRACTION_MODES`
+    :param use_cache: if True, reuse and store the fragment indices, see `data.separator_cache`
+    :param cache_dir: directory for the cached indices. If None, indices are stored next to the fragments.
+    :param cache_validation: one of `data.separator_cache.CACHE_VALIDATIONS`
+    :return: data frame with one row per written clip
+    """
+    clips = build_clip_index(
+        fragments_filepaths,
+        num_workers=num_workers,
+        search_mode=search_mode,
+        search_stride=search_stride,
+        use_cache=use_cache,
+        cache_dir=cache_dir,
+        cache_validation=cache_validation,
+    )
+
+    # Clips that were completed by a previous run are not extracted again
+    manifest = load_manifest(output_dir)
+    instrumentation = get_instrumentation()
+
+    buffer = []
+    jobs = []
+    for clip in clips:
+        clip_idx = clip["clip_idx"]
+        entry = manifest.get(clip_filename(clip["item_id"], clip["modifiers"]))
+        if is_clip_complete(output_dir, entry, clip_idx):
+            buffer.append(entry)
+        else:
+            jobs.append((clip_idx, clip))
+
+    if buffer:
+        log.info(f"Skipping {len(buffer)} clips completed by a previous run.")
+        instrumentation.count("clips_skipped", len(buffer))
+
+    job = partial(extract_clip_job, fragments_filepaths=fragments_filepaths, output_dir=output_dir, extraction_mode=extraction_mode, instrument=instrumentation.enabled)
+
+    # Long clips first, so that a long clip does not end up as the last job
+    jobs = sorted(jobs, key=lambda indexed_clip: indexed_clip[1]["end_fragment_idx"] - indexed_clip[1]["start_fragment_idx"], reverse=True)
+
+    with Pool(num_workers) as pool:
+        for entry, snapshot in tqdm(pool.imap_unordered(job, jobs), total=len(jobs), desc="Video clips", unit="clip"):
+            instrumentation.merge(snapshot)
+            instrumentation.maybe_log_snapshot(log)
+            if entry is not None:
+                # Only the main process writes to the manifest
+                append_manifest(output_dir, entry)
+                buffer.append(entry)
+
+    # Restore the recording order
+    buffer = sorted(buffer, key=lambda entry: entry["clip_idx"])
+
+    output_df = pd.DataFrame(buffer, columns=["item_id", "modifiers", "filename"])
+    return output_df
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Annotate recorded frames")
     parser.add_argument("--input_dir", type=str, help="Directory where to search for fragments", default="/tmp/66e4fbe5-7170-4d61-8585-90137782784a")
     parser.add_argument("--output_dir", type=str, help="Directory where to save the output fragments", default="/tmp")
-    parser.add_argument("--num_workers", type=int, help="Number of workers", default=8)
+    parser.add_argument("--num_workers", type=int, help="Number of worker processes", default=8)
+    parser.add_argument("--boundary_search", type=str, help="Search mode for the separators. The stride mode requires separators and blank runs to be displayed for at least the stride, the keyframes mode for longer than the keyframe interval.", choices=SEARCH_MODES, default="linear")
+    parser.add_argument("--search_stride", type=int, help="Distance between analysed frames for the stride and keyframes boundary searches", default=DEFAULT_SEARCH_STRIDE)
+    parser.add_argument("--extraction", type=str, help="How to write the clips. \"smart\" copies the compressed GOPs inside each clip and only re-encodes the partial GOPs at the boundaries.", choices=EXTRACTION_MODES, default="reencode")
+    parser.add_argument("--cache", action="store_true", help="Reuse and store per-fragment separator indices, so that unchanged fragments are not analysed again")
+    parser.add_argument("--cache_dir", type=str, help="Directory for the separator indices, used with --cache. By default, they are stored next to the fragments.", default=None)
+    parser.add_argument("--cache_validation", type=str, help="How to detect changed fragments", choices=CACHE_VALIDATIONS, default="mtime")
+    parser.add_argument("--listing_cache_dir", type=str, help="Directory for a cached listing of the input directory. Speeds up repeated runs on large trees.", default=None)
+    parser.add_argument("--report_json", type=str, help="Write the per-stage timers and counters of the run to this JSON file", default=None)
+    parser.add_argument("--snapshot_interval", type=float, help="Log the per-stage timers and counters every this many seconds", default=None)
+    parser.add_argument("--background_logging", action="store_true", help="Write log messages from a background thread and rate-limit repeated messages. Worker processes send their messages to this thread and are rate-limited separately.")
+    parser.add_argument("--events_jsonl", type=str, help="Append per-clip events to this JSON-lines file. Implies --background_logging.", default=None)
     args = vars(parser.parse_args())
 
-    fragments_filepaths = sorted(list(find_files_recursively(args["input_dir"], file_extensions=[".mkv"])))
-
-    shared_set: set[str] = set()
-    lock = Lock()
-
-    with tqdm(total=400, desc="Video clips") as pbar:
-        threads: list[Thread] = []
-
-        for i in range(args["num_workers"]):
-            offset = len(fragments_filepaths) // args["num_workers"] * i
-            worker_fragments = fragments_filepaths[offset:]
-            t = Thread(
-                target=worker,
-                args=(str(i), worker_fragments, args["output_dir"], shared_set, lock, pbar)
-            )
-            t.start()
-            threads.append(t)
-
-        # Wait for all workers to finish
-        for t in threads:
-            t.join()
-
-    print(f"Length of final set: {len(shared_set)}")
+    fragments_filepaths = scan_files_recursively(args["input_dir"], file_extensions=[".mkv"], cache_dir=args["listing_cache_dir"])
+
+    # Instrumentation is disabled unless a report or snapshots are requested
+    enable_instrumentation = args["report_json"] is not None or args["snapshot_interval"] is not None
+    enable_background_logging = args["background_logging"] or args["events_jsonl"] is not None
+    with background_logging(enable_background_logging, events_filepath=args["events_jsonl"]), instrumented(enable_instrumentation, snapshot_interval=args["snapshot_interval"]) as instrumentation:
+        output_videos_df = split_fragments_parallel(
+            fragments_filepaths=fragments_filepaths,
+            output_dir=args["output_dir"],
+            num_workers=args["num_workers"],
+            search_mode=args["boundary_search"],
+            search_stride=args["search_stride"],
+            extraction_mode=args["extraction"],
+            use_cache=args["cache"],
+            cache_dir=args["cache_dir"],
+            cache_validation=args["cache_validation"],
+        )
+
+    if instrumentation.enabled:
+        log.info(instrumentation.summary())
+    if args["report_json"] is not None:
+        instrumentation.write_report(args["report_json"], args=args)
+        log.info(f"Stored instrumentation report to \"{args['report_json']}\"")
+    log.info(f"Stored {len(output_videos_df)} video clips to \"{args['output_dir']}\"")
+
+    # Replace the list of clips in one step
+    output_csv_filepath = os.path.join(args["output_dir"], "video_clips.csv")
+    output_videos_df.to_csv(output_csv_filepath + ".tmp", index=False)
+    os.replace(output_csv_filepath + ".tmp", output_csv_filepath)
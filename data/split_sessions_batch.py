@@ -0,0 +1,174 @@
+import os
+import time
+import json
+import argparse
+import pandas as pd
+from tqdm import tqdm
+from functools import partial
+from multiprocessing import Pool
+from data.clip_extraction import EXTRACTION_MODES
+from data.clip_manifest import load_manifest, MANIFEST_FILENAME
+from data.separators import SEARCH_MODES, DEFAULT_SEARCH_STRIDE
+from data.separator_cache import CACHE_VALIDATIONS
+from data.split_recordings_into_clips import split_fragments, split_fragments_by_boundaries
+from utils.files import scan_files_recursively
+from utils.logger import setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+FRAGMENT_EXTENSIONS = [".mkv"]
+
+
+def find_sessions(root_dir: str, cache_dir: str = None) -> pd.DataFrame:
+    """
+    Find all recording sessions below a root directory. A session is a directory that directly contains fragments.
+    :param root_dir: directory to search recursively
+    :param cache_dir: directory for a cached listing, see `utils.files.scan_files_recursively`
+    :return: data frame with one row per session and columns session, input_dir, fragments_filepaths, num_fragments, num_bytes
+    """
+    sessions = {}
+    for fragment_filepath in scan_files_recursively(root_dir, file_extensions=FRAGMENT_EXTENSIONS, cache_dir=cache_dir):
+        sessions.setdefault(os.path.dirname(fragment_filepath), []).append(fragment_filepath)
+
+    buffer = []
+    for input_dir, fragments_filepaths in sorted(sessions.items()):
+        buffer.append({
+            "session": os.path.relpath(input_dir, root_dir),
+            "input_dir": input_dir,
+            "fragments_filepaths": sorted(fragments_filepaths),
+            "num_fragments": len(fragments_filepaths),
+            "num_bytes": sum(os.path.getsize(fragment_filepath) for fragment_filepath in fragments_filepaths),
+        })
+
+    return pd.DataFrame(buffer, columns=["session", "input_dir", "fragments_filepaths", "num_fragments", "num_bytes"])
+
+
+def split_session_job(session: dict, output_root: str, split_kwargs: dict) -> dict:
+    """
+    Split one session into clips. Errors are caught, so that one bad recording does not abort the batch.
+    :param session: row of `find_sessions`
+    :param output_root: the clips are written to a subdirectory with the session's name
+    :param split_kwargs: arguments to the splitter. If search_mode is given, `split_fragments_by_boundaries` is used, otherwise `split_fragments`.
+    :return: dict with the session's name, status, number of clips, run time and error message
+    """
+    output_dir = os.path.join(output_root, session["session"])
+    start_time = time.perf_counter()
+
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+
+        if split_kwargs.get("search_mode") is not None:
+            output_videos_df = split_fragments_by_boundaries(session["fragments_filepaths"], output_dir, **split_kwargs)
+        else:
+            split_kwargs = {k: v for k, v in split_kwargs.items() if k not in ("search_mode", "search_stride", "extraction_mode")}
+            output_videos_df = split_fragments(session["fragments_filepaths"], output_dir, **split_kwargs)
+
+        # Replace the list of clips in one step
+        output_csv_filepath = os.path.join(output_dir, "video_clips.csv")
+        output_videos_df.to_csv(output_csv_filepath + ".tmp", index=False)
+        os.replace(output_csv_filepath + ".tmp", output_csv_filepath)
+
+        status, error, num_clips = "done", None, len(output_videos_df)
+
+    except Exception as e:
+        log.exception(f"Error splitting session \"{session['session']}\": {e}")
+        status, error, num_clips = "failed", f"{type(e).__name__}: {e}", 0
+
+    return {
+        "session": session["session"],
+        "status": status,
+        "num_clips": num_clips,
+        "num_bytes": session["num_bytes"],
+        "seconds": time.perf_counter() - start_time,
+        "error": error,
+    }
+
+
+def split_sessions(sessions_df: pd.DataFrame, output_root: str, num_workers: int, **split_kwargs) -> pd.DataFrame:
+    """
+    Split many sessions in parallel. Each worker process handles one session at a time.
+
+    Sessions are scheduled largest first, so that a long recording does not start at the end of the batch. Progress and ETA are reported in fragment bytes.
+
+    :param sessions_df: sessions, see `find_sessions`
+    :param output_root: the clips of each session are written to a subdirectory with the session's name
+    :param num_workers: number of processes
+    :param split_kwargs: arguments to the splitter, see `split_session_job`
+    :return: data frame with one row per session, see `split_session_job`
+    """
+    sessions = sessions_df.sort_values("num_bytes", ascending=False).to_dict("records")
+    job = partial(split_session_job, output_root=output_root, split_kwargs=split_kwargs)
+
+    buffer = []
+    with Pool(num_workers) as pool:
+        with tqdm(total=int(sessions_df["num_bytes"].sum()), desc="Sessions", unit="B", unit_scale=True) as pbar:
+            for result in pool.imap_unordered(job, sessions):
+                buffer.append(result)
+                pbar.update(result["num_bytes"])
+                pbar.set_postfix(done=len(buffer), failed=sum(r["status"] == "failed" for r in buffer))
+
+    output_df = pd.DataFrame(buffer, columns=["session", "status", "num_clips", "num_bytes", "seconds", "error"])
+    return output_df.sort_values("session").reset_index(drop=True)
+
+
+def write_combined_manifest(sessions_df: pd.DataFrame, output_root: str) -> pd.DataFrame:
+    """
+    Collect the manifests of all sessions into one file in the output root.
+    :param sessions_df: sessions, see `find_sessions`
+    :param output_root: directory with one subdirectory per session
+    :return: data frame with one row per clip. The filename is relative to the output root.
+    """
+    buffer = []
+    for session in sessions_df["session"]:
+        entries = load_manifest(os.path.join(output_root, session))
+        for entry in sorted(entries.values(), key=lambda entry: entry["clip_idx"]):
+            buffer.append({"session": session, **entry, "filename": os.path.join(session, entry["filename"])})
+
+    # Replace the combined manifest in one step
+    manifest_filepath = os.path.join(output_root, MANIFEST_FILENAME)
+    with open(manifest_filepath + ".tmp", "w") as f:
+        for entry in buffer:
+            f.write(json.dumps(entry) + "\n")
+    os.replace(manifest_filepath + ".tmp", manifest_filepath)
+
+    return pd.DataFrame(buffer)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split all recording sessions below a root directory into clips")
+    parser.add_argument("--input_root", type=str, help="Directory where to search for session directories", required=True)
+    parser.add_argument("--output_root", type=str, help="Directory where to save the clips. Each session gets a subdirectory.", required=True)
+    parser.add_argument("--num_workers", type=int, help="Number of sessions processed in parallel", default=4)
+    parser.add_argument("--boundary_search", type=str, help="Find all clip boundaries first with the given search mode, then extract the clips. By default, the fragments are split in a single pass. The stride mode requires separators and blank runs to be displayed for at least the stride, the keyframes mode for longer than the keyframe interval.", choices=SEARCH_MODES, default=None)
+    parser.add_argument("--search_stride", type=int, help="Distance between analysed frames for the stride and keyframes boundary searches", default=DEFAULT_SEARCH_STRIDE)
+    parser.add_argument("--extraction", type=str, help="How to write the clips when using --boundary_search", choices=EXTRACTION_MODES, default="reencode")
+    parser.add_argument("--cache", action="store_true", help="Reuse and store per-fragment separator indices, so that unchanged fragments are not analysed again")
+    parser.add_argument("--cache_dir", type=str, help="Directory for the separator indices, used with --cache. By default, they are stored next to the fragments.", default=None)
+    parser.add_argument("--cache_validation", type=str, help="How to detect changed fragments", choices=CACHE_VALIDATIONS, default="mtime")
+    parser.add_argument("--listing_cache_dir", type=str, help="Directory for a cached listing of the input root. Speeds up repeated runs on large trees.", default=None)
+    args = vars(parser.parse_args())
+
+    sessions_df = find_sessions(args["input_root"], cache_dir=args["listing_cache_dir"])
+    log.info(f"Found {len(sessions_df)} sessions with {sessions_df['num_fragments'].sum()} fragments ({sessions_df['num_bytes'].sum() / 1e9:.1f} GB).")
+
+    results_df = split_sessions(
+        sessions_df,
+        output_root=args["output_root"],
+        num_workers=args["num_workers"],
+        search_mode=args["boundary_search"],
+        search_stride=args["search_stride"],
+        extraction_mode=args["extraction"],
+        use_cache=args["cache"],
+        cache_dir=args["cache_dir"],
+        cache_validation=args["cache_validation"],
+    )
+    results_df.to_csv(os.path.join(args["output_root"], "sessions.csv"), index=False)
+
+    failed_df = results_df[results_df["status"] == "failed"]
+    for _, row in failed_df.iterrows():
+        log.error(f"Session \"{row['session']}\" failed: {row['error']}")
+
+    clips_df = write_combined_manifest(sessions_df, args["output_root"])
+    log.info(f"Stored {len(clips_df)} clips from {len(results_df) - len(failed_df)} sessions to \"{args['output_root']}\" ({len(failed_df)} failed).")
@@ -3,6 +3,7 @@ import os
 import ast
 import numpy as np
 from pyzbar.pyzbar import decode
+from utils.instrumentation import get_instrumentation
 from utils.logger import setup_basic_logger
 
 
@@ -14,7 +15,135 @@ BLANK_BLUE_COLOR = (0, 0, 255)
 BLANK_BLACK_COLOR = (0, 0, 0)
 
 
-def is_blank_frame(img):
+# Blank frame detection operates on a strided subsample of the frame. At the default stride of 4, a 1280x720 frame is
+# reduced to 320x180 samples, which is plenty to decide whether 95% of the frame shares one colour.
+BLANK_FRAME_STRIDE = 4
+BLANK_FRAME_ATOL = 2
+BLANK_FRAME_THRESHOLD = 0.95
+BLANK_FRAME_NUM_CHUNKS = 8
+
+# The luma pre-test of `is_blank_video_frame` allows this much more than BLANK_FRAME_ATOL, to cover rounding in the colour conversion and the difference between the luma median and the luma of the median colour
+BLANK_FRAME_LUMA_MARGIN = 2
+
+
+def _as_channels(img: np.ndarray) -> np.ndarray:
+    """
+    Make sure that the given image has a channel axis. Single planes (e.g., the Y plane of a YUV frame) are treated as one channel.
+    :param img: image of shape [height, width] or [height, width, channels]
+    :return: view of shape [height, width, channels]
+    """
+    if img.ndim == 2:
+        return img[:, :, None]
+    return img
+
+
+def _histogram_median(values: np.ndarray) -> int:
+    """
+    Compute the (lower) median of uint8 values via a 256-bin histogram. This avoids the sort inside np.median.
+    :param values: 1D uint8 array
+    :return: median value as int
+    """
+    cumulative_counts = np.cumsum(np.bincount(values, minlength=256))
+    return int(np.searchsorted(cumulative_counts, (len(values) + 1) // 2))
+
+
+def _reference_color(samples: np.ndarray) -> tuple[int, ...]:
+    """
+    Estimate the dominant colour of the sampled pixels as the per-channel histogram median.
+    :param samples: uint8 array of shape [height, width, channels]
+    :return: tuple with one int per channel
+    """
+    return tuple(_histogram_median(samples[:, :, c].ravel()) for c in range(samples.shape[2]))
+
+
+def _fraction_close_exceeds(samples: np.ndarray, color, atol: int, threshold: float, num_chunks: int) -> bool:
+    """
+    Test whether more than `threshold` of the sampled pixels lie within `atol` of the given colour in every channel.
+
+    The samples are processed in chunks of rows. The test returns as soon as the outcome is certain, i.e., when either enough pixels matched or too many pixels mismatched.
+
+    :param samples: uint8 array of shape [height, width, channels]
+    :param color: reference colour, one value per channel
+    :param atol: absolute tolerance per channel
+    :param threshold: fraction of pixels that must match
+    :param num_chunks: number of row chunks
+    :return: True if the fraction of matching pixels exceeds the threshold
+    """
+    num_samples = samples.shape[0] * samples.shape[1]
+    if num_samples == 0:
+        return False
+
+    # Integer bounds per channel. Clip to the uint8 range so that comparisons stay in the array's dtype.
+    lower = [max(int(v) - atol, 0) for v in color]
+    upper = [min(int(v) + atol, 255) for v in color]
+
+    # Decision is "matches > threshold * num_samples"
+    required_matches = int(np.floor(threshold * num_samples)) + 1
+    allowed_mismatches = num_samples - required_matches
+
+    num_matches = 0
+    num_mismatches = 0
+    rows_per_chunk = max(1, -(-samples.shape[0] // num_chunks))
+    for row_start in range(0, samples.shape[0], rows_per_chunk):
+        chunk = samples[row_start:row_start + rows_per_chunk]
+
+        mask = (chunk[:, :, 0] >= lower[0]) & (chunk[:, :, 0] <= upper[0])
+        for c in range(1, chunk.shape[2]):
+            mask &= (chunk[:, :, c] >= lower[c]) & (chunk[:, :, c] <= upper[c])
+
+        chunk_matches = int(np.count_nonzero(mask))
+        num_matches += chunk_matches
+        num_mismatches += mask.size - chunk_matches
+
+        if num_matches >= required_matches:
+            return True
+        if num_mismatches > allowed_mismatches:
+            return False
+
+    return num_matches >= required_matches
+
+
+def is_blank_frame(img, stride=BLANK_FRAME_STRIDE, atol=BLANK_FRAME_ATOL, threshold=BLANK_FRAME_THRESHOLD):
+    """
+    Test whether more than 95% of the frame's pixels share the same colour.
+
+    The frame is subsampled on a strided grid. The reference colour is the per-channel median of the samples. All comparisons are done on integers, and the test exits as soon as the decision is certain.
+
+    :param img: uint8 frame of shape [height, width, 3] (e.g., rgb24) or a single plane of shape [height, width] (e.g., the Y plane)
+    :param stride: sampling stride along both axes. Use 1 to look at every pixel.
+    :param atol: tolerance per channel to account for impurity due to video compression
+    :param threshold: fraction of pixels that must match the reference colour
+    :return: True if the frame is blank
+    """
+    samples = _as_channels(img)[::stride, ::stride]
+    if samples.size == 0:
+        return False
+
+    reference_color = _reference_color(samples)
+    return _fraction_close_exceeds(samples, reference_color, atol=atol, threshold=threshold, num_chunks=BLANK_FRAME_NUM_CHUNKS)
+
+
+def is_color_frame(img, blank_color=BLANK_BLACK_COLOR, stride=BLANK_FRAME_STRIDE, atol=BLANK_FRAME_ATOL, threshold=BLANK_FRAME_THRESHOLD):
+    """
+    Test whether more than 95% of the frame's pixels have the given colour.
+    :param img: uint8 frame of shape [height, width, 3]
+    :param blank_color: RGB colour to compare against
+    :param stride: sampling stride along both axes
+    :param atol: tolerance per channel
+    :param threshold: fraction of pixels that must match the given colour
+    :return: True if the frame has the given colour. Always False for single-channel images.
+    """
+    if len(img.shape) == 2:
+        return False
+
+    samples = img[::stride, ::stride]
+    return _fraction_close_exceeds(samples, blank_color, atol=atol, threshold=threshold, num_chunks=BLANK_FRAME_NUM_CHUNKS)
+
+
+def is_blank_frame_reference(img):
+    """
+    Full-resolution reference implementation of `is_blank_frame`. Slow, but useful to verify the fast detector.
+    """
     rgb_medians = np.median(img, axis=(0, 1))
 
     # Account for impurity due to video compression
@@ -27,7 +156,10 @@ def is_blank_frame(img):
     return np.mean(mask) > 0.95
 
 
-def is_color_frame(img, blank_color=BLANK_BLACK_COLOR):
+def is_color_frame_reference(img, blank_color=BLANK_BLACK_COLOR):
+    """
+    Full-resolution reference implementation of `is_color_frame`.
+    """
     if len(img.shape) == 2:
         return False
 
@@ -40,7 +172,84 @@ def is_color_frame(img, blank_color=BLANK_BLACK_COLOR):
     return np.mean(mask) > 0.95
 
 
+# Pixel formats whose planes can be analysed in place. Every plane holds one 8-bit channel.
+PLANAR_YUV_FORMATS = {"yuv420p", "yuvj420p", "yuv422p", "yuvj422p", "yuv444p", "yuvj444p"}
+
+# Pixel format fed to the encoder, see `open_output_writer`
+OUTPUT_PIX_FMT = "yuv420p"
+
+
+def plane_view(frame: av.VideoFrame, plane_idx: int = 0) -> np.ndarray:
+    """
+    Zero-copy view of one plane of a decoded frame. Only valid while the frame is alive.
+    :param frame: decoded video frame in an 8-bit planar format
+    :param plane_idx: index of the plane
+    :return: read-only uint8 array of shape [height, width]. Rows may be padded in memory, so the array may not be contiguous.
+    """
+    plane = frame.planes[plane_idx]
+    buffer = np.frombuffer(plane, dtype=np.uint8)
+    return buffer.reshape(plane.height, plane.line_size)[:, :plane.width]
+
+
+def luma_view(frame: av.VideoFrame) -> np.ndarray:
+    """
+    Grayscale version of the frame for analysis. For planar YUV frames this is a zero-copy view of the Y plane, otherwise the frame is converted once.
+    :param frame: decoded video frame
+    :return: uint8 array of shape [height, width]
+    """
+    if frame.format.name in PLANAR_YUV_FORMATS:
+        return plane_view(frame, 0)
+    return frame.to_ndarray(format="gray")
+
+
+def is_blank_video_frame(frame: av.VideoFrame, stride: int = BLANK_FRAME_STRIDE, atol: int = BLANK_FRAME_ATOL, threshold: float = BLANK_FRAME_THRESHOLD) -> bool:
+    """
+    Blank frame test on a decoded frame, with the same decision as `is_blank_frame` on the frame converted to rgb24, but without converting the whole frame.
+
+    For planar YUV frames, the Y plane is tested first on a zero-copy view. Pixels within `atol` of the reference colour in RGB are within about `atol` of the reference in Y, so a frame that fails the looser luma test cannot be blank. Most content frames are rejected here.
+    Only the remaining, nearly flat frames are converted to rgb24 and decided jointly on all channels. Testing the planes separately is not equivalent: noise that stays within the tolerance in each of Y, U and V can exceed it in R, G or B.
+
+    :param frame: decoded video frame
+    :param stride: sampling stride along both axes
+    :param atol: tolerance per RGB channel
+    :param threshold: fraction of pixels that must match the reference colour
+    :return: True if the frame is blank
+    """
+    if frame.format.name in PLANAR_YUV_FORMATS:
+        if not is_blank_frame(plane_view(frame, 0), stride=stride, atol=atol + BLANK_FRAME_LUMA_MARGIN, threshold=threshold):
+            return False
+
+    return is_blank_frame(frame.to_ndarray(format="rgb24"), stride=stride, atol=atol, threshold=threshold)
+
+
+def prepare_output_frame(frame: av.VideoFrame, pts: int, pix_fmt: str = OUTPUT_PIX_FMT) -> av.VideoFrame:
+    """
+    Prepare a decoded frame to be passed on to the encoder. Avoids copying the pixels unless a pixel format conversion is needed.
+    :param frame: decoded input frame
+    :param pts: new presentation timestamp, in units of the input stream's time base
+    :param pix_fmt: pixel format expected by the encoder
+    :return: frame to encode. This is the input frame itself if it already has the right pixel format.
+    """
+    if frame.format.name != pix_fmt:
+        with get_instrumentation().time("convert"):
+            output_frame = frame.reformat(format=pix_fmt)
+        output_frame.time_base = frame.time_base
+    else:
+        output_frame = frame
+
+    output_frame.pts = pts
+
+    # Let the encoder choose the picture type instead of inheriting the decoder's (e.g., forced keyframes)
+    output_frame.pict_type = av.video.frame.PictureType.NONE
+    return output_frame
+
+
 def try_read_qr_code(img: np.ndarray):
+    """
+    Decode the QR code in the given image.
+    :param img: grayscale image of shape [height, width], e.g., from `luma_view`. For images with channels, pyzbar only looks at the first channel.
+    :return: decoded Python literal, or None if there is no readable QR code
+    """
     try:
         decoded_qr_code = decode(img)
 
@@ -65,7 +274,7 @@ def open_output_writer(filename: str, template_stream: av.video.stream.VideoStre
 
     output_stream.width = template_stream.width
     output_stream.height = template_stream.height
-    output_stream.pix_fmt = "yuv420p"
+    output_stream.pix_fmt = OUTPUT_PIX_FMT
     output_stream.time_base = template_stream.time_base    # keep exact tbn
 
     output_stream.options = {
@@ -81,3 +290,21 @@ def open_output_writer(filename: str, template_stream: av.video.stream.VideoStre
     }
 
     return output_container, output_stream
+
+
+def encode_and_mux(output_container: av.container.OutputContainer, output_stream: av.video.stream.VideoStream, frame: av.VideoFrame | None, time_base) -> None:
+    """
+    Encode one frame and write the resulting packets. Encoding and muxing are timed as separate stages, see `utils.instrumentation`.
+    :param output_container: output container, see `open_output_writer`
+    :param output_stream: output stream, see `open_output_writer`
+    :param frame: frame to encode, see `prepare_output_frame`. None flushes the encoder.
+    :param time_base: time base of the packet timestamps, i.e., of the input stream
+    """
+    instrumentation = get_instrumentation()
+    with instrumentation.time("encode"):
+        packets = output_stream.encode(frame)
+
+    with instrumentation.time("mux"):
+        for packet in packets:
+            packet.time_base = time_base
+            output_container.mux(packet)
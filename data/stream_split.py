@@ -0,0 +1,175 @@
+import os
+import argparse
+from collections import deque
+from collections.abc import Iterator
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from download_videos import create_client, download_file, DEFAULT_CHUNK_SIZE_MB, DEFAULT_MAX_CONCURRENCY, DEFAULT_MAX_ATTEMPTS
+from data.split_recordings_into_clips import split_fragments
+from utils.logger import setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+FRAGMENT_EXTENSIONS = (".mkv",)
+
+# Number of fragments downloaded ahead of the splitter. Together with the fragment being split, this bounds the disk space.
+DEFAULT_DOWNLOAD_AHEAD = 4
+
+
+def list_fragments(s3, bucket: str, prefix: str) -> list[str]:
+    """
+    List the fragments of a recording session on S3.
+    :param s3: S3 client
+    :param bucket: S3 bucket
+    :param prefix: key prefix of the session
+    :return: object keys in recording order
+    """
+    keys = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if obj["Key"].lower().endswith(FRAGMENT_EXTENSIONS):
+                keys.append(obj["Key"])
+
+    # Fragment names sort in recording order, see `split_recordings_into_clips`
+    return sorted(keys)
+
+
+def iter_downloaded_fragments(
+    s3,
+    bucket: str,
+    keys: list[str],
+    download_dir: str,
+    download_ahead: int = DEFAULT_DOWNLOAD_AHEAD,
+    delete_consumed: bool = False,
+    **download_kwargs,
+) -> Iterator[str]:
+    """
+    Download fragments in the background and yield each one as soon as it is complete.
+
+    At most `download_ahead` fragments are downloaded or waiting ahead of the consumer. A fragment is consumed once the consumer asks for the next one.
+
+    :param s3: S3 client, see `download_videos.create_client`
+    :param bucket: S3 bucket
+    :param keys: object keys in recording order
+    :param download_dir: where to store the fragments. The local paths mirror the keys.
+    :param download_ahead: maximum number of fragments downloaded ahead of the consumer
+    :param delete_consumed: if True, delete each fragment after it has been consumed
+    :param download_kwargs: arguments to `download_videos.download_file`
+    :return: iterator that yields local paths in recording order
+    :raises IOError: if a fragment cannot be downloaded. The recording cannot be split with a missing fragment.
+    """
+    keys_iter = iter(keys)
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=download_ahead) as executor:
+        def submit_next():
+            key = next(keys_iter, None)
+            if key is not None:
+                pending.append((key, executor.submit(download_file, s3, bucket, key, download_dir, **download_kwargs)))
+
+        for _ in range(download_ahead):
+            submit_next()
+
+        try:
+            while pending:
+                key, future = pending.popleft()
+                if future.result()["status"] == "failed":
+                    raise IOError(f"Failed to download {bucket}/{key}")
+
+                # The slot of this fragment is free for the next download
+                submit_next()
+
+                local_path = Path(download_dir) / key
+                yield str(local_path)
+
+                if delete_consumed:
+                    local_path.unlink()
+
+        finally:
+            # Do not start new downloads if the consumer stops early
+            for _, future in pending:
+                future.cancel()
+
+
+def split_streaming(
+    bucket: str,
+    prefix: str,
+    download_dir: str,
+    output_dir: str,
+    download_ahead: int = DEFAULT_DOWNLOAD_AHEAD,
+    delete_consumed: bool = False,
+    endpoint_url: str = None,
+    chunk_size_mb: int = DEFAULT_CHUNK_SIZE_MB,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+):
+    """
+    Split a recording session while it is being downloaded. The single-pass splitter consumes the fragments in order, so it can start as soon as the first fragment is complete.
+    :param bucket: S3 bucket
+    :param prefix: key prefix of the session
+    :param download_dir: where to store the fragments
+    :param output_dir: where to write the clips
+    :param download_ahead: maximum number of fragments downloaded ahead of the splitter
+    :param delete_consumed: if True, delete each fragment once the splitter has moved on to the next one
+    :param endpoint_url: custom S3 endpoint
+    :param chunk_size_mb: size of the range requests
+    :param max_concurrency: number of range requests in flight per fragment
+    :param max_attempts: number of attempts per fragment
+    :return: data frame with one row per clip, see `split_fragments`
+    """
+    s3 = create_client(num_connections=download_ahead * max_concurrency, endpoint_url=endpoint_url)
+
+    keys = list_fragments(s3, bucket, prefix)
+    log.info(f"Found {len(keys)} fragments under s3://{bucket}/{prefix}")
+
+    fragments_filepaths = iter_downloaded_fragments(
+        s3,
+        bucket,
+        keys,
+        download_dir,
+        download_ahead=download_ahead,
+        delete_consumed=delete_consumed,
+        chunk_size=chunk_size_mb * 1024 * 1024,
+        max_concurrency=max_concurrency,
+        max_attempts=max_attempts,
+    )
+
+    # The separator cache is stored next to the fragments, which may be deleted
+    return split_fragments(fragments_filepaths, output_dir, use_cache=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download the fragments of a recording session and split them into clips at the same time")
+    parser.add_argument("--bucket", type=str, help="S3 bucket", required=True)
+    parser.add_argument("--prefix", type=str, help="Key prefix of the session's fragments", required=True)
+    parser.add_argument("--download_dir", type=str, help="Directory where to store the fragments", required=True)
+    parser.add_argument("--output_dir", type=str, help="Directory where to save the clips", required=True)
+    parser.add_argument("--download_ahead", type=int, help="Maximum number of fragments downloaded ahead of the splitter", default=DEFAULT_DOWNLOAD_AHEAD)
+    parser.add_argument("--delete_fragments", action="store_true", help="Delete each fragment once it has been split")
+    parser.add_argument("--endpoint_url", type=str, help="Custom S3 endpoint, e.g., a local MinIO or moto server", default=None)
+    parser.add_argument("--chunk_size_mb", type=int, help="Part size for ranged downloads, in MB", default=DEFAULT_CHUNK_SIZE_MB)
+    parser.add_argument("--max_concurrency", type=int, help="Number of parts downloaded concurrently per fragment", default=DEFAULT_MAX_CONCURRENCY)
+    parser.add_argument("--max_attempts", type=int, help="Number of attempts per fragment", default=DEFAULT_MAX_ATTEMPTS)
+    args = vars(parser.parse_args())
+
+    output_videos_df = split_streaming(
+        bucket=args["bucket"],
+        prefix=args["prefix"],
+        download_dir=args["download_dir"],
+        output_dir=args["output_dir"],
+        download_ahead=args["download_ahead"],
+        delete_consumed=args["delete_fragments"],
+        endpoint_url=args["endpoint_url"],
+        chunk_size_mb=args["chunk_size_mb"],
+        max_concurrency=args["max_concurrency"],
+        max_attempts=args["max_attempts"],
+    )
+    log.info(f"Stored individual videos to \"{args['output_dir']}\"")
+
+    # Replace the list of clips in one step
+    output_csv_filepath = os.path.join(args["output_dir"], "video_clips.csv")
+    output_videos_df.to_csv(output_csv_filepath + ".tmp", index=False)
+    os.replace(output_csv_filepath + ".tmp", output_csv_filepath)
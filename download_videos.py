@@ -1,44 +1,287 @@
-import boto3
-import argparse
-import pandas as pd
-from tqdm import tqdm
-from multiprocessing import Pool, cpu_count
-from functools import partial
-from pathlib import Path
-
-
-def download_file(bucket, key, output_dir):
-    local_path = Path(output_dir) / key
-    local_path.parent.mkdir(parents=True, exist_ok=True)
-
-    if local_path.exists():
-        return
-
-    try:
-        s3 = boto3.client('s3')
-        s3.download_file(bucket, key, str(local_path))
-    except Exception as e:
-        print(f"[ERROR] Failed to download {bucket}/{key}: {e}")
-
-
-def process_row(row, output_dir):
-    return download_file(row['s3_bucket'], row['s3_object_key'], output_dir)
-
-
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Download S3 files from a CSV manifest.")
-    parser.add_argument('--csv_file', help='CSV file with the selected videos', default="assets/2025_07_16-selected_videos.csv")
-    parser.add_argument('--output_dir', help='Directory to download the files into', default=r"P:\GetRealLabs\grl-mleng-dsfactory-training-video-data")
-    args = vars(parser.parse_args())
-
-    df = pd.read_csv(args["csv_file"])
-
-    if 's3_bucket' not in df.columns or 's3_object_key' not in df.columns:
-        raise ValueError("CSV must contain 'bucket' and 'key' columns.")
-
-    worker_func = partial(process_row, output_dir=args["output_dir"])
-    num_workers = min(len(df), cpu_count())
-    with Pool(num_workers) as pool:
-        with tqdm(total=len(df)) as pbar:
-            for _ in pool.imap_unordered(worker_func, [row for _, row in df.iterrows()]):
-                pbar.update(1)
+import os
+import json
+import time
+import boto3
+import random
+import hashlib
+import argparse
+from tqdm import tqdm
+from pathlib import Path
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils.manifests import read_manifest
+
+
+# Downloads are bound by the network, not by the CPU. Threads spend most of their time waiting for data.
+DEFAULT_NUM_THREADS = 16
+
+# Large objects are downloaded in parts of this size, with several parts in flight per object
+DEFAULT_CHUNK_SIZE_MB = 16
+DEFAULT_MAX_CONCURRENCY = 4
+
+# Failed downloads are retried with exponential backoff, in seconds
+DEFAULT_MAX_ATTEMPTS = 5
+BASE_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+# Incomplete downloads are kept next to their final path and resumed by the next attempt
+PART_SUFFIX = ".part"
+
+# Verified downloads, keyed by "bucket/key"
+STATE_FILENAME = ".download_state.json"
+
+
+def create_client(num_connections: int, endpoint_url: str = None):
+    """
+    Create an S3 client that is shared by all download threads. boto3 clients are thread-safe.
+    :param num_connections: size of the connection pool. Should cover all threads times the concurrency per transfer.
+    :param endpoint_url: custom endpoint, e.g., a local S3-compatible server. If None, the default AWS endpoint is used.
+    :return: S3 client
+    """
+    config = Config(
+        max_pool_connections=num_connections,
+        retries={"max_attempts": 10, "mode": "adaptive"},
+    )
+    return boto3.client('s3', endpoint_url=endpoint_url, config=config)
+
+
+def load_state(state_filepath):
+    """
+    Read the verified downloads of previous runs.
+    :param state_filepath: path to state file
+    :return: dict that maps "bucket/key" to the object's size and ETag and the local file's modification time
+    """
+    if not os.path.exists(state_filepath):
+        return {}
+
+    with open(state_filepath, "r") as f:
+        return json.load(f)
+
+
+def save_state(state_filepath, state):
+    # Replace the state file in one step, so that an interrupted run never leaves a corrupt file behind
+    with open(state_filepath + ".tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(state_filepath + ".tmp", state_filepath)
+
+
+def is_verified(local_path, record):
+    """
+    Cheap check whether a file verified by a previous run is still intact. Does not access S3.
+    :param local_path: local file
+    :param record: state record of the file, or None
+    :return: True if the file has the recorded size and modification time
+    """
+    if record is None or not local_path.exists():
+        return False
+
+    stat = local_path.stat()
+    return stat.st_size == record["size"] and stat.st_mtime_ns == record["mtime_ns"]
+
+
+def _md5(filepath, chunk_size=8 * 1024 * 1024):
+    md5 = hashlib.md5()
+    with open(filepath, "rb") as f:
+        while chunk := f.read(chunk_size):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _download_ranges(s3, bucket, key, etag, part_path, size, chunk_size, max_concurrency):
+    """
+    Append the missing bytes of an object to a partial file.
+
+    Parts are requested with HTTP range requests, several at a time, but written in order. The partial file therefore always holds a prefix of the object and can be resumed after an interruption.
+    """
+    offset = part_path.stat().st_size if part_path.exists() else 0
+    ranges = [(start, min(start + chunk_size, size) - 1) for start in range(offset, size, chunk_size)]
+
+    def fetch(byte_range):
+        # IfMatch makes the request fail if the object has been replaced in the meantime
+        response = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={byte_range[0]}-{byte_range[1]}", IfMatch=etag)
+        return response["Body"].read()
+
+    with open(part_path, "ab") as f, ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        # Submit at most max_concurrency parts at a time, so that memory use is bounded
+        for i in range(0, len(ranges), max_concurrency):
+            for data in executor.map(fetch, ranges[i:i + max_concurrency]):
+                f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _download_verified(s3, bucket, key, local_path, chunk_size, max_concurrency, verify_md5):
+    """
+    Download one object to a partial file, verify it, and move it into place.
+    :return: tuple (size, ETag) of the object
+    """
+    head = s3.head_object(Bucket=bucket, Key=key)
+    size = head["ContentLength"]
+    etag = head["ETag"]
+
+    part_path = local_path.with_name(local_path.name + PART_SUFFIX)
+
+    # A previous version of the object, or a file that is too long, cannot be resumed
+    part_record_path = part_path.with_name(part_path.name + ".etag")
+    if part_path.exists() and (not part_record_path.exists() or part_record_path.read_text() != etag or part_path.stat().st_size > size):
+        part_path.unlink()
+    part_record_path.write_text(etag)
+
+    try:
+        _download_ranges(s3, bucket, key, etag, part_path, size, chunk_size, max_concurrency)
+    except ClientError as e:
+        # The object has changed since the HEAD request. Start over.
+        if e.response["Error"]["Code"] in ("412", "PreconditionFailed"):
+            part_path.unlink(missing_ok=True)
+        raise
+
+    if part_path.stat().st_size != size:
+        raise IOError(f"Expected {size} bytes, got {part_path.stat().st_size}")
+
+    # The ETag of objects uploaded in a single part is the MD5 of their content
+    if verify_md5 and "-" not in etag and _md5(part_path) != etag.strip('"'):
+        part_path.unlink()
+        raise IOError("MD5 does not match the ETag")
+
+    os.replace(part_path, local_path)
+    part_record_path.unlink()
+    return size, etag
+
+
+def download_file(s3, bucket, key, output_dir, record=None, chunk_size=DEFAULT_CHUNK_SIZE_MB * 1024 * 1024, max_concurrency=DEFAULT_MAX_CONCURRENCY, max_attempts=DEFAULT_MAX_ATTEMPTS, verify_md5=False):
+    """
+    Download one object, unless a previous run has verified the local file already.
+    :param s3: S3 client, see `create_client`
+    :param bucket: S3 bucket
+    :param key: S3 object key. The local path mirrors the key.
+    :param output_dir: directory to download the files into
+    :param record: state record from a previous run, see `load_state`
+    :param chunk_size: size of the range requests, in bytes
+    :param max_concurrency: number of range requests in flight per file
+    :param max_attempts: number of attempts before giving up. Interrupted downloads resume where they stopped.
+    :param verify_md5: if True, also compare the MD5 of single-part uploads to their ETag
+    :return: dict with the new state record (None if the download failed), status and number of bytes downloaded
+    """
+    local_path = Path(output_dir) / key
+    local_path.parent.mkdir(parents=True, exist_ok=True)
+
+    if is_verified(local_path, record):
+        return {"record": record, "status": "skipped", "num_bytes": 0}
+
+    part_path = local_path.with_name(local_path.name + PART_SUFFIX)
+    for attempt in range(max_attempts):
+        try:
+            # The file may exist from an older version of this tool that did not keep a state file
+            if local_path.exists():
+                head = s3.head_object(Bucket=bucket, Key=key)
+                if local_path.stat().st_size == head["ContentLength"] and not (verify_md5 and "-" not in head["ETag"] and _md5(local_path) != head["ETag"].strip('"')):
+                    size, etag, status = head["ContentLength"], head["ETag"], "verified"
+                    break
+                local_path.unlink()
+
+            resumed_bytes = part_path.stat().st_size if part_path.exists() else 0
+            size, etag = _download_verified(s3, bucket, key, local_path, chunk_size, max_concurrency, verify_md5)
+            status = "downloaded"
+            break
+
+        except Exception as e:
+            if attempt == max_attempts - 1:
+                print(f"[ERROR] Failed to download {bucket}/{key}: {e}")
+                return {"record": None, "status": "failed", "num_bytes": 0}
+
+            # Exponential backoff with full jitter
+            time.sleep(random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt)))
+
+    record = {"size": size, "etag": etag, "mtime_ns": local_path.stat().st_mtime_ns}
+    num_bytes = size - resumed_bytes if status == "downloaded" else 0
+    return {"record": record, "status": status, "num_bytes": num_bytes}
+
+
+def download_files(df, output_dir, num_threads=DEFAULT_NUM_THREADS, chunk_size_mb=DEFAULT_CHUNK_SIZE_MB, max_concurrency=DEFAULT_MAX_CONCURRENCY, max_attempts=DEFAULT_MAX_ATTEMPTS, verify_md5=False, endpoint_url=None):
+    """
+    Download all objects listed in a data frame. Verified files are recorded in a state file in the output directory.
+    :param df: data frame with columns s3_bucket and s3_object_key
+    :param output_dir: directory to download the files into
+    :param num_threads: number of files downloaded concurrently
+    :param chunk_size_mb: size of the range requests
+    :param max_concurrency: number of range requests in flight per file
+    :param max_attempts: number of attempts per file
+    :param verify_md5: if True, also compare the MD5 of single-part uploads to their ETag
+    :param endpoint_url: custom S3 endpoint
+    :return: tuple (number of bytes downloaded, elapsed seconds, dict with the number of files per status)
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    state_filepath = os.path.join(output_dir, STATE_FILENAME)
+    state = load_state(state_filepath)
+
+    s3 = create_client(num_connections=num_threads * max_concurrency, endpoint_url=endpoint_url)
+
+    # Plain tuples are much cheaper to build than one Series per row
+    items = list(zip(df['s3_bucket'], df['s3_object_key']))
+
+    num_bytes = 0
+    statuses = {}
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = {
+            executor.submit(
+                download_file, s3, bucket, key, output_dir,
+                record=state.get(f"{bucket}/{key}"),
+                chunk_size=chunk_size_mb * 1024 * 1024,
+                max_concurrency=max_concurrency,
+                max_attempts=max_attempts,
+                verify_md5=verify_md5,
+            ): f"{bucket}/{key}"
+            for bucket, key in items
+        }
+        with tqdm(total=len(futures)) as pbar:
+            for future in as_completed(futures):
+                result = future.result()
+                num_bytes += result["num_bytes"]
+                statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+
+                # Only this thread writes the state file
+                if result["status"] in ("downloaded", "verified"):
+                    state[futures[future]] = result["record"]
+                    save_state(state_filepath, state)
+                elif result["status"] == "failed":
+                    state.pop(futures[future], None)
+
+                elapsed = time.perf_counter() - start_time
+                pbar.set_postfix_str(f"{num_bytes / 1e6 / max(elapsed, 1e-9):.1f} MB/s")
+                pbar.update(1)
+
+    save_state(state_filepath, state)
+    return num_bytes, time.perf_counter() - start_time, statuses
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Download S3 files from a CSV manifest.")
+    parser.add_argument('--csv_file', help='CSV file with the selected videos', default="assets/2025_07_16-selected_videos.csv")
+    parser.add_argument('--output_dir', help='Directory to download the files into', default=r"P:\GetRealLabs\grl-mleng-dsfactory-training-video-data")
+    parser.add_argument('--num_threads', type=int, help='Number of files downloaded concurrently', default=DEFAULT_NUM_THREADS)
+    parser.add_argument('--chunk_size_mb', type=int, help='Part size for multipart downloads, in MB', default=DEFAULT_CHUNK_SIZE_MB)
+    parser.add_argument('--max_concurrency', type=int, help='Number of parts downloaded concurrently per file', default=DEFAULT_MAX_CONCURRENCY)
+    parser.add_argument('--max_attempts', type=int, help='Number of attempts per file', default=DEFAULT_MAX_ATTEMPTS)
+    parser.add_argument('--verify_md5', action='store_true', help='Compare the MD5 of each file to its ETag. Only applies to objects uploaded in a single part.')
+    parser.add_argument('--endpoint_url', help='Custom S3 endpoint, e.g., a local MinIO or moto server', default=None)
+    args = vars(parser.parse_args())
+
+    # Only the two key columns are read from the manifest's Parquet cache
+    try:
+        df = read_manifest(args["csv_file"], columns=['s3_bucket', 's3_object_key'])
+    except (KeyError, ValueError) as e:
+        raise ValueError("CSV must contain 's3_bucket' and 's3_object_key' columns.") from e
+
+    num_bytes, elapsed, statuses = download_files(
+        df,
+        output_dir=args["output_dir"],
+        num_threads=args["num_threads"],
+        chunk_size_mb=args["chunk_size_mb"],
+        max_concurrency=args["max_concurrency"],
+        max_attempts=args["max_attempts"],
+        verify_md5=args["verify_md5"],
+        endpoint_url=args["endpoint_url"],
+    )
+    print(f"Downloaded {num_bytes / 1e6:.1f} MB in {elapsed:.1f} s ({num_bytes / 1e6 / max(elapsed, 1e-9):.1f} MB/s), files: {statuses}")
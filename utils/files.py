@@ -1,5 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from glob import glob
+import hashlib
+import json
 import os
+import time
 from utils.args import is_list_or_tuple
 
 
@@ -22,12 +26,12 @@ def find_files(directory, file_extensions=FILE_EXTENSIONS):
         else:
             raise ValueError("Candidate file extensions must be a tuple")
 
-    # Do not search subdirectories
+    # Do not search subdirectories. The directory entries carry the file type, which saves one stat per file on most file systems.
     files = []
-    for filename in os.listdir(directory):
-        filepath = os.path.join(directory, filename)
-        if os.path.isfile(filepath) and filepath.endswith(file_extensions):
-            files.append(filepath)
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name.endswith(file_extensions) and entry.is_file():
+                files.append(entry.path)
 
     return files
 
@@ -54,7 +58,8 @@ def glob_files_recursively(directory, file_extensions=FILE_EXTENSIONS):
     """
     Find all the files with the given file extension.
 
-    Slower than the os.walk method.
+    Same result as globbing for each extension, i.e., hidden files and directories are skipped, symlinks are followed and extensions are case-sensitive except on Windows, but the tree is walked only once.
+    Unlike glob, every directory is entered only once, so symlink cycles do not lead to an endless walk.
 
     :param directory: input directory to search recursively
     :param file_extensions: list of file extensions
@@ -63,10 +68,28 @@ def glob_files_recursively(directory, file_extensions=FILE_EXTENSIONS):
     if not is_list_or_tuple(file_extensions):
         raise ValueError("Expected file extensions to be a list or tuple")
 
-    file_extensions = set(file_extensions)
+    # Like glob, compare names in the platform's case
+    file_extensions = tuple(set(os.path.normcase(ext) for ext in file_extensions))
+    visited = set()
     filepaths = []
-    for file_type in file_extensions:
-        filepaths.extend(glob(os.path.join(directory, "**", "*" + file_type), recursive=True))
+    for root, dirs, files in os.walk(directory, followlinks=True):
+        try:
+            stat = os.stat(root)
+        except OSError:
+            dirs[:] = []
+            continue
+
+        # A directory reached again through a symlink has already been listed
+        if (stat.st_dev, stat.st_ino) in visited:
+            dirs[:] = []
+            continue
+        visited.add((stat.st_dev, stat.st_ino))
+
+        # Enter real directories before symlinks, so that files are preferably found under their real path
+        dirs[:] = sorted((d for d in dirs if not d.startswith(".")), key=lambda d: os.path.islink(os.path.join(root, d)))
+        for basename in files:
+            if not basename.startswith(".") and os.path.normcase(basename).endswith(file_extensions):
+                filepaths.append(os.path.join(root, basename))
     return filepaths
 
 
@@ -89,3 +112,157 @@ def resolve_path(filepath):
         raise FileNotFoundError(f"Given file \"{filepath}\" does not exist.")
 
     return filepath
+
+
+# Number of bytes read from the start and the end of a file for the content hash
+CONTENT_HASH_NUM_BYTES = 1 << 20
+
+
+def file_signature(filepath, content_hash=False):
+    """
+    Describe the current state of a file, to decide whether data derived from the file is still valid.
+    :param filepath: path to file
+    :param content_hash: if True, also hash the first and last megabyte of the file. This catches files that were replaced without changing their size or mtime, e.g., when copied with preserved timestamps.
+    :return: dict with keys size and mtime_ns, and sha1 if content_hash is True
+    """
+    stat = os.stat(filepath)
+    signature = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+    if content_hash:
+        h = hashlib.sha1()
+        with open(filepath, "rb") as f:
+            h.update(f.read(CONTENT_HASH_NUM_BYTES))
+            if stat.st_size > 2 * CONTENT_HASH_NUM_BYTES:
+                f.seek(-CONTENT_HASH_NUM_BYTES, os.SEEK_END)
+                h.update(f.read(CONTENT_HASH_NUM_BYTES))
+        signature["sha1"] = h.hexdigest()
+
+    return signature
+
+
+# Number of threads listing directories concurrently. Listing is bound by the file system latency, especially on network mounts.
+DEFAULT_NUM_SCAN_THREADS = 16
+
+LISTING_CACHE_VERSION = 1
+
+# A directory modified this shortly before it was listed may have changed again within the same mtime tick, so its cached listing is not trusted
+MTIME_SAFETY_MARGIN_NS = 2_000_000_000
+
+
+def _list_directory(directory):
+    """
+    List one directory with os.scandir. Follows the conventions of os.walk: symlinks to directories are listed as directories but not entered.
+    :return: dict with the directory's mtime, the time of the listing, and the names of its files and subdirectories to enter
+    """
+    # Take the mtime before listing, so that a change during the listing invalidates the result
+    mtime_ns = os.stat(directory).st_mtime_ns
+    listed_at_ns = time.time_ns()
+
+    files = []
+    subdirs = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+
+            if not is_dir:
+                files.append(entry.name)
+            elif not entry.is_symlink():
+                subdirs.append(entry.name)
+
+    return {"mtime_ns": mtime_ns, "listed_at_ns": listed_at_ns, "files": files, "subdirs": subdirs}
+
+
+def _walk_parallel(directory, num_threads, cached_listing=None):
+    """
+    List a directory tree with a thread pool. Each directory is one task, and subdirectories are submitted as soon as their parent has been listed.
+    :param directory: root directory
+    :param num_threads: number of threads
+    :param cached_listing: listing of a previous walk. Directories with an unchanged mtime are not listed again.
+    :return: dict that maps each directory path to its listing, see `_list_directory`
+    """
+    cached_listing = cached_listing or {}
+
+    def visit(path):
+        try:
+            cached = cached_listing.get(path)
+            if cached is not None:
+                mtime_ns = os.stat(path).st_mtime_ns
+                if mtime_ns == cached["mtime_ns"] and mtime_ns < cached["listed_at_ns"] - MTIME_SAFETY_MARGIN_NS:
+                    return path, cached
+
+            return path, _list_directory(path)
+
+        except OSError:
+            # Same as os.walk, directories that cannot be listed are skipped
+            return path, None
+
+    listing = {}
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending = {executor.submit(visit, directory)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, entry = future.result()
+                if entry is None:
+                    continue
+
+                listing[path] = entry
+                for subdir in entry["subdirs"]:
+                    pending.add(executor.submit(visit, os.path.join(path, subdir)))
+
+    return listing
+
+
+def _listing_cache_filepath(directory, cache_dir):
+    # One cache file per root directory
+    path_hash = hashlib.sha1(os.path.abspath(directory).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, f"listing-{path_hash}.json")
+
+
+def scan_files_recursively(directory, file_extensions=FILE_EXTENSIONS, num_threads=DEFAULT_NUM_SCAN_THREADS, cache_dir=None):
+    """
+    Recursively find all the files with the given file extensions. Same result as `find_files_recursively`, but subtrees are listed in parallel.
+
+    With a cache directory, the listing of the whole tree is stored. On the next call, only directories whose mtime has changed are listed again, which reduces a repeated scan to one stat per directory.
+
+    :param directory: input directory to search recursively
+    :param file_extensions: list of file extensions
+    :param num_threads: number of threads listing directories
+    :param cache_dir: directory for the cached listing. If None, nothing is cached.
+    :return: sorted list of filepaths
+    """
+    if not is_list_or_tuple(file_extensions):
+        raise ValueError("Expected file extensions to be a list or tuple")
+
+    cached_listing = None
+    cache_filepath = None
+    if cache_dir is not None:
+        cache_filepath = _listing_cache_filepath(directory, cache_dir)
+        if os.path.exists(cache_filepath):
+            with open(cache_filepath, "r") as f:
+                cache = json.load(f)
+            if cache["version"] == LISTING_CACHE_VERSION:
+                cached_listing = cache["directories"]
+
+    listing = _walk_parallel(directory, num_threads=num_threads, cached_listing=cached_listing)
+
+    if cache_filepath is not None and listing != cached_listing:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_filepath + ".tmp", "w") as f:
+            json.dump({"version": LISTING_CACHE_VERSION, "root": os.path.abspath(directory), "directories": listing}, f)
+        os.replace(cache_filepath + ".tmp", cache_filepath)
+
+    file_extensions = set(file_extensions)
+    filepaths = []
+    for root, entry in listing.items():
+        for basename in entry["files"]:
+            if os.path.splitext(basename)[1].lower() in file_extensions:
+                filepaths.append(os.path.join(root, basename))
+
+    return sorted(filepaths)
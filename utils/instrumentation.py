@@ -0,0 +1,185 @@
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+
+class _StageTimer:
+    """
+    Context manager that adds the elapsed time to one stage
+    """
+    __slots__ = ("instrumentation", "stage", "start_time")
+
+    def __init__(self, instrumentation, stage: str):
+        self.instrumentation = instrumentation
+        self.stage = stage
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation.add_time(self.stage, time.perf_counter() - self.start_time)
+        return False
+
+
+class Instrumentation:
+    """
+    Cumulative per-stage timers and event counters of one run.
+
+    Stages are timed with `with instrumentation.time("encode"): ...`, events are counted with `instrumentation.count("clips_started")`.
+    Worker processes collect their own instrumentation and send a `snapshot` back, which the main process adds with `merge`.
+    Threads share the instrumentation of their process, so stage times are summed over threads.
+    """
+    enabled = True
+
+    def __init__(self, snapshot_interval: float = None):
+        """
+        :param snapshot_interval: seconds between two snapshots logged by `maybe_log_snapshot`. If None, no snapshots are logged.
+        """
+        self.timers = {}
+        self.counters = {}
+        self.start_time = time.perf_counter()
+        self.snapshot_interval = snapshot_interval
+        self._last_snapshot_time = self.start_time
+        self._lock = threading.Lock()
+
+    def time(self, stage: str):
+        return _StageTimer(self, stage)
+
+    def add_time(self, stage: str, seconds: float, calls: int = 1) -> None:
+        with self._lock:
+            timer = self.timers.get(stage)
+            if timer is None:
+                self.timers[stage] = [seconds, calls]
+            else:
+                timer[0] += seconds
+                timer[1] += calls
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def timed_iter(self, stage: str, iterable):
+        """
+        Wrap an iterator such that the time spent producing each item is added to the stage, e.g., for decoding.
+        """
+        iterator = iter(iterable)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_time(stage, time.perf_counter() - start_time)
+            yield item
+
+    def snapshot(self) -> dict:
+        """
+        :return: dict with the elapsed wall time, the timers (seconds and calls per stage) and the counters
+        """
+        with self._lock:
+            return {
+                "elapsed": time.perf_counter() - self.start_time,
+                "timers": {stage: {"seconds": seconds, "calls": calls} for stage, (seconds, calls) in self.timers.items()},
+                "counters": dict(self.counters),
+            }
+
+    def merge(self, snapshot: dict) -> None:
+        """
+        Add the timers and counters of another run, e.g., of a worker process.
+        """
+        if snapshot is None:
+            return
+
+        for stage, timer in snapshot["timers"].items():
+            self.add_time(stage, timer["seconds"], timer["calls"])
+        for name, n in snapshot["counters"].items():
+            self.count(name, n)
+
+    def summary(self) -> str:
+        """
+        :return: one line with the slowest stages first, followed by the counters
+        """
+        snapshot = self.snapshot()
+        timers = sorted(snapshot["timers"].items(), key=lambda item: item[1]["seconds"], reverse=True)
+        stages = ", ".join(f"{stage} {timer['seconds']:.1f}s" for stage, timer in timers)
+        counters = ", ".join(f"{name} {n}" for name, n in sorted(snapshot["counters"].items()))
+        return f"[{snapshot['elapsed']:.0f}s] {stages} | {counters}"
+
+    def maybe_log_snapshot(self, log) -> None:
+        """
+        Log a summary if the snapshot interval has passed since the last one.
+        """
+        if self.snapshot_interval is None:
+            return
+
+        now = time.perf_counter()
+        if now - self._last_snapshot_time >= self.snapshot_interval:
+            self._last_snapshot_time = now
+            log.info(self.summary())
+
+    def write_report(self, filepath: str, **metadata) -> None:
+        """
+        Write the final snapshot as JSON.
+        :param filepath: output path
+        :param metadata: additional entries, e.g., the run's arguments
+        """
+        with open(filepath, "w") as f:
+            json.dump({**metadata, **self.snapshot()}, f, indent=2)
+
+
+class NullInstrumentation(Instrumentation):
+    """
+    Disabled instrumentation. All methods return immediately, so instrumented code runs at full speed.
+    """
+    enabled = False
+
+    _NULL_CONTEXT = nullcontext()
+
+    def time(self, stage: str):
+        return self._NULL_CONTEXT
+
+    def add_time(self, stage: str, seconds: float, calls: int = 1) -> None:
+        pass
+
+    def count(self, name: str, n: int = 1) -> None:
+        pass
+
+    def timed_iter(self, stage: str, iterable):
+        return iterable
+
+    def snapshot(self) -> dict | None:
+        return None
+
+    def merge(self, snapshot: dict) -> None:
+        pass
+
+    def maybe_log_snapshot(self, log) -> None:
+        pass
+
+
+# Instrumentation of the current process. Disabled unless a run enables it.
+_current = NullInstrumentation()
+
+
+def get_instrumentation() -> Instrumentation:
+    return _current
+
+
+@contextmanager
+def instrumented(enabled: bool = True, snapshot_interval: float = None):
+    """
+    Collect instrumentation in the current process for the duration of the block.
+    :param enabled: if False, the disabled instrumentation is used
+    :param snapshot_interval: see `Instrumentation`
+    :return: the instrumentation of the block
+    """
+    global _current
+    previous = _current
+    _current = Instrumentation(snapshot_interval=snapshot_interval) if enabled else NullInstrumentation()
+    try:
+        yield _current
+    finally:
+        _current = previous
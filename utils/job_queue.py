@@ -0,0 +1,444 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+from utils.logger import setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_STATUSES = (JOB_PENDING, JOB_RUNNING, JOB_DONE, JOB_FAILED)
+
+DEFAULT_MAX_ATTEMPTS = 3
+
+# A claimed job is handed to another worker if its lease is not renewed for this long, e.g., because the worker's machine died
+DEFAULT_LEASE_SECONDS = 300.0
+
+# Delay before the first retry of a failed job. Doubles with every further attempt.
+DEFAULT_RETRY_DELAY = 30.0
+
+# How long idle workers wait before asking for new jobs
+DEFAULT_POLL_INTERVAL = 5.0
+
+# How long to wait for other processes to release the database lock
+BUSY_TIMEOUT = 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    key TEXT UNIQUE,
+    job_group TEXT,
+    after_group TEXT,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    not_before REAL NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, priority, id);
+CREATE INDEX IF NOT EXISTS jobs_by_group ON jobs (job_group, status);
+"""
+
+
+def _json_default(value):
+    # NumPy scalars, e.g., from pandas rows
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, default=_json_default)
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobQueue:
+    """
+    Durable job queue in a SQLite file. Any number of processes, also on different machines with the file on shared storage, can submit and run jobs.
+
+    Workers claim a job for a lease and renew the lease with heartbeats while the job runs. Jobs whose lease expires are handed to the next worker. Failed jobs are retried with exponential backoff until they run out of attempts.
+    Jobs can belong to a group and can wait for all jobs of another group to finish, e.g., a job that combines the results of many scan jobs.
+
+    Every write is a short transaction. The database uses the default rollback journal, because SQLite's WAL mode does not work on network file systems.
+    Jobs can run more than once, e.g., after a lost lease, so they should be idempotent.
+    """
+
+    def __init__(self, filepath: str, busy_timeout: float = BUSY_TIMEOUT):
+        """
+        :param filepath: path to the database. It is created if it does not exist.
+        :param busy_timeout: how long to wait for a lock held by another process, in seconds
+        """
+        self.filepath = filepath
+        # Autocommit mode, transactions are started explicitly
+        self.connection = sqlite3.connect(filepath, timeout=busy_timeout, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        with self._transaction():
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    self.connection.execute(statement)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    @contextmanager
+    def _transaction(self):
+        # Take the write lock right away, so that two workers can never claim the same job
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    @staticmethod
+    def _to_job(row: sqlite3.Row) -> dict:
+        job = dict(row)
+        job["group"] = job.pop("job_group")
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
+
+    def submit_many(self, jobs: list[dict]) -> list[int]:
+        """
+        Add jobs in one transaction. Jobs with a key that already exists are not added again, so submitting the same work twice is safe.
+        :param jobs: dicts with keys kind and payload, and optionally key, group, after_group, priority and max_attempts
+        :return: id of every job, or of the existing job with the same key
+        """
+        now = time.time()
+        job_ids = []
+        with self._transaction() as connection:
+            for job in jobs:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO jobs (kind, key, job_group, after_group, payload, status, priority, max_attempts, not_before, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        job["kind"],
+                        job.get("key"),
+                        job.get("group"),
+                        job.get("after_group"),
+                        _dumps(job["payload"]),
+                        JOB_PENDING,
+                        job.get("priority", 0),
+                        job.get("max_attempts", DEFAULT_MAX_ATTEMPTS),
+                        now,
+                        now,
+                        now,
+                    ),
+                )
+                if cursor.rowcount == 1:
+                    job_ids.append(cursor.lastrowid)
+                else:
+                    job_ids.append(connection.execute("SELECT id FROM jobs WHERE key = ?", (job.get("key"),)).fetchone()["id"])
+        return job_ids
+
+    def submit(self, kind: str, payload: dict, **kwargs) -> int:
+        """
+        Add one job, see `submit_many`.
+        :return: id of the job
+        """
+        return self.submit_many([{"kind": kind, "payload": payload, **kwargs}])[0]
+
+    def _expire_leases(self, connection: sqlite3.Connection, now: float) -> None:
+        connection.execute(
+            "UPDATE jobs SET status = ?, error = 'Lease expired (worker ' || worker || ')', worker = NULL, lease_expires = NULL, updated = ? WHERE status = ? AND lease_expires < ? AND attempts >= max_attempts",
+            (JOB_FAILED, now, JOB_RUNNING, now),
+        )
+        connection.execute(
+            "UPDATE jobs SET status = ?, error = 'Lease expired (worker ' || worker || ')', worker = NULL, lease_expires = NULL, not_before = ?, updated = ? WHERE status = ? AND lease_expires < ?",
+            (JOB_PENDING, now, now, JOB_RUNNING, now),
+        )
+
+    def claim(self, worker_id: str, kinds: list[str] = None, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> dict | None:
+        """
+        Claim the next job that is ready to run. Jobs with a higher priority come first, then jobs in order of submission.
+        :param worker_id: name of the claiming worker, see `default_worker_id`
+        :param kinds: only claim jobs of these kinds. If None, jobs of any kind are claimed.
+        :param lease_seconds: the job is handed to another worker unless the lease is renewed within this time, see `heartbeat`
+        :return: the job as a dict, or None if no job is ready
+        """
+        now = time.time()
+        query = (
+            "SELECT * FROM jobs AS j WHERE status = ? AND not_before <= ? "
+            "AND (after_group IS NULL OR NOT EXISTS (SELECT 1 FROM jobs AS d WHERE d.job_group = j.after_group AND d.status IN (?, ?)))"
+        )
+        parameters = [JOB_PENDING, now, JOB_PENDING, JOB_RUNNING]
+        if kinds is not None:
+            query += f" AND kind IN ({', '.join('?' * len(kinds))})"
+            parameters.extend(kinds)
+        query += " ORDER BY priority DESC, id LIMIT 1"
+
+        with self._transaction() as connection:
+            self._expire_leases(connection, now)
+
+            row = connection.execute(query, parameters).fetchone()
+            if row is None:
+                return None
+
+            connection.execute(
+                "UPDATE jobs SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                (JOB_RUNNING, worker_id, now + lease_seconds, now, row["id"]),
+            )
+            row = connection.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+
+        return self._to_job(row)
+
+    def heartbeat(self, job_id: int, worker_id: str, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> bool:
+        """
+        Renew the lease of a running job.
+        :return: False if the worker has lost the job, e.g., because its lease expired and another worker claimed it
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET lease_expires = ?, updated = ? WHERE id = ? AND worker = ? AND status = ?",
+                (now + lease_seconds, now, job_id, worker_id, JOB_RUNNING),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id: int, worker_id: str, result=None) -> bool:
+        """
+        Mark a job as done.
+        :param result: JSON-serializable result of the job
+        :return: False if the worker no longer holds the job. The result is discarded in this case.
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = NULL, worker = NULL, lease_expires = NULL, updated = ? WHERE id = ? AND worker = ? AND status = ?",
+                (JOB_DONE, _dumps(result), now, job_id, worker_id, JOB_RUNNING),
+            )
+        return cursor.rowcount == 1
+
+    def fail(self, job_id: int, worker_id: str, error: str, retry_delay: float = DEFAULT_RETRY_DELAY) -> str | None:
+        """
+        Record a failed attempt. The job is retried later unless it has used up its attempts.
+        :param error: error message
+        :param retry_delay: delay before the first retry, in seconds. Doubles with every further attempt.
+        :return: new status of the job, or None if the worker no longer holds the job
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ? AND worker = ? AND status = ?", (job_id, worker_id, JOB_RUNNING)).fetchone()
+            if row is None:
+                return None
+
+            status = JOB_PENDING if row["attempts"] < row["max_attempts"] else JOB_FAILED
+            not_before = now + retry_delay * 2 ** (row["attempts"] - 1)
+            connection.execute(
+                "UPDATE jobs SET status = ?, error = ?, worker = NULL, lease_expires = NULL, not_before = ?, updated = ? WHERE id = ?",
+                (status, error, not_before, now, job_id),
+            )
+        return status
+
+    def release(self, job_id: int, worker_id: str) -> bool:
+        """
+        Give a running job back without counting the attempt, e.g., when the worker is interrupted.
+        :return: False if the worker no longer holds the job
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts - 1, worker = NULL, lease_expires = NULL, not_before = ?, updated = ? WHERE id = ? AND worker = ? AND status = ?",
+                (JOB_PENDING, now, now, job_id, worker_id, JOB_RUNNING),
+            )
+        return cursor.rowcount == 1
+
+    def retry(self, kind: str = None, group: str = None) -> int:
+        """
+        Give failed jobs a new set of attempts.
+
+        Jobs that wait for the group of a retried job, see `submit_many`, are run again as well, even if they have already finished, because their result may change. This applies transitively.
+
+        :param kind: only retry jobs of this kind
+        :param group: only retry jobs of this group
+        :return: number of jobs that will be run again, including the dependent jobs
+        """
+        query = "SELECT id, job_group FROM jobs WHERE status = ?"
+        parameters = [JOB_FAILED]
+        if kind is not None:
+            query += " AND kind = ?"
+            parameters.append(kind)
+        if group is not None:
+            query += " AND job_group = ?"
+            parameters.append(group)
+
+        now = time.time()
+        with self._transaction() as connection:
+            rows = connection.execute(query, parameters).fetchall()
+            job_ids = [row["id"] for row in rows]
+            groups = {row["job_group"] for row in rows if row["job_group"] is not None}
+
+            # Dependent jobs that are pending or running will see the retried jobs anyway
+            visited_groups = set()
+            while groups:
+                visited_groups |= groups
+                placeholders = ", ".join("?" * len(groups))
+                dependents = connection.execute(
+                    f"SELECT id, job_group FROM jobs WHERE after_group IN ({placeholders}) AND status IN (?, ?)",
+                    [*groups, JOB_DONE, JOB_FAILED],
+                ).fetchall()
+                job_ids += [row["id"] for row in dependents]
+                groups = {row["job_group"] for row in dependents if row["job_group"] is not None} - visited_groups
+
+            for job_id in job_ids:
+                connection.execute(
+                    "UPDATE jobs SET status = ?, attempts = 0, not_before = ?, updated = ? WHERE id = ?",
+                    (JOB_PENDING, now, now, job_id),
+                )
+        return len(job_ids)
+
+    def jobs(self, kind: str = None, group: str = None, status: str = None) -> list[dict]:
+        """
+        :param kind: only return jobs of this kind
+        :param group: only return jobs of this group
+        :param status: only return jobs with this status
+        :return: matching jobs in order of submission
+        """
+        conditions = []
+        parameters = []
+        for column, value in (("kind", kind), ("job_group", group), ("status", status)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                parameters.append(value)
+
+        query = "SELECT * FROM jobs"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id"
+        return [self._to_job(row) for row in self.connection.execute(query, parameters)]
+
+    def counts(self) -> dict[str, dict[str, int]]:
+        """
+        :return: dict that maps every job kind to the number of jobs per status
+        """
+        counts = {}
+        for row in self.connection.execute("SELECT kind, status, COUNT(*) AS count FROM jobs GROUP BY kind, status ORDER BY kind"):
+            counts.setdefault(row["kind"], {status: 0 for status in JOB_STATUSES})[row["status"]] = row["count"]
+        return counts
+
+    def num_unfinished(self, kinds: list[str] = None) -> int:
+        """
+        :return: number of pending and running jobs, optionally only of the given kinds
+        """
+        query = "SELECT COUNT(*) AS count FROM jobs WHERE status IN (?, ?)"
+        parameters = [JOB_PENDING, JOB_RUNNING]
+        if kinds is not None:
+            query += f" AND kind IN ({', '.join('?' * len(kinds))})"
+            parameters.extend(kinds)
+        return self.connection.execute(query, parameters).fetchone()["count"]
+
+
+class _Heartbeat(threading.Thread):
+    """
+    Renew the lease of a running job in the background. Uses its own connection, because SQLite connections cannot be shared between threads.
+    """
+
+    def __init__(self, filepath: str, job_id: int, worker_id: str, lease_seconds: float):
+        super().__init__(daemon=True)
+        self.filepath = filepath
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.stop_event = threading.Event()
+        self.lost_event = threading.Event()
+
+    def run(self):
+        with JobQueue(self.filepath) as job_queue:
+            while not self.stop_event.wait(self.lease_seconds / 3):
+                try:
+                    if not job_queue.heartbeat(self.job_id, self.worker_id, self.lease_seconds):
+                        log.warning(f"Lost the lease of job {self.job_id}")
+                        self.lost_event.set()
+                        return
+                except sqlite3.Error as e:
+                    # Try again with the next heartbeat. The lease only expires after several missed heartbeats.
+                    log.warning(f"Heartbeat of job {self.job_id} failed: {e}")
+
+
+def run_worker(
+    filepath: str,
+    handlers: dict,
+    worker_id: str = None,
+    kinds: list[str] = None,
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    retry_delay: float = DEFAULT_RETRY_DELAY,
+    poll_interval: float = DEFAULT_POLL_INTERVAL,
+    max_jobs: int = None,
+    exit_when_idle: bool = False,
+) -> dict[str, int]:
+    """
+    Claim and run jobs until stopped.
+    :param filepath: path to the queue database
+    :param handlers: dict that maps job kinds to functions (job_queue, job) -> result. Exceptions mark the attempt as failed.
+    :param worker_id: name of this worker. By default, the host name and process id.
+    :param kinds: only run jobs of these kinds. By default, all kinds with a handler.
+    :param lease_seconds: lease of claimed jobs. Leases are renewed every third of this time while a job runs.
+    :param retry_delay: delay before the first retry of a failed job, in seconds
+    :param poll_interval: how long to wait when no job is ready, in seconds
+    :param max_jobs: stop after this many jobs
+    :param exit_when_idle: stop once no job is pending or running
+    :return: dict with the number of done, failed and lost jobs
+    """
+    worker_id = worker_id or default_worker_id()
+    kinds = list(kinds or handlers)
+    counters = {"done": 0, "failed": 0, "lost": 0}
+
+    with JobQueue(filepath) as job_queue:
+        while max_jobs is None or sum(counters.values()) < max_jobs:
+            job = job_queue.claim(worker_id, kinds=kinds, lease_seconds=lease_seconds)
+            if job is None:
+                if exit_when_idle and job_queue.num_unfinished(kinds) == 0:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            log.info(f"Running {job['kind']} job {job['id']} (attempt {job['attempts']} of {job['max_attempts']})")
+            heartbeat = _Heartbeat(filepath, job["id"], worker_id, lease_seconds)
+            heartbeat.start()
+            try:
+                result = handlers[job["kind"]](job_queue, job)
+            except KeyboardInterrupt:
+                job_queue.release(job["id"], worker_id)
+                raise
+            except Exception as e:
+                status = job_queue.fail(job["id"], worker_id, f"{type(e).__name__}: {e}", retry_delay=retry_delay)
+                log.error(f"{job['kind']} job {job['id']} failed ({status or 'lease lost'}): {e}", exc_info=True)
+                counters["failed" if status is not None else "lost"] += 1
+                continue
+            finally:
+                heartbeat.stop_event.set()
+                heartbeat.join()
+
+            if job_queue.complete(job["id"], worker_id, result):
+                counters["done"] += 1
+            else:
+                log.warning(f"Discarding the result of {job['kind']} job {job['id']}, another worker has taken it over")
+                counters["lost"] += 1
+
+    return counters
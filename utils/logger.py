@@ -1,5 +1,36 @@
-import logging
+import os
 import sys
+import copy
+import json
+import queue
+import logging
+import threading
+import multiprocessing
+import logging.handlers
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Messages from one call site beyond this many per interval are dropped and counted, see `RateLimitFilter`
+DEFAULT_RATE_LIMIT = 5
+DEFAULT_RATE_LIMIT_INTERVAL = 10.0
+
+# Loggers created by `setup_basic_logger`, so that their handlers can be switched to background logging
+_loggers = {}
+
+# Shared handlers while background logging is enabled
+_background = None
+_background_lock = threading.Lock()
+
+
+def _stdout_handler():
+    # Taken from https://stackoverflow.com/questions/7621897/python-logging-module-globally
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(logging.DEBUG)
+    handler.setFormatter(logging.Formatter(fmt=LOG_FORMAT))
+    return handler
 
 
 def setup_basic_logger(name):
@@ -7,14 +38,274 @@ def setup_basic_logger(name):
     logger = logging.getLogger(name)
 
     if not logger.handlers:
-        # Taken from https://stackoverflow.com/questions/7621897/python-logging-module-globally
-        handler = logging.StreamHandler(sys.stdout)
-        handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter(fmt='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
+        if _background is not None:
+            logger.addHandler(_background["queue_handler"])
+        else:
+            logger.addHandler(_stdout_handler())
 
     # Prevent propagation to root logger, otherwise messages get logged twice.
     logger.propagate = False
     logger.setLevel(logging.DEBUG)
+    _loggers[name] = logger
     return logger
+
+
+def log_event(logger, event, message, level=logging.INFO, exc_info=False, **fields):
+    """
+    Log a message that is also written to the JSON-lines event log, see `enable_background_logging`.
+    :param logger: logger returned by `setup_basic_logger`
+    :param event: event name, e.g., "clip_finished"
+    :param message: message for the regular log
+    :param level: log level
+    :param exc_info: if True, add the current exception to the regular log
+    :param fields: JSON-serializable fields of the event
+    """
+    logger.log(level, message, exc_info=exc_info, extra={"event": event, "fields": fields})
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let through at most `max_records` messages per call site and interval. Dropped messages are counted and reported with the next message from the same call site.
+
+    Call sites are identified by file and line, so messages built with f-strings, e.g., per frame, are limited together. Events are never dropped.
+    """
+
+    def __init__(self, max_records=DEFAULT_RATE_LIMIT, interval=DEFAULT_RATE_LIMIT_INTERVAL):
+        super().__init__()
+        self.max_records = max_records
+        self.interval = interval
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if hasattr(record, "event"):
+            return True
+
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            window = self._windows.get(key)
+
+            # Start a new interval
+            if window is None or record.created - window["start"] >= self.interval:
+                num_dropped = window["dropped"] if window is not None else 0
+                self._windows[key] = {"start": record.created, "count": 1, "dropped": 0}
+                if num_dropped > 0:
+                    record.msg = f"{record.msg} ({num_dropped} similar messages dropped)"
+                return True
+
+            if window["count"] < self.max_records:
+                window["count"] += 1
+                return True
+
+            window["dropped"] += 1
+            return False
+
+    def pop_dropped(self):
+        """
+        :return: dict that maps call sites (file, line) to the number of dropped messages that have not been reported yet
+        """
+        with self._lock:
+            dropped = {key: window["dropped"] for key, window in self._windows.items() if window["dropped"] > 0}
+            self._windows.clear()
+        return dropped
+
+
+class _EventFilter(logging.Filter):
+    def filter(self, record):
+        return hasattr(record, "event")
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Format an event as one JSON object with the time, logger, level, event name, message and the event's fields
+    """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "logger": record.name,
+            "level": record.levelname,
+            "event": record.event,
+            "message": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        return json.dumps(entry, default=str)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves formatting to the listener thread. The records stay in this process, so they do not need to be made picklable.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class _ProcessQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler for forked processes. Records are pickled, so the message and traceback are rendered here, but the formatting is left to the parent's handlers.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _events_handler(events_filepath):
+    handler = logging.FileHandler(events_filepath, mode="a", encoding="utf-8")
+    handler.setFormatter(JsonLinesFormatter())
+    handler.addFilter(_EventFilter())
+    return handler
+
+
+def enable_background_logging(events_filepath=None, rate_limit=DEFAULT_RATE_LIMIT, rate_limit_interval=DEFAULT_RATE_LIMIT_INTERVAL):
+    """
+    Move formatting and output of all loggers created by `setup_basic_logger` to a background thread. Logging calls only put the record into a queue.
+
+    Processes forked while background logging is enabled, e.g., pool workers, put their records into a multiprocessing queue, which is served by a second listener thread in this process. Each forked process rate-limits its own messages.
+
+    :param events_filepath: if given, events logged with `log_event` are appended to this JSON-lines file
+    :param rate_limit: maximum number of messages per call site and interval. If None, no messages are dropped.
+    :param rate_limit_interval: interval of the rate limit, in seconds
+    """
+    global _background
+
+    with _background_lock:
+        if _background is not None:
+            raise RuntimeError("Background logging is already enabled")
+
+        handlers = [_stdout_handler()]
+        if events_filepath is not None:
+            handlers.append(_events_handler(events_filepath))
+
+        log_queue = queue.SimpleQueue()
+        queue_handler = _DeferredQueueHandler(log_queue)
+        rate_limit_filter = None
+        if rate_limit is not None:
+            # Dropped records never reach the queue
+            rate_limit_filter = RateLimitFilter(max_records=rate_limit, interval=rate_limit_interval)
+            queue_handler.addFilter(rate_limit_filter)
+
+        listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+
+        # Records from forked processes are formatted in the child, so that they can be pickled
+        process_queue = multiprocessing.Queue()
+        process_listener = logging.handlers.QueueListener(process_queue, *handlers, respect_handler_level=True)
+        process_listener.start()
+
+        previous_handlers = {}
+        for name, logger in _loggers.items():
+            previous_handlers[name] = list(logger.handlers)
+            for handler in previous_handlers[name]:
+                logger.removeHandler(handler)
+            logger.addHandler(queue_handler)
+
+        _background = {
+            "listener": listener,
+            "process_listener": process_listener,
+            "process_queue": process_queue,
+            "queue_handler": queue_handler,
+            "handlers": handlers,
+            "rate_limit": rate_limit,
+            "rate_limit_interval": rate_limit_interval,
+            "rate_limit_filter": rate_limit_filter,
+            "previous_handlers": previous_handlers,
+        }
+
+
+def _restore_handlers(background, make_handlers):
+    for name, logger in _loggers.items():
+        logger.removeHandler(background["queue_handler"])
+        for handler in make_handlers(name):
+            logger.addHandler(handler)
+
+
+def disable_background_logging():
+    """
+    Log all queued messages, report the messages dropped by the rate limit and switch back to synchronous logging.
+    """
+    global _background
+
+    with _background_lock:
+        background = _background
+        if background is None:
+            return
+        _background = None
+
+        if background["listener"] is None:
+            # Forked process, see `_after_fork_in_child`. The parent owns the listeners and handlers.
+            _restore_handlers(background, lambda name: [_stdout_handler()])
+            return
+
+        # Records from forked processes that have already been queued are still written
+        background["listener"].stop()
+        background["process_listener"].stop()
+        background["process_queue"].close()
+        background["process_queue"].join_thread()
+
+        if background["rate_limit_filter"] is not None:
+            logger = logging.getLogger(__name__)
+            for (pathname, lineno), num_dropped in background["rate_limit_filter"].pop_dropped().items():
+                record = logger.makeRecord(__name__, logging.INFO, pathname, lineno, f"Dropped {num_dropped} messages from {os.path.basename(pathname)}:{lineno}", None, None)
+                background["handlers"][0].handle(record)
+
+        for handler in background["handlers"]:
+            handler.close()
+
+        _restore_handlers(background, lambda name: background["previous_handlers"].get(name) or [_stdout_handler()])
+
+
+@contextmanager
+def background_logging(enabled=True, **kwargs):
+    """
+    Enable background logging for the duration of the block, see `enable_background_logging`.
+    :param enabled: if False, logging stays synchronous
+    """
+    if not enabled:
+        yield
+        return
+
+    enable_background_logging(**kwargs)
+    try:
+        yield
+    finally:
+        disable_background_logging()
+
+
+def _after_fork_in_child():
+    # The listener threads do not exist in the child, so records are sent to the parent's process listener instead
+    global _background, _background_lock
+
+    _background_lock = threading.Lock()
+    background = _background
+    if background is None:
+        return
+
+    # One handler shared by all loggers
+    queue_handler = _ProcessQueueHandler(background["process_queue"])
+    rate_limit_filter = None
+    if background["rate_limit"] is not None:
+        rate_limit_filter = RateLimitFilter(max_records=background["rate_limit"], interval=background["rate_limit_interval"])
+        queue_handler.addFilter(rate_limit_filter)
+
+    _restore_handlers(background, lambda name: [queue_handler])
+    _background = {
+        **background,
+        "listener": None,
+        "process_listener": None,
+        "queue_handler": queue_handler,
+        "handlers": [],
+        "rate_limit_filter": rate_limit_filter,
+        "previous_handlers": {},
+    }
+
+
+# Windows has no fork
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
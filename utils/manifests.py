@@ -0,0 +1,137 @@
+import os
+import ast
+import json
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from utils.files import file_signature
+from utils.logger import setup_basic_logger
+
+
+log = setup_basic_logger(os.path.basename(__file__))
+
+
+# Columns that the metadata export stores as stringified Python lists
+LIST_COLUMNS = ("gestures", "dataset_labels")
+
+# String columns with at most this fraction of distinct values are stored as categoricals
+CATEGORY_MAX_FRACTION = 0.5
+
+# Key of the source CSV's signature in the Parquet schema metadata
+SIGNATURE_METADATA_KEY = b"source_signature"
+
+
+def _parse_list(value):
+    if isinstance(value, str):
+        return ast.literal_eval(value)
+    return value
+
+
+def _format_list(value) -> str:
+    # Parquet stores lists of dicts as structs with the union of all keys. Keys that a dict did not have come back as None.
+    return str([{k: v for k, v in item.items() if v is not None} if isinstance(item, dict) else item for item in value])
+
+
+def convert_types(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Give the columns of a manifest read from CSV their proper types: stringified lists become lists, columns of booleans with missing values become nullable booleans, and repetitive strings become categoricals.
+    :param df: manifest as read by `pd.read_csv`
+    :return: converted copy
+    """
+    df = df.copy()
+    for column in df.columns:
+        values = df[column]
+        non_null = values.dropna()
+
+        if column in LIST_COLUMNS:
+            df[column] = values.map(_parse_list, na_action="ignore")
+        elif values.dtype == object and len(non_null) > 0 and non_null.map(type).eq(bool).all():
+            df[column] = values.astype("boolean")
+        elif pd.api.types.is_string_dtype(values) and values.nunique() <= CATEGORY_MAX_FRACTION * len(values):
+            df[column] = values.astype("category")
+
+    return df
+
+
+def cache_filepath(csv_filepath: str, cache_dir: str = None) -> str:
+    """
+    :param csv_filepath: path to manifest CSV
+    :param cache_dir: directory for the cache. If None, the cache is stored next to the CSV file.
+    :return: path to the Parquet cache of the manifest
+    """
+    directory, filename = os.path.split(os.path.abspath(csv_filepath))
+    return os.path.join(cache_dir or directory, os.path.splitext(filename)[0] + ".parquet")
+
+
+def write_parquet(df: pd.DataFrame, filepath: str, source_signature: dict = None) -> None:
+    """
+    Store a manifest as Parquet. The file is replaced in one step.
+    :param df: manifest, see `convert_types`
+    :param filepath: output path
+    :param source_signature: signature of the CSV file the manifest was read from, see `utils.files.file_signature`
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if source_signature is not None:
+        table = table.replace_schema_metadata({**table.schema.metadata, SIGNATURE_METADATA_KEY: json.dumps(source_signature).encode()})
+
+    pq.write_table(table, filepath + ".tmp")
+    os.replace(filepath + ".tmp", filepath)
+
+
+def _read_signature(parquet_filepath: str) -> dict | None:
+    try:
+        metadata = pq.read_schema(parquet_filepath).metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return None
+
+    signature = metadata.get(SIGNATURE_METADATA_KEY)
+    return json.loads(signature) if signature is not None else None
+
+
+def read_manifest(filepath: str, columns: list[str] = None, cache_dir: str = None, use_cache: bool = True) -> pd.DataFrame:
+    """
+    Read a video manifest with typed columns.
+
+    Parquet files are read directly. CSV files are converted once into a Parquet cache, which is used as long as the CSV file is unchanged. Parquet is columnar, so only the requested columns are read.
+
+    :param filepath: path to manifest, either .csv or .parquet
+    :param columns: columns to read. If None, all columns are read.
+    :param cache_dir: directory for the Parquet cache of CSV files. If None, the cache is stored next to the CSV file.
+    :param use_cache: if False, CSV files are read without a cache
+    :return: data frame with one row per video
+    """
+    if os.path.splitext(filepath)[1].lower() == ".parquet":
+        return pd.read_parquet(filepath, columns=columns)
+
+    if not use_cache:
+        return convert_types(pd.read_csv(filepath, usecols=columns))
+
+    parquet_filepath = cache_filepath(filepath, cache_dir=cache_dir)
+    signature = file_signature(filepath)
+    if os.path.exists(parquet_filepath) and _read_signature(parquet_filepath) == signature:
+        return pd.read_parquet(parquet_filepath, columns=columns)
+
+    # The cache holds all columns, so that later calls can select different ones
+    df = convert_types(pd.read_csv(filepath))
+    try:
+        write_parquet(df, parquet_filepath, source_signature=signature)
+        log.info(f"Cached \"{filepath}\" to \"{parquet_filepath}\"")
+    except OSError as e:
+        log.warning(f"Failed to cache \"{filepath}\": {e}")
+
+    return df[columns] if columns is not None else df
+
+
+def write_manifest(df: pd.DataFrame, filepath: str) -> None:
+    """
+    Store a manifest as .parquet or .csv, depending on the extension. In CSV files, lists are written as stringified Python lists, like in the metadata export.
+    """
+    if os.path.splitext(filepath)[1].lower() == ".parquet":
+        write_parquet(df, filepath)
+        return
+
+    df = df.copy()
+    for column in LIST_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].map(_format_list, na_action="ignore")
+    df.to_csv(filepath, index=False)
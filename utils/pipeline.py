@@ -0,0 +1,107 @@
+import queue
+import threading
+
+
+# Marks the end of a stream of work items
+END_OF_STREAM = object()
+
+# How often blocked stages check whether the pipeline has been stopped
+POLL_INTERVAL = 0.1
+
+
+class PipelineStopped(Exception):
+    """
+    Raised inside a stage when another stage has failed and the pipeline is shutting down
+    """
+    pass
+
+
+class Pipeline:
+    """
+    Stages running in threads, connected by bounded queues.
+
+    Blocking puts on a full queue provide backpressure. If any stage raises an exception, all other stages are stopped at their next put or get, and `join` re-raises the first exception.
+    """
+
+    def __init__(self):
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.threads = []
+        self._errors_lock = threading.Lock()
+
+    def new_queue(self, maxsize: int) -> queue.Queue:
+        return queue.Queue(maxsize=maxsize)
+
+    def put(self, q: queue.Queue, item) -> None:
+        """
+        Put an item into a queue. Blocks while the queue is full.
+        :raises PipelineStopped: if the pipeline is shutting down
+        """
+        while True:
+            if self.stop_event.is_set():
+                raise PipelineStopped()
+            try:
+                q.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def get(self, q: queue.Queue):
+        """
+        Get an item from a queue. Blocks while the queue is empty.
+        :raises PipelineStopped: if the pipeline is shutting down
+        """
+        while True:
+            if self.stop_event.is_set():
+                raise PipelineStopped()
+            try:
+                return q.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+
+    def acquire(self, semaphore: threading.Semaphore) -> None:
+        """
+        Acquire a semaphore, e.g., to limit the number of items in flight between two stages.
+        :raises PipelineStopped: if the pipeline is shutting down
+        """
+        while not semaphore.acquire(timeout=POLL_INTERVAL):
+            if self.stop_event.is_set():
+                raise PipelineStopped()
+
+    def add_stage(self, name: str, target, *args) -> None:
+        """
+        Register a stage. The stage is a function that reads from and writes to queues using `get` and `put`.
+        :param name: thread name
+        :param target: function to run
+        :param args: arguments to the function
+        """
+        def run():
+            try:
+                target(*args)
+            except PipelineStopped:
+                pass
+            except BaseException as e:
+                with self._errors_lock:
+                    self.errors.append(e)
+                self.stop_event.set()
+
+        self.threads.append(threading.Thread(target=run, name=name, daemon=True))
+
+    def run(self) -> None:
+        """
+        Start all stages and wait for them to finish.
+        :raises: the first exception raised by any stage
+        """
+        for thread in self.threads:
+            thread.start()
+
+        try:
+            for thread in self.threads:
+                while thread.is_alive():
+                    thread.join(timeout=POLL_INTERVAL)
+        except KeyboardInterrupt:
+            self.stop_event.set()
+            raise
+
+        if self.errors:
+            raise self.errors[0]